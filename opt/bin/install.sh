@@ -46,7 +46,7 @@ echo ==== Installing python requirements
 pip3 install --no-cache-dir -r /opt/lib/requirements.txt || exit $?
 
 # Set up permissions/dirs
-chmod 755 /opt/bin/*.sh /opt/lib/reload.py /opt/lib/runjob.py
+chmod 755 /opt/bin/*.sh /opt/lib/reload.py /opt/lib/runjob.py /opt/lib/dispatcher.py /opt/lib/watcher.py
 mkdir -p /var/etc
 
 # Clean up
@@ -17,39 +17,206 @@
  * Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
  */
 
+#include <errno.h>
+#include <stdint.h>
 #include <stdio.h>
 #include <stdlib.h>
 #include <string.h>
+#include <sys/socket.h>
+#include <sys/un.h>
+#include <time.h>
 #include <unistd.h>
 
 const char *python3 = "/usr/bin/python3";
 const char *runjob = "/opt/lib/runjob.py";
+const char *dispatcher = "/var/run/docker-gen-cron.sock";
 
 extern char **environ;
 
+static int send_all(int fd, const void *buf, size_t len)
+{
+	const char *p = buf;
+	ssize_t n;
+
+	while (len > 0) {
+		n = send(fd, p, len, MSG_NOSIGNAL);
+		if (n < 0) {
+			if (errno == EINTR)
+				continue;
+			return -1;
+		}
+		p += n;
+		len -= n;
+	}
+
+	return 0;
+}
+
+static int write_all(int fd, const void *buf, size_t len)
+{
+	const char *p = buf;
+	ssize_t n;
+
+	while (len > 0) {
+		n = write(fd, p, len);
+		if (n < 0) {
+			if (errno == EINTR)
+				continue;
+			return -1;
+		}
+		p += n;
+		len -= n;
+	}
+
+	return 0;
+}
+
+static int read_all(int fd, void *buf, size_t len)
+{
+	char *p = buf;
+	ssize_t n;
+
+	while (len > 0) {
+		n = read(fd, p, len);
+		if (n < 0 && errno == EINTR)
+			continue;
+		if (n <= 0)
+			return -1;
+		p += n;
+		len -= n;
+	}
+
+	return 0;
+}
+
+static uint32_t be32(const unsigned char *p)
+{
+	return ((uint32_t) p[0] << 24) | ((uint32_t) p[1] << 16) | ((uint32_t) p[2] << 8) | p[3];
+}
+
+/*
+ * Hands the job to the dispatcher daemon (see /opt/lib/dispatcher.py) and
+ * relays its output.  Returns 0 if the dispatcher could not be reached and
+ * the job was not sent, otherwise 1 with the job's exit code in *code.
+ */
+static int dispatch(int argc, char **argv, const char *fired, int *code)
+{
+	struct sockaddr_un addr;
+	unsigned char hdr[8];
+	char buf[65536];
+	char argcs[16];
+	uint32_t len;
+	ssize_t n;
+	int fd, i, out;
+
+	fd = socket(AF_UNIX, SOCK_STREAM | SOCK_CLOEXEC, 0);
+	if (fd < 0)
+		return 0;
+
+	memset(&addr, 0, sizeof(addr));
+	addr.sun_family = AF_UNIX;
+	strncpy(addr.sun_path, dispatcher, sizeof(addr.sun_path) - 1);
+	if (connect(fd, (struct sockaddr *) &addr, sizeof(addr)) < 0)
+		goto unavailable;
+
+	/* Send request: argc, argv, environment, all NUL-terminated */
+	snprintf(argcs, sizeof(argcs), "%d", argc - 1);
+	if (send_all(fd, argcs, strlen(argcs) + 1) < 0)
+		goto unavailable;
+	for (i = 1; i < argc; i++) {
+		if (send_all(fd, argv[i], strlen(argv[i]) + 1) < 0)
+			goto unavailable;
+	}
+	for (i = 0; environ[i]; i++) {
+		if (send_all(fd, environ[i], strlen(environ[i]) + 1) < 0)
+			goto unavailable;
+	}
+	if (send_all(fd, fired, strlen(fired) + 1) < 0)
+		goto unavailable;
+	if (shutdown(fd, SHUT_WR) < 0)
+		goto unavailable;
+
+	/* Relay output frames until the exit frame arrives */
+	*code = 1;
+	for (;;) {
+		if (read_all(fd, hdr, sizeof(hdr)) < 0)
+			goto lost;
+		len = be32(hdr + 4);
+
+		if (hdr[0] == 3) {
+			if (len != 4 || read_all(fd, hdr, 4) < 0)
+				goto lost;
+			*code = (int) (int32_t) be32(hdr);
+			break;
+		}
+
+		out = hdr[0] == 2 ? 2 : 1;
+		while (len > 0) {
+			n = read(fd, buf, len < sizeof(buf) ? len : sizeof(buf));
+			if (n < 0 && errno == EINTR)
+				continue;
+			if (n <= 0)
+				goto lost;
+			write_all(out, buf, n);
+			len -= n;
+		}
+	}
+
+	close(fd);
+	return 1;
+
+lost:
+	fprintf(stderr, "runjob: lost connection to dispatcher\n");
+	close(fd);
+	return 1;
+
+unavailable:
+	close(fd);
+	return 0;
+}
+
 int main(int argc, char **argv)
 {
 	const char **pyargv, **pyenv;
+	struct timespec now;
+	char fired[64];
+	const char *profile;
 	int elen;
 	int i, t;
+	int code;
+
+	/* Note when fcron fired the job, for dispatch latency metrics */
+	clock_gettime(CLOCK_REALTIME, &now);
+	snprintf(fired, sizeof(fired), "DOCKER_GEN_CRON_FIRED=%ld.%06ld", (long) now.tv_sec, now.tv_nsec / 1000);
+
+	/* Prefer the dispatcher, fall back to running the job ourselves */
+	if (dispatch(argc, argv, fired, &code))
+		return code;
 
 	/* Count environment */
 	for (elen = 0; environ[elen]; elen++) { }
 
 	/* Copy and filter environment */
-	pyenv = (const char **) malloc((elen + 1) * sizeof(char *));
+	pyenv = (const char **) malloc((elen + 2) * sizeof(char *));
 	for (i = 0, t = 0; i < elen; i++) {
 		if (strncmp("PYTHON", environ[i], 6)) {
 			pyenv[t++] = environ[i];
 		}
 	}
 
+	pyenv[t++] = fired;
 	pyenv[t] = NULL;
 
 	/* Copy and modify argv */
 	t = 0;
-	pyargv = (const char **) malloc((argc + 2) * sizeof(char *));
+	pyargv = (const char **) malloc((argc + 4) * sizeof(char *));
 	pyargv[t++] = python3;
+	profile = getenv("DOCKER_GEN_CRON_PROFILE_STARTUP");
+	if (profile && *profile) {
+		/* Report the import time of each module on stderr */
+		pyargv[t++] = "-X";
+		pyargv[t++] = "importtime";
+	}
 	pyargv[t++] = runjob;
 	for (i = 1; i < argc; i++) {
 		pyargv[t++] = argv[i];
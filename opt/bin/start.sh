@@ -1,6 +1,6 @@
 #!/bin/sh
 
-rm -f /var/etc/jobs.json
+rm -f /var/etc/jobs.json /var/etc/jobs.idx /var/etc/reload.cache
 . /opt/bin/fcron.sh
 
 if [ -n "$PREFIX" ]; then
@@ -11,6 +11,24 @@ if [ -n "$DEBUG" ]; then
 	export DOCKER_GEN_CRON_DEBUG=$DEBUG
 fi
 
+if [ -n "$WATCHER" ]; then
+	export DOCKER_GEN_CRON_WATCHER=$WATCHER
+fi
+
+if [ -n "$METRICS" ]; then
+	export DOCKER_GEN_CRON_METRICS=$METRICS
+fi
+
+rm -f /var/run/docker-gen-cron.sock
+
+# With the built-in watcher, the dispatcher follows docker events itself
+if [ -n "$DOCKER_GEN_CRON_WATCHER" ]; then
+	exec /opt/lib/dispatcher.py
+fi
+
+# Start job dispatcher
+/opt/lib/dispatcher.py &
+
 # Start docker-gen after delay
 sleep 1
 exec docker-gen -config /opt/etc/jobs.cfg
@@ -0,0 +1,342 @@
+# This file is part of docker-gen-cron
+# Copyright (C) 2020 John J. Jordan
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+
+# asyncio counterpart of exec.docker_exec, for running many execs from one event
+# loop: each exec in flight is a task holding a stream pair and a read buffer,
+# rather than a thread (plus a stdin writer thread).  The HTTP details (request
+# format, response framing, errors) are shared with dockerapi.
+
+import asyncio
+import json
+import logging
+import struct
+import sys
+import time
+
+import dockerapi
+import exec
+import metrics
+
+logger = logging.getLogger("aioexec")
+
+class AsyncClient:
+    """
+    AsyncClient makes the Docker Engine API calls of an exec with asyncio streams.
+    Connections are kept alive and pooled like dockerapi.Client's.  It must only be
+    used from the event loop it was first used on.
+
+    Args:
+        base_url (str): unix:// or tcp:// URL of the daemon, defaults to $DOCKER_HOST
+        timeout (int): Timeout for API calls, in seconds
+        pool_size (int): Maximum number of idle connections to keep
+    """
+    def __init__(self, base_url=None, timeout=60, pool_size=8):
+        self.socket_path, self.address, self.prefix = dockerapi.parse_host(base_url)
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self._idle = []
+
+    async def exec_create(self, container, cmd, stdin=False, environment=None, user=""):
+        """Creates an exec instance, see dockerapi.Client.exec_create"""
+        body = {
+            "AttachStdin": stdin,
+            "AttachStdout": True,
+            "AttachStderr": True,
+            "Tty": False,
+            "Cmd": cmd,
+            "Env": ["{}={}".format(k, v) for k, v in (environment or {}).items()],
+            "User": user,
+        }
+        return await self._json("POST", "/containers/{}/exec".format(dockerapi.quote(container)), body)
+
+    async def exec_start(self, exec_id):
+        """Starts an exec instance.
+
+        Returns:
+            asyncio.StreamReader: Multiplexed stdout and stderr of the exec
+            asyncio.StreamWriter: Stdin of the exec
+        """
+        body = json.dumps({"Detach": False, "Tty": False}).encode("utf-8")
+        headers = {"Content-Type": "application/json", "Connection": "Upgrade", "Upgrade": "tcp"}
+        reader, writer, resp = await self._send("POST", "/exec/{}/start".format(dockerapi.quote(exec_id)), body, headers)
+        if resp.status not in (101, 200):
+            try:
+                dockerapi.check_response(resp, await read_body(reader, resp))
+            finally:
+                writer.close()
+        # The stream now belongs to the exec, anything read past the headers is still
+        # in the reader's buffer
+        return reader, writer
+
+    async def exec_inspect(self, exec_id):
+        """Returns the inspect output of an exec instance"""
+        return await self._json("GET", "/exec/{}/json".format(dockerapi.quote(exec_id)))
+
+    async def close(self):
+        """Closes idle connections"""
+        idle, self._idle = self._idle, []
+        for _, writer in idle:
+            writer.close()
+
+    async def _json(self, method, path, body=None):
+        """Makes an API call and returns the decoded JSON response, if any"""
+        data = None
+        headers = {}
+        if body is not None:
+            data = json.dumps(body).encode("utf-8")
+            headers["Content-Type"] = "application/json"
+
+        reader, writer, resp = await self._send(method, path, data, headers)
+        try:
+            content = await asyncio.wait_for(read_body(reader, resp), self.timeout)
+        except:
+            writer.close()
+            raise
+
+        if resp.will_close or len(self._idle) >= self.pool_size:
+            writer.close()
+        else:
+            self._idle.append((reader, writer))
+
+        dockerapi.check_response(resp, content)
+        if len(content) == 0:
+            return None
+        return json.loads(content)
+
+    async def _send(self, method, path, body, headers):
+        """Sends a request on a pooled connection, retrying once on a fresh connection if
+        the daemon closed an idle one.
+
+        Returns:
+            asyncio.StreamReader: The connection's reader
+            asyncio.StreamWriter: The connection's writer, which the caller must pool or close
+            dockerapi.Response: The response, with only headers read
+        """
+        data = dockerapi.format_request(method, self.prefix + path, body, headers)
+        while self._idle:
+            reader, writer = self._idle.pop()
+            try:
+                return reader, writer, await self._exchange(reader, writer, data)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                writer.close()
+
+        reader, writer = await asyncio.wait_for(self._connect(), self.timeout)
+        try:
+            return reader, writer, await self._exchange(reader, writer, data)
+        except:
+            writer.close()
+            raise
+
+    async def _exchange(self, reader, writer, data):
+        writer.write(data)
+        await writer.drain()
+        return await asyncio.wait_for(read_head(reader), self.timeout)
+
+    async def _connect(self):
+        if self.socket_path is not None:
+            return await asyncio.open_unix_connection(self.socket_path, limit=exec.BUFFER_SIZE)
+        return await asyncio.open_connection(*self.address, limit=exec.BUFFER_SIZE)
+
+async def read_head(reader):
+    """Reads the status line and headers of a response.
+
+    Returns:
+        dockerapi.Response: The response, to be read with read_body
+    """
+    version, status, reason = dockerapi.parse_status((await reader.readuntil(b"\n")).rstrip(b"\r\n"))
+    headers = {}
+    while True:
+        line = (await reader.readuntil(b"\n")).rstrip(b"\r\n")
+        if line == b"":
+            break
+        dockerapi.parse_header(line, headers)
+    return dockerapi.Response(None, version, status, reason, headers)
+
+async def read_body(reader, resp):
+    """Returns the entire body of a response"""
+    if resp.chunked:
+        chunks = []
+        while True:
+            size = int((await reader.readuntil(b"\n")).split(b";")[0], 16)
+            if size == 0:
+                # Trailers
+                while (await reader.readuntil(b"\n")).strip() != b"":
+                    pass
+                return b"".join(chunks)
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+    elif resp.length is not None:
+        return await reader.readexactly(resp.length)
+    return await reader.read()
+
+async def docker_exec(client, container_name, args, input, stdout=None, stderr=None):
+    """Executes a command in a container, writes output to stdout/stderr and returns the
+    exit code.  Same as exec.docker_exec, but for an AsyncClient.
+
+    Output is written to stdout/stderr from the event loop, so they should be files or
+    buffers rather than pipes that may fill up.
+
+    Args:
+        client (AsyncClient): Docker client
+        container_name (str): Container to run the command in
+        args (dict): Keyword arguments to pass to client.exec_create
+        input (str/bytes/file): Data to write to stdin of exec process (text, bytes or a binary
+            file to stream from), or None to close stdin.
+        stdout (file): Binary stream to write stdout to, or None for sys.stdout
+        stderr (file): Binary stream to write stderr to, or None for sys.stderr
+
+    Returns:
+        int: Exit code of process
+    """
+    started = time.monotonic()
+    has_input = not not input
+    ec = await client.exec_create(container_name, stdin=has_input, **args)
+    id = ec["Id"]
+
+    reader, writer = await client.exec_start(id)
+    stdin = None
+    try:
+        # Write stdin alongside reading output, so neither side can fill up and stall
+        # the other.
+        if has_input:
+            stdin = asyncio.ensure_future(write_stdin(writer, input))
+        out_bytes, err_bytes = await read_result(reader, stdout, stderr)
+    finally:
+        if stdin is not None:
+            # The process may be done without reading all of its input
+            stdin.cancel()
+            await asyncio.gather(stdin, return_exceptions=True)
+        writer.close()
+    closed = time.monotonic()
+    inspect = await wait_for_exit(client, id)
+    finished = time.monotonic()
+
+    metrics.OUTPUT_BYTES.inc(container_name, "stdout", amount=out_bytes)
+    metrics.OUTPUT_BYTES.inc(container_name, "stderr", amount=err_bytes)
+    logger.info("{}: exec {} exited with code {} after {:.3f}s ({:.3f}s waiting for completion)"
+        .format(container_name, id[:12], inspect["ExitCode"], finished - started, finished - closed))
+    return inspect["ExitCode"]
+
+async def wait_for_exit(client, id):
+    """Waits for an exec to finish, see exec.wait_for_exit"""
+    delay = exec.POLL_MIN
+    inspect = await client.exec_inspect(id)
+    while inspect["Running"]:
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, exec.POLL_MAX)
+        inspect = await client.exec_inspect(id)
+    return inspect
+
+async def read_result(reader, stdout=None, stderr=None):
+    """Reads multiplexed stdout+stderr from an exec stream and writes it to stdout and
+    stderr (sys.stdout and sys.stderr by default).
+
+    Whatever is available is read at once and split into frames, and the output of a
+    read is flushed before waiting for the next one.
+
+    Returns:
+        int: Bytes of stdout relayed
+        int: Bytes of stderr relayed
+    """
+    relays = {1: exec.Relay(stdout or sys.stdout.buffer), 2: exec.Relay(stderr or sys.stderr.buffer)}
+    buf = bytearray()
+    remaining = 0       # Bytes left in the current frame
+    relay = None
+    try:
+        while True:
+            data = await reader.read(exec.BUFFER_SIZE)
+            if not data:
+                return relays[1].count, relays[2].count
+
+            if remaining >= len(data):
+                relay.write(data)
+                remaining -= len(data)
+            else:
+                buf += data
+                start = 0
+                while start < len(buf):
+                    if remaining > 0:
+                        take = min(remaining, len(buf) - start)
+                        relay.write(buf[start:start + take])
+                        start += take
+                        remaining -= take
+                        continue
+
+                    if len(buf) - start < 8:
+                        break
+                    stream, remaining = struct.unpack_from(">BxxxL", buf, start)
+                    start += 8
+                    if remaining <= 0:
+                        return relays[1].count, relays[2].count
+                    relay = relays[2 if stream == 2 else 1]
+                del buf[:start]
+
+            for r in relays.values():
+                r.flush()
+    finally:
+        for r in relays.values():
+            r.flush()
+
+async def write_stdin(writer, data):
+    """Writes data to the exec stream in chunks and then closes its write side.
+
+    Args:
+        writer (asyncio.StreamWriter): The exec stream
+        data (str/bytes/file): Text, bytes or a binary file to copy
+    """
+    try:
+        if isinstance(data, str):
+            for i in range(0, len(data), exec.STDIN_CHUNK):
+                writer.write(data[i:i + exec.STDIN_CHUNK].encode("utf-8"))
+                await writer.drain()
+        elif isinstance(data, (bytes, bytearray)):
+            view = memoryview(data)
+            for i in range(0, len(view), exec.STDIN_CHUNK):
+                writer.write(view[i:i + exec.STDIN_CHUNK])
+                await writer.drain()
+        else:
+            while True:
+                chunk = data.read(exec.STDIN_CHUNK)
+                if not chunk:
+                    break
+                writer.write(chunk)
+                await writer.drain()
+        if writer.can_write_eof():
+            writer.write_eof()
+    except OSError as e:
+        logger.debug("Process stopped reading stdin: {}".format(e))
+
+async def run_all(client, execs, limit=None):
+    """Runs many execs on the current event loop.
+
+    Args:
+        client (AsyncClient): Docker client
+        execs (list): Arguments to docker_exec after the client, for each exec
+        limit (int): Maximum number of execs in flight at once, or None for no limit
+
+    Returns:
+        list: The exit code of each exec, or the exception it raised
+    """
+    semaphore = asyncio.Semaphore(limit) if limit else None
+
+    async def run(args):
+        if semaphore is None:
+            return await docker_exec(client, *args)
+        async with semaphore:
+            return await docker_exec(client, *args)
+
+    return await asyncio.gather(*(run(args) for args in execs), return_exceptions=True)
@@ -0,0 +1,555 @@
+#!/usr/bin/python3
+# This file is part of docker-gen-cron
+# Copyright (C) 2020 John J. Jordan
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+
+# Benchmarks that run without docker.  A stand-in for the Docker Engine API is
+# served on a Unix socket, with just enough of the API for runjob: container
+# inspect/start/restart and exec create/start/inspect, streaming output in the
+# multiplexed format exec.read_result parses.
+#
+#   bench.py exec     - exec.docker_exec on a shared client
+#   bench.py aioexec  - aioexec.docker_exec, every fire on one event loop
+#   bench.py runjob   - runjob.main, as a fire that isn't handled by the dispatcher
+#   bench.py reload   - parsing and generating the crontab for synthetic jobs.json
+#                       files of increasing size, with fcrontab stubbed out
+#
+# Run bench.py -h for the options.
+
+import argparse
+import asyncio
+import concurrent.futures
+import contextlib
+import http.server
+import io
+import itertools
+import json
+import logging
+import math
+import os
+import random
+import re
+import socketserver
+import struct
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.parse
+
+import aioexec
+import dockerapi
+import exec
+import history
+import jobindex
+import logconfig
+import parser
+import reload
+import runjob
+
+logger = logging.getLogger("bench")
+
+FRAME_SIZE = 16384
+
+class FakeDocker(socketserver.ThreadingUnixStreamServer):
+    """
+    FakeDocker serves a stand-in for the Docker Engine API on a Unix socket.
+
+    Args:
+        path (str): Socket path
+        containers (dict): Map of container name to its environment (list of "K=V")
+        output_size (int): Bytes of stdout each exec produces
+        stderr_size (int): Bytes of stderr each exec produces
+        delay (float): Seconds each exec runs for before producing output
+    """
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, path, containers, output_size=0, stderr_size=0, delay=0.0):
+        super().__init__(path, FakeDockerHandler)
+        self.containers = containers
+        self.output_size = output_size
+        self.stderr_size = stderr_size
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.execs = {}
+        self.ids = itertools.count()
+        self.requests = 0
+
+    def inspect(self, name):
+        """Returns the inspect output of a container, or None if it doesn't exist"""
+        env = self.containers.get(name)
+        if env is None:
+            return None
+        return {
+            "Id": container_id(name),
+            "Name": "/" + name,
+            "State": {"Status": "running", "Running": True},
+            "Config": {"Env": env},
+        }
+
+    def serve(self):
+        """Serves on a background thread"""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+class FakeDockerHandler(http.server.BaseHTTPRequestHandler):
+    """Handles a connection to FakeDocker"""
+    protocol_version = "HTTP/1.1"
+
+    routes = [
+        ("GET", re.compile(r"/containers/json"), "containers"),
+        ("GET", re.compile(r"/containers/([^/]+)/json"), "inspect"),
+        ("POST", re.compile(r"/containers/([^/]+)/(?:start|restart)"), "start"),
+        ("POST", re.compile(r"/containers/([^/]+)/exec"), "exec_create"),
+        ("POST", re.compile(r"/exec/([^/]+)/start"), "exec_start"),
+        ("GET", re.compile(r"/exec/([^/]+)/json"), "exec_inspect"),
+    ]
+
+    def do_GET(self):
+        self.route("GET")
+
+    def do_POST(self):
+        self.route("POST")
+
+    def route(self, method):
+        with self.server.lock:
+            self.server.requests += 1
+        path = re.sub(r"^/v[0-9.]+", "", self.path.split("?")[0])
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length)) if length > 0 else None
+        for m, pattern, name in self.routes:
+            match = pattern.fullmatch(path)
+            if m == method and match is not None:
+                return getattr(self, name)(body, *match.groups())
+        self.reply(404, {"message": "page not found"})
+
+    def containers(self, body):
+        self.reply(200, [{"Id": container_id(name), "Names": ["/" + name]} for name in self.server.containers])
+
+    def inspect(self, body, name):
+        inspect = self.server.inspect(urllib.parse.unquote(name))
+        if inspect is None:
+            return self.reply(404, {"message": "No such container: " + name})
+        self.reply(200, inspect)
+
+    def start(self, body, name):
+        self.reply(204)
+
+    def exec_create(self, body, name):
+        with self.server.lock:
+            id = "{:064x}".format(next(self.server.ids))
+            self.server.execs[id] = {"Running": True, "ExitCode": None, "stdin": body.get("AttachStdin")}
+        self.reply(201, {"Id": id})
+
+    def exec_start(self, body, id):
+        with self.server.lock:
+            ex = self.server.execs.get(id)
+        if ex is None:
+            return self.reply(404, {"message": "No such exec instance: " + id})
+
+        self.send_response(101, "UPGRADED")
+        self.send_header("Content-Type", "application/vnd.docker.raw-stream")
+        self.send_header("Connection", "Upgrade")
+        self.send_header("Upgrade", "tcp")
+        self.end_headers()
+
+        reader = None
+        if ex["stdin"]:
+            reader = threading.Thread(target=drain, args=(self.rfile,), daemon=True)
+            reader.start()
+        if self.server.delay > 0:
+            time.sleep(self.server.delay)
+        try:
+            write_frames(self.wfile, 1, self.server.output_size)
+            write_frames(self.wfile, 2, self.server.stderr_size)
+            if reader is not None:
+                reader.join()
+        except OSError:
+            pass
+
+        with self.server.lock:
+            ex["Running"] = False
+            ex["ExitCode"] = 0
+        self.close_connection = True
+
+    def exec_inspect(self, body, id):
+        with self.server.lock:
+            ex = self.server.execs.get(id)
+            if ex is not None and not ex["Running"]:
+                del self.server.execs[id]
+        if ex is None:
+            return self.reply(404, {"message": "No such exec instance: " + id})
+        self.reply(200, {"ID": id, "Running": ex["Running"], "ExitCode": ex["ExitCode"]})
+
+    def reply(self, status, body=None):
+        data = json.dumps(body).encode("utf-8") if body is not None else b""
+        self.send_response(status)
+        if body is not None:
+            self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+def container_id(name):
+    """Returns a stable fake id for a container name"""
+    return "{:0>64}".format(name.encode("utf-8").hex()[-64:])
+
+def write_frames(out, stream, size):
+    """Writes size bytes of output as frames of FRAME_SIZE"""
+    data = b"x" * min(size, FRAME_SIZE)
+    while size > 0:
+        n = min(size, FRAME_SIZE)
+        out.write(struct.pack(">BxxxL", stream, n) + data[:n])
+        size -= n
+
+def drain(f):
+    """Reads f until end of file"""
+    try:
+        while f.read(65536):
+            pass
+    except OSError:
+        pass
+
+def make_jobs_json(containers, jobs, input_size=0):
+    """Generates jobs.json with jobs that each container runs every minute.
+
+    Args:
+        containers (int): Number of containers
+        jobs (int): Number of jobs per container
+        input_size (int): Bytes of % input for each job
+
+    Returns:
+        dict: Parsed jobs.json
+        dict: Map of container name to its environment, for FakeDocker
+    """
+    suffix = "%" + "i" * input_size if input_size > 0 else ""
+    j = {"containers": [], "env": {}}
+    envs = {}
+    for c in range(containers):
+        name = "bench{}".format(c)
+        kvs = [(str(i), "* * * * * echo job {} {}{}".format(c, i, suffix)) for i in range(jobs)]
+        j["containers"].append({"name": name, "running": True, "envs": [{"key": k, "cmd": v} for k, v in kvs]})
+        envs[name] = ["CRON_{}={}".format(k, v) for k, v in kvs]
+    return j, envs
+
+@contextlib.contextmanager
+def environment(containers, jobs, output_size=0, stderr_size=0, input_size=0, delay=0.0):
+    """Sets up jobs.json, the job index and FakeDocker in a temporary directory, and points
+    runjob at them.
+
+    Yields:
+        FakeDocker: The server
+        list: (container, job id) of each job
+    """
+    j, envs = make_jobs_json(containers, jobs, input_size)
+    saved = (parser.JOB_FILE, jobindex.INDEX_FILE, history.HISTORY_FILE, os.environ.get("DOCKER_HOST"))
+    with tempfile.TemporaryDirectory() as d:
+        parser.JOB_FILE = os.path.join(d, "jobs.json")
+        jobindex.INDEX_FILE = os.path.join(d, "jobs.idx")
+        history.HISTORY_FILE = os.path.join(d, "history.db")
+        sock = os.path.join(d, "docker.sock")
+        os.environ["DOCKER_HOST"] = "unix://" + sock
+        server = FakeDocker(sock, envs, output_size, stderr_size, delay).serve()
+        try:
+            with open(parser.JOB_FILE, "w") as f:
+                json.dump(j, f)
+            index = jobindex.build(parser.parse_crontab_json(j))
+            jobindex.write(index)
+            fires = [(name, id) for name, entries in sorted(index.containers.items()) for id in entries]
+            yield server, fires
+        finally:
+            server.shutdown()
+            server.server_close()
+            parser.JOB_FILE, jobindex.INDEX_FILE, history.HISTORY_FILE = saved[:3]
+            if saved[3] is None:
+                del os.environ["DOCKER_HOST"]
+            else:
+                os.environ["DOCKER_HOST"] = saved[3]
+
+def run(fire, fires, concurrency):
+    """Runs fire(container, jobid) for each of fires on a thread pool.
+
+    Returns:
+        list: Latency of each fire, in seconds
+        float: Total elapsed time
+        int: Number of fires that failed
+    """
+    def timed(args):
+        started = time.monotonic()
+        ok = fire(*args)
+        return time.monotonic() - started, ok
+
+    started = time.monotonic()
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as pool:
+        results = list(pool.map(timed, fires))
+    elapsed = time.monotonic() - started
+    return [r[0] for r in results], elapsed, sum(1 for r in results if r[1] != 0)
+
+def bench_exec(args):
+    """Runs each job through exec.docker_exec with a shared client"""
+    with environment(args.containers, args.jobs, args.output, args.stderr, args.input, args.delay) as (server, fires):
+        client = dockerapi.Client(pool_size=args.concurrency)
+        cfg = jobindex.load()
+        devnull = open(os.devnull, "wb")
+        def fire(name, id):
+            jobcfg = cfg.find(name, id)
+            return exec.docker_exec(client, name, runjob.get_command(jobcfg, {}), jobcfg.job.input, devnull, devnull)
+        try:
+            return run(fire, fires * args.rounds, args.concurrency) + (server.requests,)
+        finally:
+            devnull.close()
+            client.close()
+
+def bench_aioexec(args):
+    """Runs each job through aioexec.docker_exec, with one task per fire on one event loop"""
+    with environment(args.containers, args.jobs, args.output, args.stderr, args.input, args.delay) as (server, fires):
+        cfg = jobindex.load()
+
+        async def main(devnull):
+            client = aioexec.AsyncClient(pool_size=args.concurrency)
+            semaphore = asyncio.Semaphore(args.concurrency)
+
+            async def fire(name, id):
+                async with semaphore:
+                    started = time.monotonic()
+                    jobcfg = cfg.find(name, id)
+                    try:
+                        code = await aioexec.docker_exec(client, name, runjob.get_command(jobcfg, {}), jobcfg.job.input, devnull, devnull)
+                    except Exception:
+                        logger.exception("Fire failed")
+                        code = -1
+                    return time.monotonic() - started, code
+
+            started = time.monotonic()
+            try:
+                results = await asyncio.gather(*(fire(*f) for f in fires * args.rounds))
+            finally:
+                await client.close()
+            return [r[0] for r in results], time.monotonic() - started, sum(1 for r in results if r[1] != 0)
+
+        with open(os.devnull, "wb") as devnull:
+            return asyncio.run(main(devnull)) + (server.requests,)
+
+def bench_runjob(args):
+    """Runs each job through runjob.main, as /opt/bin/runjob does without the dispatcher"""
+    with environment(args.containers, args.jobs, args.output, args.stderr, args.input, args.delay) as (server, fires):
+        # Job output goes to sys.stdout/sys.stderr, log output still goes to the console
+        saved = sys.stdout, sys.stderr
+        sys.stdout = sys.stderr = io.TextIOWrapper(open(os.devnull, "wb"))
+        try:
+            return run(lambda name, id: runjob.exit_code(runjob.main(name, "job", id)),
+                fires * args.rounds, args.concurrency) + (server.requests,)
+        finally:
+            sys.stdout.close()
+            sys.stdout, sys.stderr = saved
+
+# Line types for make_crontab_json, covering the kinds of lines in test_cases.yml
+CRONTAB_LINES = [
+    "*/5 * * * * touch /tmp/minutely",
+    "&runas(irc),mailto(a@b.c) 0 */2 * * * echo hello world",
+    "VAR{i} = \"value {i}\"",
+    "!mailto(root),erroronlymail(true)",
+    "@daily backup.sh --fast",
+    "%hourly 15 report.sh %line 1%line 2",
+    "%daily 30 4 nightly.sh",
+    "@reset 1d cleanup.sh \\%escaped",
+    "&nice(10),stdin(input.txt) 15 3 * * 1-5 import.sh",
+    "!reset",
+    "SHELL=/bin/bash",
+    "# A comment",
+]
+
+def make_crontab_json(count, seed=0):
+    """Makes a synthetic jobs.json with the specified number of containers.  Each container
+    gets a random selection of CRONTAB_LINES and start/restart jobs, the same selection
+    for the same seed.
+
+    Returns:
+        dict: Parsed jobs.json
+    """
+    rng = random.Random(seed)
+    containers = []
+    for i in range(count):
+        lines = rng.sample(CRONTAB_LINES, rng.randint(1, len(CRONTAB_LINES)))
+        envs = [{"key": str(k), "cmd": line.format(i=i)} for k, line in enumerate(lines)]
+        if rng.random() < 0.5:
+            envs.append({"key": "START_0", "cmd": "@daily"})
+        if rng.random() < 0.3:
+            envs.append({"key": "RESTART_0", "cmd": "0 4 * * *"})
+        containers.append({"name": "container_{}".format(i), "running": rng.random() < 0.9, "envs": envs + [None]})
+    return {"containers": containers + [None], "env": {}}
+
+def crontab_lines(j):
+    """Returns the number of crontab entries in jobs.json"""
+    return sum(len(parser.container_envs(c)) for c in j["containers"] if c is not None)
+
+@contextlib.contextmanager
+def stub_install():
+    """Replaces reload.install_crontab with a stub and writes the job index to a temporary
+    directory.
+
+    Yields:
+        list: Each crontab "installed"
+    """
+    installed = []
+    def install(crontab, lirefs):
+        installed.append(crontab)
+        return True
+
+    saved = reload.install_crontab, jobindex.INDEX_FILE
+    with tempfile.TemporaryDirectory() as d:
+        reload.install_crontab = install
+        jobindex.INDEX_FILE = os.path.join(d, "jobs.idx")
+        try:
+            yield installed
+        finally:
+            reload.install_crontab, jobindex.INDEX_FILE = saved
+
+def timed(fn, *args):
+    """Returns the result of fn and the time it took"""
+    started = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - started
+
+def traced(fn, *args):
+    """Returns the peak memory allocated while running fn, and the memory and number of
+    blocks held by its result"""
+    tracemalloc.start()
+    try:
+        result = fn(*args)
+        retained, peak = tracemalloc.get_traced_memory()
+        blocks = sum(stat.count for stat in tracemalloc.take_snapshot().statistics("filename"))
+        del result
+    finally:
+        tracemalloc.stop()
+    return peak, retained, blocks
+
+def bench_reload(args):
+    """Times parsing and generating the crontab, and full reloads with fcrontab stubbed out,
+    for each of args.sizes.
+
+    Returns:
+        list: A dict of results for each size
+    """
+    results = []
+    for size in args.sizes:
+        j = make_crontab_json(size, args.seed)
+        r = {"containers": size, "lines": crontab_lines(j)}
+
+        cfg, r["parse"] = timed(parser.parse_crontab_json, j)
+        (crontab, _), r["generate"] = timed(reload.generate_crontab, cfg)
+        r["output_lines"] = len(crontab)
+        r["output_bytes"] = len("\n".join(crontab)) + 1
+        r["peak"], r["retained"], r["blocks"] = traced(lambda: reload.generate_crontab(parser.parse_crontab_json(j)))
+
+        with stub_install() as installed:
+            reloader = reload.Reloader(None)
+            _, r["cold"] = timed(reloader.reload, j)
+            _, r["unchanged"] = timed(reloader.reload, j)
+
+            # Change 1% of containers
+            for c in j["containers"][:max(1, size // 100)]:
+                c["running"] = not c["running"]
+            _, r["incremental"] = timed(reloader.reload, j)
+            r["installs"] = len(installed)
+            r["index_bytes"] = sum(e.stat().st_size for e in os.scandir(jobindex.INDEX_FILE))
+        results.append(r)
+    return results
+
+BENCHMARKS = {
+    "exec": bench_exec,
+    "aioexec": bench_aioexec,
+    "runjob": bench_runjob,
+    "reload": bench_reload,
+}
+
+def percentile(values, p):
+    """Returns the p-th percentile (nearest rank) of values"""
+    values = sorted(values)
+    if len(values) == 0:
+        return 0.0
+    k = max(1, math.ceil(p / 100.0 * len(values)))
+    return values[k - 1]
+
+def report(name, args, latencies, elapsed, failed, requests):
+    """Formats the results of a benchmark"""
+    count = len(latencies)
+    return ("{name}: {count} fires ({containers} containers x {jobs} jobs x {rounds} rounds, {concurrency} at once, "
+            "{output} bytes output)\n"
+            "  p50 {p50:.2f}ms  p99 {p99:.2f}ms  max {max:.2f}ms\n"
+            "  {rate:.1f} fires/s, {mbps:.1f} MiB/s output, {requests} API calls, {failed} failed").format(
+        name=name, count=count, containers=args.containers, jobs=args.jobs, rounds=args.rounds,
+        concurrency=args.concurrency, output=args.output,
+        p50=percentile(latencies, 50) * 1000, p99=percentile(latencies, 99) * 1000,
+        max=max(latencies, default=0) * 1000, rate=count / elapsed if elapsed > 0 else 0,
+        mbps=count * (args.output + args.stderr) / elapsed / (1 << 20) if elapsed > 0 else 0,
+        requests=requests, failed=failed)
+
+def report_reload(results):
+    """Formats the results of the reload benchmark"""
+    lines = ["reload: parse and generate, then full reloads (cold, unchanged, 1% changed) with fcrontab stubbed"]
+    lines.append("  {:>10} {:>10} {:>9} {:>9} {:>12} {:>9} {:>9} {:>10} {:>9} {:>9} {:>9} {:>10} {:>10}".format(
+        "containers", "lines", "parse", "generate", "lines/s", "peak MiB", "held MiB", "blocks", "cold", "unchanged", "1%",
+        "output KiB", "index KiB"))
+    for r in results:
+        lines.append("  {:>10} {:>10} {:>8.3f}s {:>8.3f}s {:>12.0f} {:>9.1f} {:>9.1f} {:>10} {:>8.3f}s {:>8.3f}s {:>8.3f}s {:>10.0f} {:>10.0f}".format(
+            r["containers"], r["lines"], r["parse"], r["generate"], r["lines"] / (r["parse"] + r["generate"]),
+            r["peak"] / (1 << 20), r["retained"] / (1 << 20), r["blocks"], r["cold"], r["unchanged"], r["incremental"],
+            r["output_bytes"] / 1024, r["index_bytes"] / 1024))
+    return "\n".join(lines)
+
+def sizes(s):
+    """Parses a comma separated list of sizes for argparse"""
+    return [int(x) for x in s.split(",") if x]
+
+def make_arg_parser():
+    p = argparse.ArgumentParser(description="docker-gen-cron benchmarks")
+    p.add_argument("benchmark", nargs="*", help="Benchmarks to run: {} (default: all)".format(", ".join(sorted(BENCHMARKS))))
+    p.add_argument("-c", "--containers", type=int, default=10, help="Number of containers")
+    p.add_argument("-j", "--jobs", type=int, default=10, help="Jobs per container")
+    p.add_argument("-r", "--rounds", type=int, default=1, help="Times to fire each job")
+    p.add_argument("-n", "--concurrency", type=int, default=8, help="Fires running at once")
+    p.add_argument("-o", "--output", type=int, default=1024, help="Bytes of stdout per exec")
+    p.add_argument("-e", "--stderr", type=int, default=0, help="Bytes of stderr per exec")
+    p.add_argument("-i", "--input", type=int, default=0, help="Bytes of stdin per exec")
+    p.add_argument("-d", "--delay", type=float, default=0.0, help="Seconds each exec runs for")
+    p.add_argument("-s", "--sizes", type=sizes, default=[1000, 10000], help="Numbers of containers for reload, e.g. 1000,10000,50000")
+    p.add_argument("--seed", type=int, default=0, help="Random seed for generated containers")
+    return p
+
+def main(argv):
+    p = make_arg_parser()
+    args = p.parse_args(argv)
+    for name in args.benchmark:
+        if name not in BENCHMARKS:
+            p.error("unknown benchmark: {}".format(name))
+
+    logging.getLogger().setLevel(logging.WARNING)
+    for name in args.benchmark or sorted(BENCHMARKS):
+        if name == "reload":
+            print(report_reload(bench_reload(args)))
+        else:
+            print(report(name, args, *BENCHMARKS[name](args)))
+    return True
+
+if __name__ == "__main__":
+    logconfig.setDefault()
+    sys.exit(0 if main(sys.argv[1:]) else 1)
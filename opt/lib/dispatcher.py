@@ -0,0 +1,409 @@
+#!/usr/bin/python3
+# This file is part of docker-gen-cron
+# Copyright (C) 2020 John J. Jordan
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+
+# Long-lived job dispatcher.  fcron execs /opt/bin/runjob for every job, which
+# connects here over a Unix socket instead of starting a Python interpreter.
+#
+# Request: NUL-terminated strings: argument count, the arguments runjob was
+# invoked with, then its environment.  The client shuts down its write side
+# when finished.
+#
+# Response: frames in the same format as the docker attach stream (an 8 byte
+# header: stream byte, 3 bytes padding, big-endian 32-bit length) for stdout
+# (1) and stderr (2), followed by a single exit frame (3) holding a
+# big-endian 32-bit exit code.
+#
+# reload.py sends the single argument --reload instead, which queues a reload
+# with the dispatcher's reload scheduler and returns at once.
+
+import collections
+import contextlib
+import contextvars
+import logging
+import os
+import socket
+import socketserver
+import struct
+import sys
+import threading
+import time
+
+import jobindex
+import metrics
+import parser
+import logconfig
+import reload
+import runjob
+import statecache
+
+logger = logging.getLogger("dispatcher")
+
+SOCKET_PATH = "/var/run/docker-gen-cron.sock"
+MAX_REQUEST = 1024 * 1024
+RELOAD = "--reload"
+
+STDOUT = 1
+STDERR = 2
+EXIT = 3
+
+# The stderr of the client whose request is being served, see ClientLogHandler
+_client = contextvars.ContextVar("client", default=None)
+
+def main():
+    for h in logging.getLogger().handlers:
+        h.addFilter(_not_serving)
+    handler = ClientLogHandler()
+    handler.setFormatter(logconfig.formatter())
+    logging.getLogger().addHandler(handler)
+
+    if os.path.exists(SOCKET_PATH):
+        os.unlink(SOCKET_PATH)
+
+    server = Server(SOCKET_PATH)
+    os.chmod(SOCKET_PATH, 0o600)
+    threading.Thread(target=server.client.follow_events, daemon=True).start()
+    start_reloads(server, os.environ)
+
+    if os.environ.get("DOCKER_GEN_CRON_METRICS"):
+        register_metrics(server, server.scheduler)
+        metrics.serve(os.environ["DOCKER_GEN_CRON_METRICS"])
+
+    logger.info("Listening on {}".format(SOCKET_PATH))
+    server.serve_forever()
+    return True
+
+def start_reloads(server, env):
+    """Starts running the server's reloads, on the built-in watcher if it's enabled"""
+    if env.get("DOCKER_GEN_CRON_WATCHER"):
+        # Follow docker events in-process, in place of docker-gen.  Reload requests go to
+        # the watcher's scheduler, where they resync every container.
+        import watcher
+        w = watcher.Watcher(server.client, server.reloader)
+        server.scheduler = w.scheduler
+        threading.Thread(target=w.run, daemon=True).start()
+    else:
+        threading.Thread(target=server.scheduler.run, daemon=True).start()
+
+def register_metrics(server, scheduler):
+    """Registers metrics read from the state of the dispatcher"""
+    for key, type, help in [
+            ("events", "counter", "Reload requests and container events received"),
+            ("coalesced", "counter", "Reload requests and events merged into another reload"),
+            ("reloads", "counter", "Reloads run by the scheduler"),
+            ("apply_seconds", "counter", "Total time from the first change of each reload until it was applied"),
+            ("last_apply_seconds", "gauge", "Time from the first change of the last reload until it was applied")]:
+        metrics.callback("docker_gen_cron_scheduler_{}".format(key if type == "gauge" else key + "_total"),
+            help, type, lambda key=key: scheduler.stats()[key])
+    metrics.callback("docker_gen_cron_running_jobs", "Dispatches holding a slot", "gauge",
+        lambda: server.limiter.running)
+    metrics.callback("docker_gen_cron_queued_jobs", "Dispatches waiting for a slot", "gauge",
+        lambda: len(server.limiter.queue))
+
+class Server(socketserver.ThreadingUnixStreamServer):
+    """
+    Server accepts runjob requests and runs them against a shared docker client
+    (which caches container states) and a cached copy of the job index.  It also runs the reloads requested by
+    reload.py, coalescing bursts of them.
+    """
+    daemon_threads = True
+
+    def __init__(self, path):
+        super().__init__(path, Handler)
+        self.client = statecache.CachingClient()
+        self.limiter = Limiter()
+        self.lock = threading.Lock()
+        self.cfg = None
+        self.cfg_key = None
+        self.reloader = reload.Reloader()
+        self.scheduler = reload.Scheduler(self.reload)
+
+    def config(self):
+        """Returns the job index (or parsed crontab if there is no index), reloading it
+        when it has changed on disk"""
+        key = (stat_key(jobindex.INDEX_FILE), stat_key(parser.JOB_FILE))
+        with self.lock:
+            if key != self.cfg_key:
+                self.cfg = runjob.load_config()
+                self.cfg_key = key
+                logconfig.setLevel(self.cfg)
+                self.limiter.configure(
+                    parser.setting_int(self.cfg.environment, "DOCKER_GEN_CRON_MAX_CONCURRENT"),
+                    parser.setting_int(self.cfg.environment, "DOCKER_GEN_CRON_MAX_PER_CONTAINER"))
+                self.client.states.ttl = parser.setting_int(self.cfg.environment, "DOCKER_GEN_CRON_STATE_TTL", statecache.DEFAULT_TTL)
+                logger.debug("Loaded {}".format(type(self.cfg).__name__))
+            return self.cfg
+
+    def run(self, args, env, stdout, stderr):
+        """Runs a single runjob request.
+
+        Args:
+            args (list): Arguments runjob was invoked with
+            env (dict): Environment runjob was invoked with
+            stdout (file): Binary stream for job stdout
+            stderr (file): Binary stream for job stderr
+
+        Returns:
+            bool/int: Whether the operation succeeds, and if so the exit code of the job.
+        """
+        if args == [RELOAD]:
+            self.scheduler.notify()
+            return True
+
+        args = runjob.parse_args(args)
+        if len(args) not in (2, 3):
+            logger.error("Invalid arguments: {}".format(repr(args)))
+            return False
+
+        if not runjob.wait_for_jobs():
+            logger.critical("Cannot load jobs file, aborting")
+            return False
+
+        cfg = self.config()
+        delay = runjob.jitter(cfg, *args)
+        if delay > 0:
+            logger.debug("Delaying {:.3f}s for jitter".format(delay))
+            time.sleep(delay)
+
+        return runjob.dispatch(self.client, cfg, *args, env=env, stdout=stdout, stderr=stderr, slot=self.limiter.slot)
+
+    def reload(self, keys):
+        """Reloads the crontab from jobs.json, called by the scheduler"""
+        self.reloader.reload(parser.load_crontab_json())
+
+class Limiter:
+    """
+    Limiter caps the number of dispatches running at once, overall and per container
+    (0 means unlimited).  Dispatches over the limit wait in a FIFO queue.  When a slot
+    frees up, the oldest waiter that fits within both limits goes next, so one busy
+    container can't hold up the others.
+    """
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.queue = collections.deque()
+        self.running = 0
+        self.per_container = collections.Counter()
+        self.max_total = 0
+        self.max_per_container = 0
+
+    def configure(self, max_total, max_per_container):
+        """Updates the limits"""
+        with self.cond:
+            if (max_total, max_per_container) != (self.max_total, self.max_per_container):
+                logger.info("Concurrency limits: {} total, {} per container".format(max_total or "unlimited", max_per_container or "unlimited"))
+            self.max_total = max_total
+            self.max_per_container = max_per_container
+            self.cond.notify_all()
+
+    @contextlib.contextmanager
+    def slot(self, container_name):
+        """Context manager that waits for and holds a slot for container_name"""
+        ticket = [container_name]
+        with self.cond:
+            self.queue.append(ticket)
+            try:
+                if not self._next(ticket):
+                    logger.debug("Waiting for a slot for {} ({} queued)".format(container_name, len(self.queue)))
+                    while not self._next(ticket):
+                        self.cond.wait()
+            finally:
+                self.queue.remove(ticket)
+                # Whoever was queued behind this ticket may be next now
+                self.cond.notify_all()
+            self.running += 1
+            self.per_container[container_name] += 1
+
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.running -= 1
+                self.per_container[container_name] -= 1
+                if self.per_container[container_name] <= 0:
+                    del self.per_container[container_name]
+                self.cond.notify_all()
+
+    def _fits(self, container_name):
+        if self.max_total > 0 and self.running >= self.max_total:
+            return False
+        if self.max_per_container > 0 and self.per_container[container_name] >= self.max_per_container:
+            return False
+        return True
+
+    def _next(self, ticket):
+        """Returns whether ticket is the oldest queued ticket that fits"""
+        for t in self.queue:
+            if self._fits(t[0]):
+                return t is ticket
+        return False
+
+class Handler(socketserver.BaseRequestHandler):
+    """Handles a single connection from runjob"""
+
+    def handle(self):
+        try:
+            args, env = read_request(self.request)
+        except ValueError as e:
+            logger.error("Bad request: {}".format(e))
+            return
+
+        lock = threading.Lock()
+        stdout = FrameWriter(self.request, STDOUT, lock)
+        stderr = FrameWriter(self.request, STDERR, lock)
+        token = _client.set(stderr)
+        try:
+            res = self.server.run(args, env, stdout, stderr)
+        except:
+            logger.exception("Unexpected exception running {}".format(repr(args)))
+            res = False
+        finally:
+            # Threads that copied the context may outlive the request, their records go
+            # to the console from now on
+            stderr.closed = True
+            _client.reset(token)
+
+        try:
+            with lock:
+                self.request.sendall(struct.pack(">BxxxLl", EXIT, 4, runjob.exit_code(res)))
+        except OSError:
+            logger.warning("Client went away before job {} finished".format(repr(args)))
+
+def stat_key(path):
+    """Returns a value that changes whenever the file at path is replaced or modified"""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+def request_reload():
+    """Asks a running dispatcher to reload the crontab.
+
+    Returns:
+        bool: Whether the reload was queued, False if there is no dispatcher
+    """
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(10)
+            sock.connect(SOCKET_PATH)
+            sock.sendall("1\0{}\0".format(RELOAD).encode("utf-8"))
+            sock.shutdown(socket.SHUT_WR)
+            data = bytearray()
+            while True:
+                chunk = sock.recv(4096)
+                if not chunk:
+                    break
+                data += chunk
+    except OSError:
+        return False
+
+    # Skip over any log output to the exit frame
+    pos = 0
+    while pos + 8 <= len(data):
+        stream, length = struct.unpack_from(">BxxxL", data, pos)
+        pos += 8
+        if stream == EXIT and length == 4 and pos + 4 <= len(data):
+            return struct.unpack_from(">l", data, pos)[0] == 0
+        pos += length
+    return False
+
+def read_request(sock):
+    """Reads a request from the client socket.
+
+    Returns:
+        list: Arguments
+        dict: Environment
+    """
+    data = bytearray()
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            break
+        data += chunk
+        if len(data) > MAX_REQUEST:
+            raise ValueError("request too large")
+
+    parts = data.decode("utf-8", "surrogateescape").split("\0")
+    if len(parts) < 2 or parts[-1] != "" or not parser.is_int(parts[0]):
+        raise ValueError("malformed request")
+    argc = int(parts[0])
+    if argc < 0 or argc > len(parts) - 2:
+        raise ValueError("malformed request")
+
+    args = parts[1:argc + 1]
+    env = {}
+    for e in parts[argc + 1:-1]:
+        k, sep, v = e.partition("=")
+        if sep:
+            env[k] = v
+    return args, env
+
+class FrameWriter:
+    """
+    FrameWriter is a binary stream that sends everything written to it to the
+    client as frames of a single stream.
+
+    Attributes:
+        closed (bool): Whether the request is done, and log records no longer go to the client
+    """
+    def __init__(self, sock, stream, lock):
+        self.sock = sock
+        self.stream = stream
+        self.lock = lock
+        self.closed = False
+
+    def write(self, data):
+        if len(data) == 0:
+            return 0
+        with self.lock:
+            self.sock.sendall(struct.pack(">BxxxL", self.stream, len(data)))
+            self.sock.sendall(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+class ClientLogHandler(logging.Handler):
+    """Sends log records emitted while serving a request to that request's client.  The
+    client is found in the context, so records of other threads working on the request
+    reach it too if they run in a copy of it (see logconfig.in_context)."""
+
+    def emit(self, record):
+        stderr = client_stderr()
+        if stderr is None:
+            return
+        try:
+            stderr.write((self.format(record) + "\n").encode("utf-8"))
+        except OSError:
+            pass
+        except:
+            self.handleError(record)
+
+def _not_serving(record):
+    """Log filter that drops records which are delivered to a client instead"""
+    return client_stderr() is None
+
+def client_stderr():
+    """Returns the stderr of the client whose request is being served, or None"""
+    stderr = _client.get()
+    if stderr is None or stderr.closed:
+        return None
+    return stderr
+
+if __name__ == "__main__":
+    logconfig.setDefault()
+    sys.exit(0 if main() else 1)
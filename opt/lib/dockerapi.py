@@ -0,0 +1,538 @@
+# This file is part of docker-gen-cron
+# Copyright (C) 2020 John J. Jordan
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+
+import json
+import os
+import select
+import socket
+import threading
+import urllib.parse
+
+DEFAULT_HOST = "unix:///var/run/docker.sock"
+
+# Variables that configure TLS for the docker CLI and SDK, which Client doesn't support
+TLS_VARS = ("DOCKER_TLS_VERIFY", "DOCKER_CERT_PATH", "DOCKER_TLS")
+MAX_HEADERS = 65536
+
+class APIError(Exception):
+    """
+    APIError is raised when the docker daemon responds with an error.
+
+    Attributes:
+        status (int): HTTP status code
+        explanation (str): Error message from the daemon
+    """
+    def __init__(self, status, explanation):
+        super().__init__("{} {}".format(status, explanation))
+        self.status = status
+        self.explanation = explanation
+
+class NotFound(APIError):
+    """NotFound is raised when the container or exec doesn't exist"""
+
+class ConnectionClosed(ConnectionError):
+    """ConnectionClosed is raised when the daemon closes the connection before responding"""
+
+class ContainerState:
+    """
+    ContainerState holds the handful of fields needed to act on a container.
+
+    Attributes:
+        id (str): Container id
+        name (str): Container name
+        status (str): Container status, e.g. "running" or "exited"
+        labels (dict): Container labels
+    """
+    def __init__(self, id, name, status, labels=None):
+        self.id = id
+        self.name = name
+        self.status = status
+        self.labels = labels or {}
+
+class Client:
+    """
+    Client is a minimal Docker Engine API client.  Method names and return values follow
+    docker.APIClient for the calls docker-gen-cron makes, but connections are kept alive
+    and shared through a small pool, so a burst of calls (inspect, exec_create,
+    exec_inspect, ...) reuses a single connection to the daemon.  It is safe to share
+    between threads.
+
+    HTTP is spoken directly over the socket (see Connection) rather than through
+    http.client, which takes longer to import than a short-lived runjob can spare.
+
+    Args:
+        base_url (str): unix:// or tcp:// URL of the daemon, defaults to $DOCKER_HOST
+        timeout (int): Timeout for API calls, in seconds
+        pool_size (int): Maximum number of idle connections to keep
+    """
+    def __init__(self, base_url=None, timeout=60, pool_size=8):
+        self.socket_path, self.address, self.prefix = parse_host(base_url)
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def containers(self, all=False):
+        """Returns the list of containers, including stopped ones if all is set"""
+        return self._json("GET", "/containers/json?all={}".format(1 if all else 0))
+
+    def inspect_container(self, container):
+        """Returns the full inspect output of a container"""
+        return self._json("GET", "/containers/{}/json".format(quote(container)))
+
+    def container_state(self, container):
+        """Returns the id, name, status and labels of a container.
+
+        Returns:
+            ContainerState: The container's state
+        """
+        j = self.inspect_container(container)
+        return ContainerState(j["Id"], j["Name"].lstrip("/"), j["State"]["Status"], j.get("Config", {}).get("Labels"))
+
+    def start(self, container):
+        """Starts a container"""
+        self._json("POST", "/containers/{}/start".format(quote(container)))
+
+    def restart(self, container, timeout=10):
+        """Restarts a container"""
+        self._json("POST", "/containers/{}/restart?t={}".format(quote(container), timeout))
+
+    def exec_create(self, container, cmd, stdin=False, environment=None, user=""):
+        """Creates an exec instance.
+
+        Returns:
+            dict: Contains the "Id" of the exec instance
+        """
+        body = {
+            "AttachStdin": stdin,
+            "AttachStdout": True,
+            "AttachStderr": True,
+            "Tty": False,
+            "Cmd": cmd,
+            "Env": ["{}={}".format(k, v) for k, v in (environment or {}).items()],
+            "User": user,
+        }
+        return self._json("POST", "/containers/{}/exec".format(quote(container)), body)
+
+    def exec_start(self, exec_id, socket=True):
+        """Starts an exec instance and returns the socket attached to its stdio"""
+        if not socket:
+            raise ValueError("only socket=True is supported")
+
+        body = json.dumps({"Detach": False, "Tty": False}).encode("utf-8")
+        headers = {"Content-Type": "application/json", "Connection": "Upgrade", "Upgrade": "tcp"}
+        conn, resp = self._send("POST", "/exec/{}/start".format(quote(exec_id)), body, headers)
+        if resp.status not in (101, 200):
+            try:
+                check_response(resp, resp.read())
+            finally:
+                conn.close()
+
+        # The connection now belongs to the exec stream, starting with anything read
+        # past the response headers.
+        sock, leftover = conn.detach()
+        sock.settimeout(None)
+        return HijackedSocket(sock, leftover)
+
+    def exec_inspect(self, exec_id):
+        """Returns the inspect output of an exec instance"""
+        return self._json("GET", "/exec/{}/json".format(quote(exec_id)))
+
+    def events(self, filters=None):
+        """Subscribes to the event stream of the daemon.
+
+        The subscription is in place once this returns, so nothing that happens after
+        the call is missed.  The stream uses its own connection, without a timeout.
+
+        Args:
+            filters (dict): Map of filter name to list of values, e.g. {"type": ["container"]}
+
+        Returns:
+            generator: Yields each event (dict) until the connection closes.
+        """
+        path = "/events"
+        if filters:
+            path += "?filters={}".format(urllib.parse.quote(json.dumps(filters)))
+
+        conn = self._connect(timeout=None)
+        try:
+            conn.request("GET", self.prefix + path)
+            resp = conn.response()
+            if resp.status >= 400:
+                check_response(resp, resp.read())
+        except:
+            conn.close()
+            raise
+        return stream_json(conn, resp)
+
+    def close(self):
+        """Closes idle connections"""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+    def _json(self, method, path, body=None):
+        """Makes an API call and returns the decoded JSON response, if any"""
+        data = None
+        headers = {}
+        if body is not None:
+            data = json.dumps(body).encode("utf-8")
+            headers["Content-Type"] = "application/json"
+
+        conn, resp = self._send(method, path, data, headers)
+        try:
+            content = resp.read()
+        except:
+            conn.close()
+            raise
+
+        if resp.will_close:
+            conn.close()
+        else:
+            self._release(conn)
+
+        check_response(resp, content)
+        if len(content) == 0:
+            return None
+        return json.loads(content)
+
+    def _send(self, method, path, body, headers):
+        """Sends a request on a pooled connection.  Idle connections the daemon has closed
+        are dropped before use.  If one is closed while in use, a GET is retried once on a
+        fresh connection, but a POST is not: the daemon may have acted on it already, and
+        starting a container or an exec twice is worse than an error.
+
+        Returns:
+            Connection: The connection, which the caller must release or close
+            Response: The response, with only headers read
+        """
+        conn, reused = self._acquire()
+        try:
+            conn.request(method, self.prefix + path, body, headers)
+            return conn, conn.response()
+        except (ConnectionClosed, BrokenPipeError, ConnectionResetError):
+            conn.close()
+            if not reused or method != "GET":
+                raise
+
+        conn = self._connect()
+        try:
+            conn.request(method, self.prefix + path, body, headers)
+            return conn, conn.response()
+        except:
+            conn.close()
+            raise
+
+    def _acquire(self):
+        """Returns an idle connection (and True) or a new one (and False)"""
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                conn = self._idle.pop()
+            if not conn.closed_by_peer():
+                return conn, True
+            conn.close()
+        return self._connect(), False
+
+    def _release(self, conn):
+        """Returns a connection to the pool"""
+        with self._lock:
+            if len(self._idle) < self.pool_size:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def _connect(self, timeout=-1):
+        """Opens a new connection, with the client's timeout unless one is specified"""
+        timeout = self.timeout if timeout == -1 else timeout
+        if self.socket_path is not None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.settimeout(timeout)
+                sock.connect(self.socket_path)
+            except:
+                sock.close()
+                raise
+        else:
+            sock = socket.create_connection(self.address, timeout)
+        return Connection(sock)
+
+class Connection:
+    """
+    Connection is a keep-alive HTTP/1.1 connection to the daemon.  It implements just
+    what the Engine API needs: requests with JSON bodies, responses delimited by
+    Content-Length, chunked encoding or the end of the connection, and the upgrade
+    that turns an exec start into a raw stream.
+    """
+    def __init__(self, sock):
+        self.sock = sock
+        self.buf = bytearray()
+
+    def request(self, method, path, body=None, headers=None):
+        self.sock.sendall(format_request(method, path, body, headers))
+
+    def closed_by_peer(self):
+        """Returns whether an idle connection has been closed by the daemon (or has
+        unexpected data waiting), so that it shouldn't be used"""
+        if self.buf:
+            return True
+        try:
+            readable, _, _ = select.select([self.sock], [], [], 0)
+        except (OSError, ValueError):
+            return True
+        return len(readable) > 0
+
+    def response(self):
+        """Reads the status line and headers of a response.
+
+        Returns:
+            Response: The response, with the body still to be read
+        """
+        version, status, reason = parse_status(self.readline())
+        headers = {}
+        while True:
+            line = self.readline()
+            if line == b"":
+                break
+            parse_header(line, headers)
+        return Response(self, version, status, reason, headers)
+
+    def readline(self):
+        """Returns the next CRLF-terminated line, without the CRLF"""
+        start = 0
+        while True:
+            i = self.buf.find(b"\n", start)
+            if i >= 0:
+                line = bytes(self.buf[:i])
+                del self.buf[:i + 1]
+                return line.rstrip(b"\r")
+            start = len(self.buf)
+            if start > MAX_HEADERS:
+                raise ConnectionError("Response line too long")
+            if not self.fill():
+                raise ConnectionClosed("Connection closed by daemon")
+
+    def read(self, n):
+        """Returns exactly n bytes"""
+        while len(self.buf) < n:
+            if not self.fill():
+                raise ConnectionClosed("Connection closed by daemon")
+        data = bytes(self.buf[:n])
+        del self.buf[:n]
+        return data
+
+    def read_some(self):
+        """Returns whatever is available (at least one byte), or b"" at end of file"""
+        if not self.buf and not self.fill():
+            return b""
+        data = bytes(self.buf)
+        self.buf.clear()
+        return data
+
+    def fill(self):
+        """Reads more data into the buffer, returns False at end of file"""
+        data = self.sock.recv(65536)
+        self.buf += data
+        return len(data) > 0
+
+    def detach(self):
+        """Gives up the socket, and whatever was read past the last response"""
+        sock, leftover = self.sock, bytes(self.buf)
+        self.sock = None
+        self.buf = bytearray()
+        return sock, leftover
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+class Response:
+    """
+    Response is the response to a request on a Connection.
+
+    Attributes:
+        status (int): HTTP status code
+        reason (str): HTTP reason phrase
+        headers (dict): Headers, with lowercase names
+        will_close (bool): Whether the daemon will close the connection after this response
+    """
+    def __init__(self, conn, version, status, reason, headers):
+        self.conn = conn
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.chunked = "chunked" in headers.get("transfer-encoding", "").lower()
+        self.length = None
+        if not self.chunked and "content-length" in headers:
+            self.length = int(headers["content-length"])
+        elif status < 200 or status in (204, 304):
+            self.length = 0
+        self.will_close = (headers.get("connection", "").lower() == "close" or version == "HTTP/1.0"
+            or (self.length is None and not self.chunked))
+
+    def read(self):
+        """Returns the entire body"""
+        return b"".join(self.chunks())
+
+    def chunks(self):
+        """Yields the body in pieces, as it arrives"""
+        conn = self.conn
+        if self.chunked:
+            while True:
+                size = int(conn.readline().split(b";")[0], 16)
+                if size == 0:
+                    # Trailers
+                    while conn.readline() != b"":
+                        pass
+                    return
+                yield conn.read(size)
+                conn.read(2)
+        elif self.length is not None:
+            remaining = self.length
+            while remaining > 0:
+                data = conn.read_some()
+                if not data:
+                    raise ConnectionClosed("Connection closed by daemon")
+                if len(data) > remaining:
+                    # Can't happen with a well-behaved daemon, keep the rest for the next response
+                    conn.buf[:0] = data[remaining:]
+                    data = data[:remaining]
+                remaining -= len(data)
+                yield data
+        else:
+            while True:
+                data = conn.read_some()
+                if not data:
+                    return
+                yield data
+
+class HijackedSocket:
+    """
+    HijackedSocket is the raw stream of an exec after the HTTP upgrade, starting with
+    any data that was read along with the response headers.  Like the socket.SocketIO
+    objects docker.APIClient returns, the socket is available as _sock.
+    """
+    def __init__(self, sock, leftover):
+        self._sock = sock
+        self._leftover = memoryview(leftover)
+
+    def readinto(self, b):
+        if len(self._leftover) > 0:
+            n = min(len(b), len(self._leftover))
+            b[:n] = self._leftover[:n]
+            self._leftover = self._leftover[n:]
+            return n
+        return self._sock.recv_into(b)
+
+    def buffered(self):
+        """Returns the number of bytes to be read before reading from the socket"""
+        return len(self._leftover)
+
+    def fileno(self):
+        return self._sock.fileno()
+
+    def close(self):
+        self._sock.close()
+
+def stream_json(conn, resp):
+    """Yields each line of a streaming response decoded as JSON, closing conn at the end"""
+    try:
+        pending = b""
+        for data in resp.chunks():
+            lines = (pending + data).split(b"\n")
+            pending = lines.pop()
+            for line in lines:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+        if pending.strip():
+            yield json.loads(pending)
+    finally:
+        conn.close()
+
+def parse_host(base_url=None):
+    """Parses the URL of the daemon ($DOCKER_HOST by default).
+
+    Returns:
+        str: Path of the Unix socket, or None
+        tuple: (host, port) to connect to over TCP, or None
+        str: Prefix of API paths, for $DOCKER_API_VERSION
+
+    Raises:
+        ValueError: The URL is not supported, or TLS is configured
+    """
+    base_url = base_url or os.environ.get("DOCKER_HOST") or DEFAULT_HOST
+    # docker.from_env turned TLS on with either variable.  The exec stream's stdin is
+    # ended by half-closing the socket, which Python's ssl can't do, so rather than
+    # connecting in plaintext to a daemon that expects TLS, refuse.
+    for var in TLS_VARS:
+        if os.environ.get(var):
+            raise ValueError("{} is set, but TLS connections to the docker daemon are not supported, "
+                "mount its Unix socket instead".format(var))
+    url = urllib.parse.urlparse(base_url)
+    version = os.environ.get("DOCKER_API_VERSION")
+    prefix = "/v{}".format(version) if version else ""
+    if url.scheme in ("unix", "http+unix"):
+        return url.path, None, prefix
+    elif url.scheme in ("tcp", "http"):
+        return None, (url.hostname, url.port or 2375), prefix
+    raise ValueError("Unsupported docker host: {}".format(base_url))
+
+def format_request(method, path, body=None, headers=None):
+    """Returns the bytes of an HTTP/1.1 request"""
+    lines = ["{} {} HTTP/1.1".format(method, path), "Host: docker"]
+    for k, v in (headers or {}).items():
+        lines.append("{}: {}".format(k, v))
+    if body is not None or method == "POST":
+        lines.append("Content-Length: {}".format(len(body or b"")))
+    data = ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+    return data + body if body else data
+
+def parse_status(line):
+    """Parses the status line of a response, without its CRLF.
+
+    Returns:
+        tuple: (version, status, reason)
+    """
+    parts = line.decode("latin-1").split(None, 2)
+    if len(parts) < 2 or not parts[0].startswith("HTTP/") or not parts[1].isdigit():
+        raise ConnectionError("Malformed status line: {}".format(repr(line)))
+    return parts[0], int(parts[1]), parts[2] if len(parts) > 2 else ""
+
+def parse_header(line, headers):
+    """Parses a header line, without its CRLF, into headers (keyed by lowercase name)"""
+    k, _, v = line.decode("latin-1").partition(":")
+    headers[k.strip().lower()] = v.strip()
+
+def check_response(resp, content):
+    """Raises APIError if the response is an error"""
+    if resp.status < 400:
+        return
+    try:
+        explanation = json.loads(content)["message"]
+    except (ValueError, KeyError, TypeError):
+        explanation = content.decode("utf-8", "replace")
+    if resp.status == 404:
+        raise NotFound(resp.status, explanation)
+    raise APIError(resp.status, explanation)
+
+def quote(s):
+    """Quotes a container name or id for use in a URL path"""
+    return urllib.parse.quote(s, safe="")
@@ -16,79 +16,349 @@
 # along with this program; if not, write to the Free Software Foundation,
 # Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
 
-import docker
+import io
+import logging
 import os
+import select
 import socket
+import stat
 import struct
 import sys
+import threading
 import time
 
-def docker_exec(client, container_name, args, input):
+import logconfig
+import metrics
+
+logger = logging.getLogger("exec")
+
+# Bounds of the exponential backoff used when the exec is still running after
+# its output stream has closed.
+POLL_MIN = 0.005
+POLL_MAX = 0.25
+
+# Output is read and batched in chunks of this size.  The read buffer grows for large
+# frames, up to MAX_BUFFER_SIZE.
+BUFFER_SIZE = 64 * 1024
+MAX_BUFFER_SIZE = 1024 * 1024
+
+# Stdin is encoded and sent in chunks of this size
+STDIN_CHUNK = 64 * 1024
+
+# Seconds a timed out exec is given to stop after each signal, before the next signal or
+# giving up on it
+KILL_GRACE = 10
+
+# Exit code reported for a timed out job, as timeout(1) does
+TIMEOUT_CODE = 124
+
+class Timeout(Exception):
+    """
+    Timeout is raised when an exec runs for longer than its timeout.
+
+    Attributes:
+        container (str): Container name
+        duration (float): Seconds the exec ran for before it was abandoned
+    """
+    def __init__(self, container, duration):
+        super().__init__("{}: exec timed out after {:.3f}s".format(container, duration))
+        self.container = container
+        self.duration = duration
+
+def docker_exec(client, container_name, args, input, stdout=None, stderr=None, timeout=None, cancel=None):
     """Executes a command in a container, writes output to stdout/stderr and returns the exit code.
 
+    When timeout expires, cancel is called to stop the process in the container with
+    SIGTERM, then SIGKILL after KILL_GRACE.  If the output stream is still open after
+    another KILL_GRACE, the exec is abandoned.
+
     Args:
-        client (docker.APIClient): Docker client
+        client (dockerapi.Client): Docker client
         container_name (str): Container to run the command in
         args (dict): Keyword arguments to pass to client.exec_create
-        input (str): Text to write to stdin of exec process, or None to close stdin.
+        input (str/bytes/file): Data to write to stdin of exec process (text, bytes or a binary
+            file to stream from), or None to close stdin.
+        stdout (file): Binary stream to write stdout to, or None for sys.stdout
+        stderr (file): Binary stream to write stderr to, or None for sys.stderr
+        timeout (float): Seconds the process may run for, or None for no limit
+        cancel (callable): Called with a signal name ("TERM" or "KILL") to stop the process
 
     Returns:
         int: Exit code of process
+
+    Raises:
+        Timeout: The process ran for longer than timeout
     """
 
+    started = time.monotonic()
     has_input = not not input
     ec = client.exec_create(container_name, stdin=has_input, **args)
     id = ec["Id"]
 
     sock = client.exec_start(id, socket=True)
-    if has_input:
-        write_stdin(sock, input)
+    writer = None
+    done = threading.Event()
+    expired = threading.Event()
+    if timeout is not None:
+        threading.Thread(target=logconfig.in_context(watchdog), args=(sock, timeout, cancel, done, expired), daemon=True).start()
+    try:
+        # Write stdin alongside reading output, so neither side can fill up and stall
+        # the other.
+        if has_input:
+            writer = threading.Thread(target=logconfig.in_context(write_stdin), args=(sock, input), daemon=True)
+            writer.start()
 
-    read_result(sock)
+        try:
+            out_bytes, err_bytes = read_result(sock, stdout, stderr)
+        except OSError:
+            if not expired.is_set():
+                raise
+            out_bytes = err_bytes = 0
+    finally:
+        done.set()
+        if writer is not None:
+            if writer.is_alive():
+                # The process is done without reading all of its input, unblock the writer
+                shutdown(sock, socket.SHUT_RDWR)
+            writer.join()
+        sock.close()
+    closed = time.monotonic()
+    if expired.is_set():
+        # The process may not have stopped, don't wait for it
+        metrics.OUTPUT_BYTES.inc(container_name, "stdout", amount=out_bytes)
+        metrics.OUTPUT_BYTES.inc(container_name, "stderr", amount=err_bytes)
+        raise Timeout(container_name, closed - started)
+    inspect = wait_for_exit(client, id)
+    finished = time.monotonic()
+
+    metrics.OUTPUT_BYTES.inc(container_name, "stdout", amount=out_bytes)
+    metrics.OUTPUT_BYTES.inc(container_name, "stderr", amount=err_bytes)
+    logger.info("{}: exec {} exited with code {} after {:.3f}s ({:.3f}s waiting for completion)"
+        .format(container_name, id[:12], inspect["ExitCode"], finished - started, finished - closed))
+    return inspect["ExitCode"]
+
+def watchdog(sock, timeout, cancel, done, expired):
+    """Stops an exec that is still running after timeout, see docker_exec.
+
+    Args:
+        sock (socket.SocketIO): The exec stream
+        timeout (float): Seconds to wait for done
+        cancel (callable): Called with a signal name to stop the process, or None
+        done (threading.Event): Set once the output stream has closed
+        expired (threading.Event): Set here if timeout expires
+    """
+    if done.wait(timeout):
+        return
+    expired.set()
+    for signal in ("TERM", "KILL"):
+        if cancel is not None:
+            try:
+                cancel(signal)
+            except Exception:
+                logger.exception("Error sending SIG{} to timed out exec".format(signal))
+        if done.wait(KILL_GRACE):
+            return
+    # Nothing stopped it, give up on the stream
+    shutdown(sock, socket.SHUT_RDWR)
+
+def wait_for_exit(client, id):
+    """Waits for an exec to finish.  The end of the output stream normally means the process
+    has exited, so this polls with a short backoff in case dockerd hasn't caught up yet.
+
+    Args:
+        client (dockerapi.Client): Docker client
+        id (str): Exec id
+
+    Returns:
+        dict: Result of client.exec_inspect once the exec is no longer running
+    """
+    delay = POLL_MIN
     inspect = client.exec_inspect(id)
     while inspect["Running"]:
-        time.sleep(1)
+        time.sleep(delay)
+        delay = min(delay * 2, POLL_MAX)
         inspect = client.exec_inspect(id)
+    return inspect
 
-    return inspect["ExitCode"]
+def read_result(sock, stdout=None, stderr=None):
+    """Reads multiplexed stdin+stdout from a socket and writes it to stdout and stderr
+    (sys.stdout and sys.stderr by default).
 
-def read_result(sock):
-    """Reads multiplexed stdin+stdout from a socket and writes it to sys.stdout and sys.stderr"""
+    Returns:
+        int: Bytes of stdout relayed
+        int: Bytes of stderr relayed
+    """
 
-    # Stolen from docker.utils.socket package
+    # Adapted from docker.utils.socket package
     # See also: https://docs.docker.com/engine/api/v1.24/#attach-to-a-container
-    buf = bytearray(512)
-    bufv = memoryview(buf)
-    hdr = bufv[:8]
-    while True:
-        # Read header
-        hdrv = hdr
-        while len(hdrv) > 0:
-            count = sock.readinto(hdrv)
-            if count <= 0:
-                return
-            hdrv = hdrv[count:]
-
-        # Parse header
-        stream, datalen = struct.unpack(">BxxxL", hdr)
-        if datalen <= 0:
+    #
+    # The socket is read in large chunks and frames are parsed out of the buffer, so
+    # small frames don't cost a read each.  Output is batched by Relay.  A large frame
+    # headed for a pipe is spliced straight from the socket instead.
+    relays = {1: Relay(stdout or sys.stdout.buffer), 2: Relay(stderr or sys.stderr.buffer)}
+    fd = splice_source(sock)
+    buf = bytearray(BUFFER_SIZE)
+    view = memoryview(buf)
+    start = end = 0     # Unparsed data is buf[start:end]
+    remaining = 0       # Bytes left in the current frame
+    relay = None
+    try:
+        while True:
+            if start == end:
+                start = end = 0
+            elif end == len(buf):
+                buf[:end - start] = buf[start:end]
+                end -= start
+                start = 0
+
+            # Write out what we have if the socket is about to block
+            if fd is not None and not readable(fd):
+                for r in relays.values():
+                    r.flush()
+
+            count = sock.readinto(view[end:])
+            if not count:
+                return relays[1].count, relays[2].count
+            end += count
+
+            while start < end:
+                if remaining > 0:
+                    take = min(remaining, end - start)
+                    relay.write(view[start:start + take])
+                    start += take
+                    remaining -= take
+                    if remaining > 0 and fd is not None and relay.fd is not None:
+                        relay.flush()
+                        if not splice(fd, relay.fd, remaining):
+                            return relays[1].count, relays[2].count
+                        relay.count += remaining
+                        remaining = 0
+                    continue
+
+                if end - start < 8:
+                    break
+                stream, remaining = struct.unpack_from(">BxxxL", buf, start)
+                start += 8
+                if remaining <= 0:
+                    return relays[1].count, relays[2].count
+                relay = relays[2 if stream == 2 else 1]
+
+                # Grow the buffer for large frames, up to a point
+                if remaining > len(buf) - 8 and len(buf) < MAX_BUFFER_SIZE:
+                    size = min(MAX_BUFFER_SIZE, 1 << (remaining + 8).bit_length())
+                    grown = bytearray(size)
+                    grown[:end - start] = buf[start:end]
+                    view.release()
+                    buf, view = grown, memoryview(grown)
+                    end -= start
+                    start = 0
+    finally:
+        view.release()
+        for r in relays.values():
+            r.flush()
+
+class Relay:
+    """
+    Relay batches the output for one stream of an exec, and writes it to the output
+    when BUFFER_SIZE bytes have accumulated or when asked to flush.
+
+    Attributes:
+        out (file): Binary output stream
+        fd (int): File descriptor of out if it is a pipe that can be spliced to, or None
+        count (int): Number of bytes relayed
+    """
+    def __init__(self, out):
+        self.out = out
+        self.fd = splice_target(out)
+        self.pending = bytearray()
+        self.count = 0
+
+    def write(self, data):
+        self.count += len(data)
+        if len(self.pending) + len(data) < BUFFER_SIZE:
+            self.pending += data
             return
 
-        # Pick stream, pipe data
-        buf = sys.stderr.buffer if stream == 2 else sys.stdout.buffer
-        while datalen > 0:
-            count = sock.readinto(bufv[:datalen])
-            if count <= 0:
-                # Flush and let the header read fail and exit
-                break
-            buf.write(bufv[:count])
-            datalen -= count
-        buf.flush()
+        if self.pending:
+            self.out.write(self.pending)
+            self.pending.clear()
+        self.out.write(data)
+
+    def flush(self):
+        if self.pending:
+            self.out.write(self.pending)
+            self.pending.clear()
+        self.out.flush()
+
+def splice_source(sock):
+    """Returns the file descriptor of sock if it can be read from directly, or None"""
+    if not hasattr(os, "splice") or not hasattr(sock, "fileno"):
+        return None
+    # HijackedSocket may be holding data read along with the HTTP response
+    if getattr(sock, "buffered", lambda: 0)() > 0:
+        return None
+    try:
+        return sock.fileno()
+    except (OSError, ValueError, io.UnsupportedOperation):
+        return None
+
+def splice_target(out):
+    """Returns the file descriptor of out if it is a pipe that can be spliced to, or None"""
+    if not hasattr(os, "splice"):
+        return None
+    try:
+        fd = out.fileno()
+        return fd if stat.S_ISFIFO(os.fstat(fd).st_mode) else None
+    except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+        return None
+
+def splice(src, dst, count):
+    """Moves count bytes from src to dst without copying them through userspace.
+
+    Returns:
+        bool: False if src reached end of file first
+    """
+    while count > 0:
+        n = os.splice(src, dst, count)
+        if n <= 0:
+            return False
+        count -= n
+    return True
+
+def readable(fd):
+    """Returns whether fd can be read without blocking"""
+    r, _, _ = select.select([fd], [], [], 0)
+    return len(r) > 0
 
 def write_stdin(sock, data):
-    """Writes data to the socket and then shuts down the write side"""
+    """Writes data to the socket in chunks and then shuts down the write side.
+
+    Args:
+        sock (socket.SocketIO): The exec socket
+        data (str/bytes/file): Text, bytes or a binary file to copy
+    """
+    try:
+        if isinstance(data, str):
+            for i in range(0, len(data), STDIN_CHUNK):
+                sock._sock.sendall(data[i:i + STDIN_CHUNK].encode("utf-8"))
+        elif isinstance(data, (bytes, bytearray)):
+            view = memoryview(data)
+            for i in range(0, len(view), STDIN_CHUNK):
+                sock._sock.sendall(view[i:i + STDIN_CHUNK])
+        else:
+            while True:
+                chunk = data.read(STDIN_CHUNK)
+                if not chunk:
+                    break
+                sock._sock.sendall(chunk)
+    except OSError as e:
+        logger.debug("Process stopped reading stdin: {}".format(e))
+    finally:
+        shutdown(sock, socket.SHUT_WR)
 
-    if type(data) == str:
-        data = data.encode("utf-8")
-    os.write(sock.fileno(), data)
-    sock._sock.shutdown(socket.SHUT_WR)
+def shutdown(sock, how):
+    """Shuts down the exec socket, ignoring errors if it's already closed"""
+    try:
+        sock._sock.shutdown(how)
+    except OSError:
+        pass
@@ -0,0 +1,228 @@
+# This file is part of docker-gen-cron
+# Copyright (C) 2020 John J. Jordan
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+
+# Run history of jobs, kept in SQLite when DOCKER_GEN_CRON_HISTORY is set.  Each
+# job keeps its last DOCKER_GEN_CRON_HISTORY runs, so summaries only ever look at
+# a bounded number of rows per job.  Job ids change whenever a job is edited, so
+# the database as a whole is also capped at MAX_ROWS runs and MAX_AGE seconds.
+
+import logging
+import math
+import os
+import sqlite3
+import threading
+import time
+import urllib.parse
+
+import parser
+
+logger = logging.getLogger("history")
+
+HISTORY_FILE = "/var/etc/history.db"
+
+# Runs kept across all jobs, and the age at which runs are dropped, checked every
+# PRUNE_INTERVAL runs
+MAX_ROWS = 100000
+MAX_AGE = 30 * 24 * 60 * 60
+PRUNE_INTERVAL = 100
+
+# Code recorded for a fire skipped because the previous run of the job was still going
+SKIPPED = -2
+
+# Seconds to wait for another process writing to the database
+BUSY_TIMEOUT = 5
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    container TEXT NOT NULL,
+    job TEXT NOT NULL,
+    job_index INTEGER,
+    started REAL NOT NULL,
+    duration REAL NOT NULL,
+    code INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS runs_job ON runs (container, job, id);
+"""
+
+# Connections are kept open for each thread, for the dispatcher
+_local = threading.local()
+
+class Summary:
+    """
+    Summary describes the recent runs of a job.
+
+    Attributes:
+        container (str): Container name
+        job (str): Job id
+        index (int): Index of the job, as of its last run
+        runs (int): Number of runs kept, including skipped ones
+        last_started (float): When the last run started, in seconds since the epoch
+        last_duration (float): Duration of the last run, in seconds
+        last_code (int): Exit code of the last run, SKIPPED if it was skipped
+        p50 (float): Median duration of the runs that weren't skipped, in seconds, or None
+        p95 (float): 95th percentile duration, likewise
+        failures (int): Number of runs with a non-zero exit code
+        skipped (int): Number of runs skipped by the overlap option
+    """
+    def __init__(self, container, job):
+        self.container = container
+        self.job = job
+        self.index = None
+        self.runs = 0
+        self.last_started = None
+        self.last_duration = None
+        self.last_code = None
+        self.p50 = None
+        self.p95 = None
+        self.failures = 0
+        self.skipped = 0
+
+def connect(path=None, readonly=False):
+    """Returns this thread's connection to the history database (HISTORY_FILE by
+    default), creating the database if needed unless readonly is set"""
+    path = path or HISTORY_FILE
+    db = getattr(_local, "connections", {}).get((path, readonly))
+    if db is None:
+        if readonly:
+            db = sqlite3.connect("file:{}?mode=ro".format(urllib.parse.quote(path)), timeout=BUSY_TIMEOUT,
+                isolation_level=None, uri=True)
+        else:
+            db = sqlite3.connect(path, timeout=BUSY_TIMEOUT, isolation_level=None)
+            try:
+                db.execute("PRAGMA journal_mode=WAL")
+                db.execute("PRAGMA synchronous=NORMAL")
+                db.executescript(SCHEMA)
+            except:
+                db.close()
+                raise
+        _local.__dict__.setdefault("connections", {})[(path, readonly)] = db
+    return db
+
+def runs_kept(environment):
+    """Returns the number of runs to keep per job, 0 if history is disabled (the default)"""
+    return max(0, parser.setting_int(environment, "DOCKER_GEN_CRON_HISTORY"))
+
+def record(environment, container, job, index, started, duration, code, path=None):
+    """Records a run, evicting the oldest runs of the job beyond the number kept, and
+    every PRUNE_INTERVAL runs, runs beyond MAX_ROWS or MAX_AGE.  Errors are logged
+    rather than raised, history is not worth failing a job over.
+
+    Args:
+        environment (dict): Same as parser.CronTab.environment
+        container (str): Container name
+        job (str): Job id
+        index (int): Index of the job
+        started (float): When the run started, in seconds since the epoch
+        duration (float): Duration of the run, in seconds
+        code (int): Exit code, -1 if the job couldn't be run or SKIPPED
+        path (str): Database, or None for HISTORY_FILE
+    """
+    keep = runs_kept(environment)
+    if keep <= 0:
+        return
+    try:
+        db = connect(path)
+        with db:
+            db.execute("BEGIN IMMEDIATE")
+            cur = db.execute("INSERT INTO runs (container, job, job_index, started, duration, code) VALUES (?, ?, ?, ?, ?, ?)",
+                (container, job, index, started, duration, code))
+            db.execute("DELETE FROM runs WHERE container = ? AND job = ? AND id <= ("
+                "SELECT id FROM runs WHERE container = ? AND job = ? AND id <= ? ORDER BY id DESC LIMIT 1 OFFSET ?)",
+                (container, job, container, job, cur.lastrowid, keep))
+            if cur.lastrowid % PRUNE_INTERVAL == 0:
+                prune(db, cur.lastrowid, started)
+    except sqlite3.Error as e:
+        logger.warning("Cannot record run history: {}".format(e))
+
+def prune(db, last, now):
+    """Deletes runs more than MAX_ROWS before run id last, or older than MAX_AGE.  Ids
+    only grow, so this bounds the number of rows whichever jobs they belong to."""
+    db.execute("DELETE FROM runs WHERE id <= ? OR started < ?", (last - MAX_ROWS, now - MAX_AGE))
+
+def summarize(container, job=None, path=None):
+    """Summarizes the runs of a container's jobs.  The database is only read, and
+    there are no runs if it doesn't exist.
+
+    Args:
+        container (str): Container name
+        job (str): Job id, or None for every job of the container
+        path (str): Database, or None for HISTORY_FILE
+
+    Returns:
+        list: Summary of each job, by job id
+    """
+    if not os.path.exists(path or HISTORY_FILE):
+        return []
+    db = connect(path, readonly=True)
+    if job is None:
+        jobs = [r[0] for r in db.execute("SELECT DISTINCT job FROM runs WHERE container = ? ORDER BY job", (container,))]
+    else:
+        jobs = [job]
+
+    summaries = []
+    for j in jobs:
+        rows = db.execute("SELECT job_index, started, duration, code FROM runs WHERE container = ? AND job = ? ORDER BY id",
+            (container, j)).fetchall()
+        if not rows:
+            continue
+        s = Summary(container, j)
+        s.index, s.last_started, s.last_duration, s.last_code = rows[-1]
+        s.runs = len(rows)
+        s.skipped = sum(1 for r in rows if r[3] == SKIPPED)
+        s.failures = sum(1 for r in rows if r[3] not in (0, SKIPPED))
+        durations = sorted(r[2] for r in rows if r[3] != SKIPPED)
+        if durations:
+            s.p50 = percentile(durations, 50)
+            s.p95 = percentile(durations, 95)
+        summaries.append(s)
+    return summaries
+
+def percentile(values, p):
+    """Returns the p-th percentile of sorted values (nearest rank)"""
+    return values[max(0, math.ceil(len(values) * p / 100) - 1)]
+
+def seconds(value):
+    """Formats a duration for show, or "-" if there is none"""
+    return "-" if value is None else "{:.3f}s".format(value)
+
+def show(environment, container, job, out, path=None):
+    """Writes a table summarizing the runs of a container's jobs to out.
+
+    Returns:
+        bool: Whether there were any runs
+    """
+    summaries = summarize(container, job, path)
+    if not summaries and runs_kept(environment) <= 0:
+        out.write("Run history is off, set DOCKER_GEN_CRON_HISTORY to keep it\n".encode("utf-8"))
+        out.flush()
+        return False
+    lines = ["{:<12} {:>5} {:>5} {:<19} {:>5} {:>10} {:>10} {:>10} {:>8} {:>7}".format(
+        "JOB", "INDEX", "RUNS", "LAST RUN", "CODE", "DURATION", "P50", "P95", "FAILED", "SKIPPED")]
+    for s in summaries:
+        ran = s.runs - s.skipped
+        lines.append("{:<12} {:>5} {:>5} {:<19} {:>5} {:>10} {:>10} {:>10} {:>8} {:>7}".format(
+            s.job[:12], s.index if s.index is not None else "-", s.runs,
+            time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(s.last_started)),
+            "skip" if s.last_code == SKIPPED else s.last_code,
+            seconds(None if s.last_code == SKIPPED else s.last_duration), seconds(s.p50), seconds(s.p95),
+            "{:.1f}%".format(100.0 * s.failures / ran) if ran else "-", s.skipped))
+    if not summaries:
+        lines.append("No runs recorded for {}".format(container))
+    out.write(("\n".join(lines) + "\n").encode("utf-8"))
+    out.flush()
+    return len(summaries) > 0
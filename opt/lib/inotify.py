@@ -0,0 +1,88 @@
+# This file is part of docker-gen-cron
+# Copyright (C) 2020 John J. Jordan
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+
+# Waits for files to appear using inotify(7) through ctypes, falling back to
+# polling where inotify is unavailable.
+
+import logging
+import os
+import select
+import time
+
+logger = logging.getLogger("inotify")
+
+# From <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# Seconds between checks when polling
+POLL_INTERVAL = 0.1
+
+def wait_for_file(path, timeout):
+    """Waits for a file to exist.  Writers should create the file atomically (by
+    renaming it into place), since waiters may read it as soon as it appears.
+
+    Args:
+        path (str): File to wait for
+        timeout (float): Seconds to wait
+
+    Returns:
+        bool: Whether the file exists, False on timeout
+    """
+    deadline = time.monotonic() + timeout
+    # Watch before checking, so a file that appears in between isn't missed
+    fd = watch(os.path.dirname(path) or ".", IN_MOVED_TO | IN_CREATE | IN_CLOSE_WRITE)
+    try:
+        while not os.path.exists(path):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            if fd is None:
+                time.sleep(min(POLL_INTERVAL, remaining))
+            elif select.select([fd], [], [], remaining)[0]:
+                # The events themselves don't matter, the loop checks for the file again
+                os.read(fd, 65536)
+        return True
+    finally:
+        if fd is not None:
+            os.close(fd)
+
+def watch(directory, mask):
+    """Creates an inotify instance watching a directory.
+
+    Returns:
+        int: The inotify file descriptor, or None if inotify is unavailable
+    """
+    try:
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    except (OSError, AttributeError) as e:
+        logger.debug("inotify unavailable, polling: {}".format(e))
+        return None
+    if fd < 0:
+        logger.debug("inotify_init1 failed, polling: {}".format(os.strerror(ctypes.get_errno())))
+        return None
+
+    if libc.inotify_add_watch(fd, os.fsencode(directory), mask) < 0:
+        logger.debug("Cannot watch {}, polling: {}".format(directory, os.strerror(ctypes.get_errno())))
+        os.close(fd)
+        return None
+    return fd
@@ -0,0 +1,274 @@
+# This file is part of docker-gen-cron
+# Copyright (C) 2020 John J. Jordan
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+
+import marshal
+import os
+import time
+import urllib.parse
+
+import parser
+
+# A symlink to the current generation: a directory holding the environment and one
+# file per container, so runjob only reads the container it fires a job in.
+INDEX_FILE = "/var/etc/jobs.idx"
+ENVIRONMENT_FILE = "environment"
+BATCHES_FILE = "batches"
+VERSION = 2
+
+# runjob argument that fires a batch of start/restart actions, followed by its id
+BATCH = "--batch"
+
+class JobConfig:
+    """
+    JobConfig represents a job and its applied options and environment.
+
+    Attributes:
+        container (parser.Container): The container of the job.
+        env (dict): The environment variables set leading up to this job.
+        options (dict): The fcron options specified for this job.
+        shell (str): The SHELL environment variable or None.
+        job (parser.Job): The job object.
+    """
+    def __init__(self):
+        self.container = None
+        self.env = {}
+        self.options = {}
+        self.shell = None
+        self.job = None
+
+    def add_options(self, options):
+        """Merges the specified options into this JobConfig"""
+        for k, v in options.items():
+            if k == "reset":
+                self.options = {}
+                self.env = {} # TODO: Correct?
+                self.shell = None
+            else:
+                self.options[k] = v
+
+    def copy(self):
+        """Returns a copy of this JobConfig that can be modified independently"""
+        cfg = JobConfig()
+        cfg.container = self.container
+        cfg.env = dict(self.env)
+        cfg.options = dict(self.options)
+        cfg.shell = self.shell
+        cfg.job = self.job
+        return cfg
+
+    def to_entry(self):
+        """Converts this JobConfig to an index entry"""
+        return {
+            "index": self.job.index,
+            "cmd": self.job.cmd,
+            "input": self.job.input,
+            "env": self.env,
+            "shell": self.shell,
+            "options": self.options,
+        }
+
+    @staticmethod
+    def from_entry(container_name, entry):
+        """Creates a JobConfig from an index entry"""
+        job = parser.Job()
+        job.index = entry["index"]
+        job.cmd = entry["cmd"]
+        job.input = entry["input"]
+
+        cfg = JobConfig()
+        cfg.container = container_name
+        cfg.env = entry["env"]
+        cfg.options = entry["options"]
+        cfg.shell = entry["shell"]
+        cfg.job = job
+        return cfg
+
+class JobIndex:
+    """
+    JobIndex is a precompiled lookup table of jobs written by reload.py.
+
+    Attributes:
+        containers (dict): Map of container name to a map of job hash to index entry.
+            When loaded from disk, containers are read into it as they are looked up.
+        environment (dict): Same as parser.CronTab.environment
+        batches (dict): Map of batch id to a list of [container name, action], see
+            reload.generate_batches.  Read from disk the first time it is needed.
+        path (str): Generation directory to read containers from, or None
+    """
+    def __init__(self, path=None):
+        self.containers = {}
+        self.environment = {}
+        self.batches = None if path is not None else {}
+        self.path = path
+
+    def find(self, container_name, id):
+        """Finds a job by container and id.
+
+        Returns:
+            JobConfig: The job and its associated configuration, or None if not found.
+        """
+        entry = self.container(container_name).get(id)
+        if entry is None:
+            return None
+        return JobConfig.from_entry(container_name, entry)
+
+    def batch(self, id):
+        """Finds a batch of start/restart actions by id.
+
+        Returns:
+            list: [container name, action] of each action in the batch, or None if not found.
+        """
+        if self.batches is None:
+            self.batches = read_blob(os.path.join(self.path, BATCHES_FILE)) or {}
+        return self.batches.get(id)
+
+    def container(self, name):
+        """Returns the map of job hash to index entry of a container, reading it from
+        disk the first time."""
+        entries = self.containers.get(name)
+        if entries is None:
+            entries = {}
+            if self.path is not None:
+                entries = read_blob(os.path.join(self.path, container_file(name))) or {}
+                self.containers[name] = entries
+        return entries
+
+def resolve_jobs(container):
+    """Walks the jobs of a container in order, evaluating assignments and option lines.
+
+    Args:
+        container (parser.Container): Container to walk
+
+    Yields:
+        JobConfig: Each job with the options and environment in effect for it.
+    """
+    cfg = JobConfig()
+    cfg.container = container.name
+    for job in container.jobs:
+        if job.assign is not None:
+            if job.assign[0] == "SHELL":
+                cfg.shell = job.assign[1]
+            else:
+                cfg.env[job.assign[0]] = job.assign[1]
+        elif job.prefix == "!":
+            cfg.add_options(job.options)
+        else:
+            jobcfg = cfg.copy()
+            jobcfg.add_options(job.options)
+            jobcfg.job = job
+            yield jobcfg
+
+def build(cfg):
+    """Builds an index of every job in the configuration.
+
+    This must run before reload.generate_crontab, which strips options that are
+    handled by runjob rather than fcron.
+
+    Args:
+        cfg (parser.CronTab): The crontab configuration.
+
+    Returns:
+        JobIndex: The index
+    """
+    index = JobIndex()
+    index.environment = cfg.environment
+    for c in cfg.containers:
+        index.containers[c.name] = build_container(c)
+    return index
+
+def build_container(container):
+    """Builds the index entries for a single container.
+
+    Returns:
+        dict: Map of job hash to index entry
+    """
+    return {jobcfg.job.jobhash(): jobcfg.to_entry() for jobcfg in resolve_jobs(container)}
+
+def write(index, path=None):
+    """Writes the index to a new generation directory, then atomically points the
+    symlink at path (INDEX_FILE by default) to it.  The previous generation is kept
+    for readers that loaded it just before the switch, older ones are removed."""
+    path = path or INDEX_FILE
+    previous = current_generation(path)
+    gen = "{}.{}.{}".format(path, time.time_ns(), os.getpid())
+    os.mkdir(gen)
+    write_blob(os.path.join(gen, ENVIRONMENT_FILE), index.environment)
+    if index.batches:
+        write_blob(os.path.join(gen, BATCHES_FILE), index.batches)
+    for name, entries in index.containers.items():
+        write_blob(os.path.join(gen, container_file(name)), entries)
+
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    os.symlink(os.path.basename(gen), tmp)
+    os.replace(tmp, path)
+    remove_generations(path, keep=(gen, previous))
+
+def load(path=None):
+    """Loads the index (INDEX_FILE by default).  Only the environment is read, the
+    containers are read as they are looked up.
+
+    Returns:
+        JobIndex: The index, or None if it doesn't exist or is from another version.
+    """
+    gen = current_generation(path or INDEX_FILE)
+    if gen is None:
+        return None
+
+    environment = read_blob(os.path.join(gen, ENVIRONMENT_FILE))
+    if environment is None:
+        return None
+
+    index = JobIndex(gen)
+    index.environment = environment
+    return index
+
+def current_generation(path):
+    """Returns the generation directory the symlink at path points to, or None"""
+    try:
+        return os.path.join(os.path.dirname(path), os.readlink(path))
+    except OSError:
+        # Missing, or an index from before generations
+        return None
+
+def remove_generations(path, keep):
+    """Removes generation directories of the index at path other than those in keep"""
+    import shutil
+    dirname, prefix = os.path.split(path)
+    keep = {os.path.basename(k) for k in keep if k is not None}
+    for e in os.scandir(dirname or "."):
+        if e.name.startswith(prefix + ".") and e.name not in keep and e.is_dir(follow_symlinks=False):
+            shutil.rmtree(e.path, ignore_errors=True)
+
+def container_file(name):
+    """Returns the file name of a container's entries within a generation"""
+    return "c." + urllib.parse.quote(name, safe="")
+
+def write_blob(path, value):
+    with open(path, "wb") as f:
+        f.write(marshal.dumps((VERSION, value)))
+
+def read_blob(path):
+    """Returns the value written by write_blob, or None if path doesn't exist or is
+    from another version"""
+    try:
+        with open(path, "rb") as f:
+            version, value = marshal.loads(f.read())
+    except (FileNotFoundError, EOFError, ValueError, TypeError):
+        return None
+    if version != VERSION:
+        return None
+    return value
@@ -15,6 +15,7 @@
 # along with this program; if not, write to the Free Software Foundation,
 # Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
 
+import contextvars
 import logging
 
 def setDefault():
@@ -22,13 +23,21 @@ def setDefault():
     root = logging.getLogger()
     root.setLevel(logging.INFO)
     ch = logging.StreamHandler()
-    fmt = logging.Formatter(fmt="%(asctime)s %(levelname)s [%(name)s] %(message)s", datefmt="%Y-%m-%d %H:%M:%S")
-    ch.setFormatter(fmt)
+    ch.setFormatter(formatter())
     root.addHandler(ch)
 
+def formatter():
+    """Returns the formatter used for log output"""
+    return logging.Formatter(fmt="%(asctime)s %(levelname)s [%(name)s] %(message)s", datefmt="%Y-%m-%d %H:%M:%S")
+
 def setLevel(cfg):
     """Updates the logging level based on the supplied configuration"""
     if "DOCKER_GEN_CRON_DEBUG" in cfg.environment:
         logging.getLogger().setLevel(logging.DEBUG)
 
-setDefault()
+def in_context(fn):
+    """Returns fn wrapped to run in a copy of the calling thread's context, for running on
+    other threads.  Where log records go can depend on the context (see dispatcher), so
+    this keeps a worker's records with those of the thread that handed it work."""
+    ctx = contextvars.copy_context()
+    return lambda *args, **kwargs: ctx.copy().run(fn, *args, **kwargs)
@@ -0,0 +1,245 @@
+# This file is part of docker-gen-cron
+# Copyright (C) 2020 John J. Jordan
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+
+# In-process metrics, exposed in the Prometheus text format by the dispatcher
+# when DOCKER_GEN_CRON_METRICS is set.  Metrics are recorded in whatever
+# process does the work, so only the dispatcher's (and its watcher's) show up.
+
+import bisect
+import logging
+import threading
+
+logger = logging.getLogger("metrics")
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600)
+
+class Metric:
+    """
+    Metric is the base of the metric types: a named family of values, one per
+    combination of label values.
+
+    Attributes:
+        name (str): Metric name
+        help (str): Description
+        labels (tuple): Label names
+    """
+    type = "untyped"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def samples(self):
+        """Yields (suffix, labels, value) for each sample"""
+        with self.lock:
+            values = list(self.values.items())
+        for key, value in sorted(values):
+            yield "", dict(zip(self.labels, key)), value
+
+    def render(self):
+        """Returns the lines of this metric in the text format"""
+        lines = ["# HELP {} {}".format(self.name, self.help), "# TYPE {} {}".format(self.name, self.type)]
+        for suffix, labels, value in self.samples():
+            lines.append("{}{}{} {}".format(self.name, suffix, format_labels(labels), format_value(value)))
+        return lines
+
+    def _key(self, labelvalues):
+        if len(labelvalues) != len(self.labels):
+            raise ValueError("{} expects labels {}".format(self.name, self.labels))
+        return tuple(str(v) for v in labelvalues)
+
+class Counter(Metric):
+    """Counter is a value that only goes up"""
+    type = "counter"
+
+    def inc(self, *labelvalues, amount=1):
+        key = self._key(labelvalues)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, *labelvalues):
+        with self.lock:
+            return self.values.get(self._key(labelvalues), 0)
+
+class Histogram(Metric):
+    """Histogram counts observations in buckets, and keeps their count and sum"""
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DURATION_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labelvalues):
+        key = self._key(labelvalues)
+        with self.lock:
+            h = self.values.get(key)
+            if h is None:
+                h = self.values[key] = [[0] * len(self.buckets), 0, 0.0]
+            i = bisect.bisect_left(self.buckets, value)
+            if i < len(self.buckets):
+                h[0][i] += 1
+            h[1] += 1
+            h[2] += value
+
+    def samples(self):
+        with self.lock:
+            values = [(key, (list(h[0]), h[1], h[2])) for key, h in self.values.items()]
+        for key, (counts, count, total) in sorted(values):
+            labels = dict(zip(self.labels, key))
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                yield "_bucket", dict(labels, le=format_value(bound)), cumulative
+            yield "_bucket", dict(labels, le="+Inf"), count
+            yield "_sum", labels, total
+            yield "_count", labels, count
+
+class Callback(Metric):
+    """Callback is a metric whose value is read from a function when rendered"""
+
+    def __init__(self, name, help, type, fn):
+        super().__init__(name, help)
+        self.type = type
+        self.fn = fn
+
+    def samples(self):
+        yield "", {}, self.fn()
+
+class Registry:
+    """Registry holds the metrics to be rendered"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def register(self, metric):
+        with self.lock:
+            if metric.name in self.metrics:
+                raise ValueError("Duplicate metric {}".format(metric.name))
+            self.metrics[metric.name] = metric
+        return metric
+
+    def unregister(self, name):
+        with self.lock:
+            self.metrics.pop(name, None)
+
+    def render(self):
+        """Returns all metrics in the text format"""
+        with self.lock:
+            metrics = sorted(self.metrics.values(), key=lambda m: m.name)
+        lines = []
+        for m in metrics:
+            lines.extend(m.render())
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+
+def counter(name, help, labels=()):
+    """Creates and registers a Counter"""
+    return REGISTRY.register(Counter(name, help, labels))
+
+def histogram(name, help, labels=(), buckets=DURATION_BUCKETS):
+    """Creates and registers a Histogram"""
+    return REGISTRY.register(Histogram(name, help, labels, buckets))
+
+def callback(name, help, type, fn):
+    """Creates and registers a Callback, replacing any previous one with the same name"""
+    REGISTRY.unregister(name)
+    return REGISTRY.register(Callback(name, help, type, fn))
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, escape(v)) for k, v in labels.items()) + "}"
+
+def format_value(v):
+    if isinstance(v, float):
+        return repr(v)
+    return str(v)
+
+def escape(s):
+    return str(s).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def parse_address(address):
+    """Parses a port or host:port, listening on all addresses by default.
+
+    Returns:
+        tuple: (host, port)
+    """
+    host, sep, port = address.rpartition(":")
+    return host.strip("[]") if sep else "", int(port)
+
+def serve(address):
+    """Serves /metrics on a background thread.
+
+    Args:
+        address (str): Port or host:port to listen on
+
+    Returns:
+        http.server.ThreadingHTTPServer: The server
+    """
+    # Only the dispatcher serves metrics, keep http.server out of runjob's imports
+    import http.server
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        """Serves /metrics"""
+
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = REGISTRY.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+    server = http.server.ThreadingHTTPServer(parse_address(address), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info("Serving metrics on {}".format(address))
+    return server
+
+# Metrics recorded by docker-gen-cron
+DISPATCH_LATENCY = histogram("docker_gen_cron_dispatch_latency_seconds",
+    "Time from fcron firing a job to the docker call that carries it out", ["container", "action"])
+EXEC_DURATION = histogram("docker_gen_cron_exec_duration_seconds",
+    "Duration of job execs, from exec_create until the exit code is known", ["container", "job"])
+EXEC_EXITS = counter("docker_gen_cron_exec_exits_total",
+    "Completed job execs by exit code (or timeout, or error)", ["container", "job", "code"])
+JOBS_WAIT = histogram("docker_gen_cron_jobs_wait_seconds",
+    "Time fires waited for jobs.json to be written, by outcome (ready or timeout)", ["outcome"])
+OUTPUT_DROPPED = counter("docker_gen_cron_output_dropped_bytes_total",
+    "Bytes of job output dropped because the output sinks fell behind", ["container"])
+OUTPUT_BYTES = counter("docker_gen_cron_output_bytes_total",
+    "Bytes of job output relayed", ["container", "stream"])
+OVERLAPS = counter("docker_gen_cron_overlaps_total",
+    "Fires of jobs with the overlap option that found a previous run still going, by action taken (skip, queue, kill, or stale when its lock was broken)",
+    ["container", "job", "action"])
+RELOAD_DURATION = histogram("docker_gen_cron_reload_duration_seconds",
+    "Duration of crontab reloads", ["outcome"])
+RELOADS = counter("docker_gen_cron_reloads_total",
+    "Crontab reloads by outcome (installed, unchanged or failed)", ["outcome"])
+STATE_CACHE = counter("docker_gen_cron_state_cache_total",
+    "Container state lookups by the dispatcher, by result (hit or miss)", ["result"])
@@ -0,0 +1,178 @@
+# This file is part of docker-gen-cron
+# Copyright (C) 2020 John J. Jordan
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+
+# Single-flight locking of jobs with the overlap(...) option.  Each run of such
+# a job holds an flock(2) on a lock file for its container and job id, so
+# runs fired through the dispatcher and by runjob.py on its own see each other.
+# The kernel drops the lock of a process that dies; a lock held for longer than
+# DOCKER_GEN_CRON_STALE_LOCK seconds (a hung run) is broken by the next run.
+
+import fcntl
+import logging
+import os
+import time
+import urllib.parse
+
+import metrics
+import parser
+
+logger = logging.getLogger("overlap")
+
+LOCK_DIR = "/var/run/docker-gen-cron"
+
+# What a run does when the previous run of the job is still going
+SKIP = "skip"
+QUEUE = "queue"
+KILL = "kill"
+POLICIES = (SKIP, QUEUE, KILL)
+
+# Seconds a lock can be held before it is considered stale, when
+# DOCKER_GEN_CRON_STALE_LOCK is not set
+DEFAULT_STALE = 24 * 60 * 60
+
+# Seconds between attempts to take a held lock, doubling from POLL_MIN up to POLL_MAX
+POLL_MIN = 0.05
+POLL_MAX = 1.0
+
+# Seconds to wait for a run sent SIGTERM by kill to finish before sending SIGKILL
+KILL_GRACE = 10
+
+class Lock:
+    """
+    Lock is a held job lock.
+
+    Attributes:
+        path (str): Lock file
+        fd (int): Open lock file, holding the flock
+    """
+    def __init__(self, path, fd):
+        self.path = path
+        self.fd = fd
+
+    def release(self):
+        """Releases the lock.  The file is removed first, so runs waiting on it open a
+        new one rather than locking a file that's gone."""
+        if self.fd is None:
+            return
+        try:
+            if os.stat(self.path).st_ino == os.fstat(self.fd).st_ino:
+                os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        os.close(self.fd)
+        self.fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+def policy(options):
+    """Returns the overlap policy of a job from its options, or None if it has none"""
+    if "overlap" not in options:
+        return None
+    value = options["overlap"] or SKIP
+    if value not in POLICIES:
+        logger.warning("Invalid overlap policy {}, using {}".format(repr(value), SKIP))
+        return SKIP
+    return value
+
+def stale_after(environment):
+    """Returns how many seconds a lock can be held before it is stale"""
+    return parser.setting_int(environment, "DOCKER_GEN_CRON_STALE_LOCK", DEFAULT_STALE)
+
+def lock_path(container, job):
+    """Returns the lock file of a job"""
+    return os.path.join(LOCK_DIR, "{}.{}.lock".format(urllib.parse.quote(container, safe=""), job))
+
+def acquire(container, job, policy, stale=DEFAULT_STALE, kill=None, run=""):
+    """Takes the lock of a job, dealing with a run that holds it according to policy.
+
+    Args:
+        container (str): Container name
+        job (str): Job id
+        policy (str): SKIP to give up, QUEUE to wait for the lock, or KILL to call kill
+            and then wait
+        stale (float): Seconds after which a held lock is broken
+        kill (callable): Called with the signal name ("TERM", then "KILL" if the run is
+            still going after KILL_GRACE) and the run id of the holder, to stop the run
+            holding the lock
+        run (str): Id of this run, kept in the lock file for a later run's kill
+
+    Returns:
+        Lock: The lock, to be released when the run is done, or None if skipped
+    """
+    path = lock_path(container, job)
+    os.makedirs(LOCK_DIR, exist_ok=True)
+    overlapped = False
+    killed = None
+    delay = POLL_MIN
+    while True:
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            st = os.fstat(fd)
+            holder, _, holder_run = os.pread(fd, 128, 0).decode("ascii", "replace").strip().partition(" ")
+            holder = holder or "?"
+            os.close(fd)
+            held = time.time() - st.st_mtime
+            if held > stale:
+                logger.warning("{}: breaking lock of job {} held by runjob {} for {:.0f}s".format(container, job, holder, held))
+                metrics.OVERLAPS.inc(container, job, "stale")
+                break_lock(path, st.st_ino)
+                continue
+
+            if not overlapped:
+                overlapped = True
+                metrics.OVERLAPS.inc(container, job, policy)
+                logger.warning("{}: job {} is still running (runjob {}, for {:.0f}s), {}".format(container, job, holder, held,
+                    {SKIP: "skipping this run", QUEUE: "waiting for it", KILL: "stopping it"}[policy]))
+            if policy == SKIP:
+                return None
+            if policy == KILL and kill is not None:
+                if killed is None:
+                    kill("TERM", holder_run)
+                    killed = time.monotonic()
+                elif killed > 0 and time.monotonic() - killed > KILL_GRACE:
+                    kill("KILL", holder_run)
+                    killed = 0
+            time.sleep(delay)
+            delay = min(delay * 2, POLL_MAX)
+            continue
+
+        # The holder may have removed the file between our open and flock
+        try:
+            same = os.stat(path).st_ino == os.fstat(fd).st_ino
+        except FileNotFoundError:
+            same = False
+        if not same:
+            os.close(fd)
+            continue
+
+        os.ftruncate(fd, 0)
+        os.pwrite(fd, "{} {}\n".format(os.getpid(), run).encode("ascii"), 0)
+        return Lock(path, fd)
+
+def break_lock(path, ino):
+    """Removes a stale lock file, unless it has been replaced already"""
+    try:
+        if os.stat(path).st_ino == ino:
+            os.unlink(path)
+    except FileNotFoundError:
+        pass
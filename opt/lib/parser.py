@@ -23,6 +23,30 @@ import re
 JOB_FILE = "/var/etc/jobs.json"
 logger = logging.getLogger("parser")
 
+# Patterns used by the parser
+_INT = re.compile(r"\s*[+-]?\d+(?:_\d+)*\s*")
+_ASSIGN = re.compile(r"[a-zA-Z]\w*\s*=")
+_OPTIONS = re.compile(r"(([a-zA-Z][a-zA-Z0-9]+)(\([^\)\s]+\))?,)*([a-zA-Z][a-zA-Z0-9]+)(\([^\)\s]+\))?")
+_OPTION = re.compile(r"([a-zA-Z][a-zA-Z0-9]+)(?:\(([^\)\s]+)\))?")
+_INPUT = re.compile(r"(?:[^\\%]|\\.)*%", re.S)
+# Each field must be followed by whitespace or the end of the line
+_FIELDS = [re.compile(r"(?:\S+(?:\s+|\Z)){%d}" % n) for n in range(6)]
+
+# Variables from the cron container's environment that are passed along in CronTab.environment
+SETTINGS = [
+    "DOCKER_GEN_CRON_DEBUG",
+    "DOCKER_GEN_CRON_MAX_CONCURRENT",
+    "DOCKER_GEN_CRON_MAX_PER_CONTAINER",
+    "DOCKER_GEN_CRON_JITTER",
+    "DOCKER_GEN_CRON_BATCH",
+    "DOCKER_GEN_CRON_OUTPUT",
+    "DOCKER_GEN_CRON_OUTPUT_DIR",
+    "DOCKER_GEN_CRON_HISTORY",
+    "DOCKER_GEN_CRON_STALE_LOCK",
+    "DOCKER_GEN_CRON_STATE_TTL",
+    "DOCKER_GEN_CRON_PROFILE_STARTUP",
+]
+
 class CronTab:
     """
     CronTab represents configuration extracted from environment variables on docker containers.
@@ -31,6 +55,8 @@ class CronTab:
         containers (list): List of Container objects
         environment (dict): Environment variables supplied to docker-gen specific to docker-gen-cron
     """
+    __slots__ = ("containers", "environment")
+
     def __init__(self):
         self.containers = []
         self.environment = {}
@@ -47,6 +73,8 @@ class Container:
         start_jobs (list): List of start jobs specified in the container environment
         restart_jobs (list): List of restart jobs specified in the container environment
     """
+    __slots__ = ("name", "running", "options", "jobs", "start_jobs", "restart_jobs")
+
     def __init__(self):
         self.name = None
         self.running = False
@@ -72,6 +100,8 @@ class Job:
         start (bool): Whether this is a job to start the container
         restart (bool): Whether this is a job to restart the container
     """
+    __slots__ = ("container", "index", "orig", "options", "assign", "prefix", "timespec", "cmd", "input", "start", "restart")
+
     def __init__(self):
         self.container = None
         self.index = 0
@@ -119,37 +149,37 @@ class Job:
 class Options:
     """
     Options is a dict-like object backed by an associative list.  Allows duplicates and maintains
-    original item order.
+    original item order.  Lookups go through an index of the positions of each key, with the
+    last occurrence winning.
     """
+    __slots__ = ("_items", "_index")
+
     def __init__(self):
         self._items = []
+        self._index = {}
 
     def __getitem__(self, key):
-        for i in range(len(self._items) - 1, -1, -1):
-            if self._items[i][0] == key:
-                return self._items[i][1]
-        raise KeyError
+        return self._items[self._index[key][-1]][1]
 
     def __setitem__(self, key, value):
-        for i in range(len(self._items) - 1, -1, -1):
-            if self._items[i][0] == key:
-                self._items[i] = (key, value)
-                return
-        self._items.append((key, value))
+        pos = self._index.get(key)
+        if pos is not None:
+            self._items[pos[-1]] = (key, value)
+        else:
+            self._index[key] = [len(self._items)]
+            self._items.append((key, value))
 
     def __delitem__(self, key):
-        for i in range(len(self._items) - 1, -1, -1):
-            if self._items[i][0] == key:
-                self._items.pop(i)
+        if key not in self._index:
+            return
+        self._items = [item for item in self._items if item[0] != key]
+        self._reindex()
 
     def __iter__(self):
-        return self._items.map(lambda x: x[0])
+        return (k for k, _ in self._items)
 
     def __contains__(self, key):
-        for k, v in self._items:
-            if k == key:
-                return True
-        return False
+        return key in self._index
 
     def __repr__(self):
         return repr({k: v for k, v in self._items})
@@ -161,20 +191,29 @@ class Options:
         return self._items[:]
 
     def has_any(self, *options):
+        index = self._index
         for opt in options:
-            if opt in self:
+            if opt in index:
                 return True
         return False
 
+    def _reindex(self):
+        self._index = {}
+        for i, (k, _) in enumerate(self._items):
+            self._index.setdefault(k, []).append(i)
+
 def parse_crontab():
     """Parses the crontab from a jobs.json output file
 
     Returns:
         CronTab: Crontabs of all containers in jobs.json
     """
+    return parse_crontab_json(load_crontab_json())
+
+def load_crontab_json():
+    """Loads the jobs.json output file without parsing any crontabs"""
     with open(JOB_FILE, "r") as f:
-        j = json.load(f)
-    return parse_crontab_json(j)
+        return json.load(f)
 
 def parse_crontab_json(j):
     """Parses the crontab from the specified parsed JSON.
@@ -184,24 +223,52 @@ def parse_crontab_json(j):
     """
     result = CronTab()
     for cj in j["containers"]:
-        if cj is None: continue
-        kvs = [(e["key"], e["cmd"]) for e in cj["envs"] if e is not None]
-        if len(kvs) == 0:
-            continue
-
-        container = Container()
-        container.name = cj["name"]
-        container.running = cj["running"]
-        parse_container(container, kvs)
-        result.containers.append(container)
-
-    keys = ["DOCKER_GEN_CRON_DEBUG"]
-    result.environment = {k: v for k, v in j["env"].items() if k in keys}
+        container = parse_container_json(cj)
+        if container is not None:
+            result.containers.append(container)
 
+    result.environment = parse_environment(j)
     result.containers.sort(key=lambda c: c.name)
 
     return result
 
+def container_envs(cj):
+    """Returns the (key, cmd) pairs of a container from jobs.json"""
+    return [(e["key"], e["cmd"]) for e in cj["envs"] if e is not None]
+
+def parse_container_json(cj):
+    """Parses a single container from jobs.json.
+
+    Returns:
+        Container: The container, or None if it has no crontab entries.
+    """
+    if cj is None:
+        return None
+    kvs = container_envs(cj)
+    if len(kvs) == 0:
+        return None
+
+    container = Container()
+    container.name = cj["name"]
+    container.running = cj["running"]
+    parse_container(container, kvs)
+    return container
+
+def parse_environment(j):
+    """Extracts the docker-gen-cron settings from the environment in jobs.json"""
+    return {k: v for k, v in j["env"].items() if k in SETTINGS}
+
+def setting_int(environment, key, default=0):
+    """Returns an integer setting from CronTab.environment, or default if it is unset or invalid"""
+    v = environment.get(key)
+    if v is None:
+        return default
+    try:
+        return int(v)
+    except ValueError:
+        logger.warning("Ignoring invalid {}: {}".format(key, repr(v)))
+        return default
+
 def parse_container(c, e):
     """Parses the crontabs for the specified environment variables.
 
@@ -209,10 +276,21 @@ def parse_container(c, e):
         c (Container): Container object to write to
         e (dict): Environment variables for container
     """
-    jobs = [(int(k), v) for k, v in e if is_int(k)]
-    startJobs = [(int(trim_prefix("START_", k)), v) for k, v in e if k.startswith("START_") and is_int(trim_prefix("START_", k))]
-    restartJobs = [(int(trim_prefix("RESTART_", k)), v) for k, v in e if k.startswith("RESTART_") and is_int(trim_prefix("RESTART_", k))]
-    c.options = {k: v for k, v in e if not is_int(k) and not k.startswith("START_") and not k.startswith("RESTART_")}
+    jobs = []
+    startJobs = []
+    restartJobs = []
+    c.options = {}
+    for k, v in e:
+        if is_int(k):
+            jobs.append((int(k), v))
+        elif k.startswith("START_"):
+            if is_int(k[6:]):
+                startJobs.append((int(k[6:]), v))
+        elif k.startswith("RESTART_"):
+            if is_int(k[8:]):
+                restartJobs.append((int(k[8:]), v))
+        else:
+            c.options[k] = v
 
     for i, j in sorted(jobs):
         job = parse_job(j)
@@ -239,7 +317,11 @@ def parse_container(c, e):
                 c.restart_jobs.append(job)
 
 def parse_job(j):
-    """Parses the job string into a Job object."""
+    """Parses the job string into a Job object.
+
+    The line is scanned once from left to right: prefix, options, timespec fields and
+    finally the command and its input.
+    """
     job = Job()
     job.orig = j
 
@@ -253,83 +335,49 @@ def parse_job(j):
     # We'll add this back at the end after we've gotten past the point where stuff will be
     # written back out nearly unchanged.
     postlf = ""
-    if "\n" in j:
-        idx = j.index("\n")
+    idx = j.find("\n")
+    if idx >= 0:
         postlf, j = j[idx:], j[:idx]
 
     # If this looks like an assignment, then handle it and go
-    m = re.match(r"[a-zA-Z]\w*\s*=", j)
-    if m is not None:
-        k, v = j.split("=", 2)
+    if _ASSIGN.match(j) is not None:
+        k, _, v = j.partition("=")
         k = k.strip()
         v = v.strip()
-        if (v.startswith('"') and v.endswith('"')) or (v.startswith("'") and v.endswith("'")):
+        if len(v) >= 2 and v[0] == v[-1] and v[0] in "\"'":
             v = v[1:-1]
 
         job.assign = (k, v)
         return job
 
     # Gather prefix
+    pos = 0
     if len(j) > 0 and j[0] in "%@!&":
         job.prefix = j[0]
-        j = j[1:]
+        pos = 1
 
-    # Find end of options
-    m = re.match(r"(([a-zA-Z][a-zA-Z0-9]+)(\([^\)\s]+\))?,)*([a-zA-Z][a-zA-Z0-9]+)(\([^\)\s]+\))?", j)
+    # Options, if any
+    m = _OPTIONS.match(j, pos)
     if m is not None:
-        # Parse them.
-        last = m.end()
-        ok = parse_options(job, j[:last])
-        if not ok:
-            # error
-            return None
-        j = j[last:]
+        for o in _OPTION.finditer(j, pos, m.end()):
+            job.options[o.group(1)] = o.group(2)
+        pos = m.end()
 
     if job.prefix == "!":
         # Options set only, we're done.
         return job
 
     # Parse the timespec
-    j, ok = parse_timespec(job, j)
+    rest, ok = parse_timespec(job, j[pos:])
     if not ok:
         # We didn't get enough fields.
         return None
 
     # This only leaves the command.
-    job.cmd, job.input = split_input(j + postlf)
+    job.cmd, job.input = split_input(rest + postlf)
 
     return job
 
-def parse_options(job, options):
-    """Parses fcron options into the specified job."""
-    i = 0
-    while i < len(options):
-        nextComma = options.find(",", i)
-        nextParen = options.find("(", i)
-        arg = None
-
-        if nextParen >= 0 and ((nextComma >= 0 and nextParen < nextComma) or (nextComma < 0)):
-            # We have an argument to consume.
-            endParen = options.find(")", i)
-            if endParen < 0:
-                logger.warning("Unmatched '('")
-                return False
-            job.options[options[i:nextParen]] = options[nextParen + 1:endParen]
-            nextComma = options.find(",", endParen)
-            if nextComma < 0:
-                break
-            i = nextComma + 1
-        elif nextComma < 0:
-            # Just a name to the end
-            job.options[options[i:]] = None
-            break
-        else:
-            # Just a name to the comma
-            job.options[options[i:nextComma]] = None
-            i = nextComma + 1
-
-    return True
-
 def parse_timespec(job, line):
     """Parses the timespec into the specified job.
 
@@ -391,18 +439,12 @@ def split_input(line):
         str: The command
         str: The input or None
     """
-    i = 0
-    bslash = False
-    while i < len(line):
-        c = line[i]
-        if bslash:
-            bslash = False
-        elif c == "\\":
-            bslash = True
-        elif c == "%":
-            # Start of input!
+    if "%" in line:
+        # Find the first % that isn't escaped with a backslash
+        m = _INPUT.match(line)
+        if m is not None:
+            i = m.end() - 1
             return line[:i].strip(), line[i+1:].replace("%", "\n")
-        i += 1
 
     # We didn't find input character.
     return line.strip(), None
@@ -420,41 +462,17 @@ def take_fields(line, n):
         bool: Whether at least n fields were found
     """
     line = line.lstrip()
-    i = 0
-    taken = 0
-    for _ in range(n):
-        last = i
-        # Read non-whitespace
-        while i < len(line) and not line[i].isspace():
-            i += 1
-        # Read whitespace
-        while i < len(line) and line[i].isspace():
-            i += 1
-        if i > last:
-            taken += 1
-
-    return line[:i].rstrip(), line[i:], (taken == n)
-
-def trim_prefix(pfx, s):
-    """Trims a prefix from a string if the string starts with that prefix.
-
-    Args:
-        pfx (str): Prefix
-        s (str): String
+    m = _FIELDS[n].match(line) if n < len(_FIELDS) else re.compile(r"(?:\S+(?:\s+|\Z)){%d}" % n).match(line)
+    if m is None:
+        # Fewer than n fields, take everything
+        return line.rstrip(), "", False
 
-    Returns:
-        str: s with the specified prefix removed if it is a prefix. Otherwise,
-            s is returned.
-    """
-    return s[len(pfx):] if s.startswith(pfx) else s
+    i = m.end()
+    return line[:i].rstrip(), line[i:], True
 
 def is_int(s):
     """Returns true if the specified string is an integer."""
-    try:
-        int(s)
-        return True
-    except ValueError:
-        return False
+    return _INT.fullmatch(s) is not None
 
 def print_job(j):
     print("prefix=" + j.prefix)
@@ -16,20 +16,394 @@
 # along with this program; if not, write to the Free Software Foundation,
 # Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
 
+import collections
+import hashlib
+import json
 import logging
+import os
 import subprocess
+import threading
+import time
 
+import jobindex
+import metrics
 import parser
 import logconfig
 
 logger = logging.getLogger("reload")
 USER = "nobody"
+CACHE_FILE = "/var/etc/reload.cache"
+CACHE_VERSION = 2
+
+# Settings passed to jobs through the crontab, for runjob to see before it loads jobs.json
+HEADER_SETTINGS = ["DOCKER_GEN_CRON_PROFILE_STARTUP"]
+
+# Debounce bounds for Scheduler, in seconds.  The quiet period grows from MIN_DELAY by
+# MIN_DELAY per event/s seen over RATE_WINDOW, up to MAX_DELAY, and no change waits
+# longer than MAX_WAIT.
+MIN_DELAY = 0.25
+MAX_DELAY = 5.0
+MAX_WAIT = 20.0
+RATE_WINDOW = 10.0
 
 def main():
-    cfg = parser.parse_crontab()
-    logconfig.setLevel(cfg)
-    crontab, lirefs = generate_crontab(cfg)
-    return install_crontab(crontab, lirefs)
+    # Hand the reload to the dispatcher if it's running, it coalesces bursts
+    import dispatcher
+    if dispatcher.request_reload():
+        logger.debug("Reload queued with dispatcher")
+        return True
+    return Reloader().reload(parser.load_crontab_json())
+
+class Reloader:
+    """
+    Reloader generates and installs the crontab incrementally.  The output for each
+    container is cached (in memory and in CACHE_FILE) under a digest of its entry in
+    jobs.json, so only containers that changed are parsed and regenerated, and
+    fcrontab isn't run at all when the result matches what was last installed.
+
+    Attributes:
+        cache_file (str): Where the cache is persisted between runs, or None
+        sections (dict): Map of container name to its cached section
+        installed (str): Digest of the last crontab installed successfully
+    """
+    def __init__(self, cache_file=CACHE_FILE):
+        self.cache_file = cache_file
+        self.sections = {}
+        self.installed = None
+        self.load()
+
+    def load(self):
+        """Loads the cache from disk, if there is one"""
+        if self.cache_file is None:
+            return
+        try:
+            with open(self.cache_file, "r") as f:
+                j = json.load(f)
+        except FileNotFoundError:
+            return
+        except ValueError:
+            logger.warning("Ignoring corrupt cache {}".format(self.cache_file))
+            return
+
+        if j.get("version") == CACHE_VERSION:
+            self.sections = j["sections"]
+            self.installed = j["installed"]
+
+    def save(self):
+        """Atomically writes the cache to disk"""
+        if self.cache_file is None:
+            return
+        tmp = "{}.{}.tmp".format(self.cache_file, os.getpid())
+        with open(tmp, "w") as f:
+            json.dump({"version": CACHE_VERSION, "installed": self.installed, "sections": self.sections}, f)
+        os.replace(tmp, self.cache_file)
+
+    def reload(self, j):
+        """Generates and installs the crontab for the specified jobs.json contents.
+
+        Args:
+            j (dict): Parsed jobs.json
+
+        Returns:
+            bool: Whether the crontab is up-to-date
+        """
+        started = time.monotonic()
+        cfg = parser.CronTab()
+        cfg.environment = parser.parse_environment(j)
+        logconfig.setLevel(cfg)
+
+        sections, regenerated = self.update_sections(j)
+        batches, batched = {}, {}
+        if parser.setting_int(cfg.environment, "DOCKER_GEN_CRON_BATCH") > 0:
+            batches, batched = group_batches(sections)
+
+        index = jobindex.JobIndex()
+        index.environment = cfg.environment
+        crontab = generate_header(cfg.environment)
+        lirefs = {}
+        for name, section in sections:
+            lines, refs = section["lines"], section["refs"]
+            if name in batched:
+                lines, refs = omit_lines(lines, refs, batched[name])
+            for offset, kind, i, orig in refs:
+                lirefs[len(crontab) + offset] = ref_job(name, kind, i, orig)
+            crontab.extend(lines)
+            index.containers[name] = section["index"]
+        if batches:
+            crontab.extend(generate_batches(batches))
+            index.batches = {id: entries for id, (schedule, entries) in batches.items()}
+
+        m = hashlib.sha256()
+        m.update(json.dumps(cfg.environment, sort_keys=True).encode("utf-8"))
+        m.update(json.dumps(index.batches, sort_keys=True).encode("utf-8"))
+        m.update("\n".join(crontab).encode("utf-8"))
+        digest = m.hexdigest()
+
+        logger.debug("Regenerated {} of {} containers".format(regenerated, len(sections)))
+        if digest == self.installed:
+            logger.info("Crontab up-to-date, no change needed")
+            if regenerated > 0:
+                self.save()
+            record_reload("unchanged", started)
+            return True
+
+        # Write the index first: any line fcron can fire once the crontab is installed
+        # must already be in it.  runjob falls back to parsing jobs.json for anything
+        # it can't find, which covers lines left over if the install fails.
+        jobindex.write(index)
+        ok = install_crontab(crontab, lirefs)
+        self.installed = digest if ok else None
+        self.save()
+        record_reload("installed" if ok else "failed", started)
+        return ok
+
+    def update_sections(self, j):
+        """Brings the cached section of each container in jobs.json up-to-date.
+
+        Args:
+            j (dict): Parsed jobs.json
+
+        Returns:
+            list: (name, section) for each container with crontab entries, sorted by name
+            int: The number of sections that had to be regenerated
+        """
+        sections = {}
+        regenerated = 0
+        for cj in j["containers"]:
+            if cj is None:
+                continue
+            kvs = parser.container_envs(cj)
+            if len(kvs) == 0:
+                continue
+
+            name = cj["name"]
+            digest = hashlib.sha256(json.dumps([cj["running"], kvs]).encode("utf-8")).hexdigest()
+            section = self.sections.get(name)
+            if section is None or section["digest"] != digest:
+                section = generate_section(parser.parse_container_json(cj))
+                section["digest"] = digest
+                regenerated += 1
+            sections[name] = section
+
+        self.sections = sections
+        return sorted(sections.items()), regenerated
+
+class Scheduler:
+    """
+    Scheduler coalesces bursts of change notifications into as few reloads as possible.
+    After a notification it waits for a quiet period before reloading, which adapts to
+    the rate of notifications: short when things are quiet, longer during a storm
+    (e.g. a rolling deploy), but never more than MAX_WAIT after the first pending
+    notification.  Reloads run one at a time on the thread calling run().
+
+    Args:
+        apply (callable): Performs a reload, given the set of keys passed to notify
+        clock (callable): Returns the current time in seconds, time.monotonic by default
+
+    Attributes:
+        reloads (int): Number of reloads run
+        events (int): Number of notifications received
+        coalesced (int): Number of notifications that didn't need a reload of their own
+        apply_seconds (float): Total time from first pending notification to reload completion
+        last_apply_seconds (float): The same, for the last reload
+    """
+    def __init__(self, apply, min_delay=MIN_DELAY, max_delay=MAX_DELAY, max_wait=MAX_WAIT, clock=time.monotonic):
+        self.apply = apply
+        self.clock = clock
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.max_wait = max_wait
+        self.cond = threading.Condition()
+        self.lock = threading.Lock()
+        self.pending = set()
+        self.count = 0
+        self.first = None
+        self.last = None
+        self.history = collections.deque()
+        self.reloads = 0
+        self.events = 0
+        self.coalesced = 0
+        self.apply_seconds = 0.0
+        self.last_apply_seconds = 0.0
+
+    def notify(self, key=None):
+        """Requests a reload, key is passed along to apply"""
+        now = self.clock()
+        with self.cond:
+            self.pending.add(key)
+            self.count += 1
+            self.events += 1
+            if self.first is None:
+                self.first = now
+            self.last = now
+            self.history.append(now)
+            self.cond.notify_all()
+
+    def delay(self, now=None):
+        """Returns the current quiet period, based on the recent notification rate"""
+        now = self.clock() if now is None else now
+        while self.history and self.history[0] < now - RATE_WINDOW:
+            self.history.popleft()
+        rate = len(self.history) / RATE_WINDOW
+        return min(self.max_delay, self.min_delay * (1 + rate))
+
+    def wait(self, timeout=None):
+        """Waits for a burst of notifications to end.
+
+        Returns:
+            set: The keys notified, or None on timeout
+            int: The number of notifications
+            float: When the first of them arrived
+        """
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.first is not None, timeout):
+                return None, 0, None
+            while True:
+                now = self.clock()
+                due = self.due(now)
+                if now >= due:
+                    break
+                self.cond.wait(due - now)
+
+            keys, count, first = self.pending, self.count, self.first
+            self.pending = set()
+            self.count = 0
+            self.first = None
+            self.last = None
+            return keys, count, first
+
+    def due(self, now=None):
+        """Returns when the pending notifications should be applied.  Must be called with
+        cond held, while notifications are pending."""
+        return min(self.last + self.delay(now), self.first + self.max_wait)
+
+    def run_once(self, timeout=None):
+        """Waits for notifications and runs a single reload for all of them.
+
+        Returns:
+            bool: Whether a reload ran
+        """
+        keys, count, first = self.wait(timeout)
+        if keys is None:
+            return False
+
+        with self.lock:
+            try:
+                self.apply(keys)
+            except:
+                logger.exception("Reload failed")
+            elapsed = self.clock() - first
+
+        with self.cond:
+            self.reloads += 1
+            self.coalesced += count - 1
+            self.apply_seconds += elapsed
+            self.last_apply_seconds = elapsed
+        logger.debug("Reload {} applied {} changes {:.3f}s after the first".format(self.reloads, count, elapsed))
+        return True
+
+    def run(self):
+        """Runs reloads forever"""
+        while True:
+            self.run_once()
+
+    def stats(self):
+        """Returns the counters as a dict"""
+        with self.cond:
+            return {
+                "reloads": self.reloads,
+                "events": self.events,
+                "coalesced": self.coalesced,
+                "apply_seconds": self.apply_seconds,
+                "last_apply_seconds": self.last_apply_seconds,
+            }
+
+def record_reload(outcome, started):
+    """Records the outcome and duration of a reload in metrics"""
+    metrics.RELOADS.inc(outcome)
+    metrics.RELOAD_DURATION.observe(time.monotonic() - started, outcome)
+
+def generate_section(container):
+    """Generates the cacheable output of a single container.
+
+    Args:
+        container (parser.Container): The container
+
+    Returns:
+        dict: The crontab lines ("lines"), references from lines to jobs ("refs"), the
+            job index entries ("index") of the container, and the line, kind and
+            schedule of each start/restart line ("batch"), for group_batches.
+    """
+    # Index first, generation strips options only runjob understands
+    index = jobindex.build_container(container)
+    lines, lirefs = generate_container(container)
+    refs = [[line, job_kind(job), job.index, job.orig] for line, job in sorted(lirefs.items())]
+    # Option lines and assignments apply to the entries after them in the section, which
+    # a batch line wouldn't get, so only plain start/restart sections are batched
+    modified = {job_kind(job) for job in lirefs.values() if job.prefix == "!" or job.assign is not None}
+    # The schedule is everything before " <name> start"
+    batch = [[line, kind, lines[line - 1].rsplit(" ", 2)[0]] for line, kind, _, _ in refs
+        if kind != "job" and kind not in modified]
+    return {"lines": lines, "refs": refs, "index": index, "batch": batch}
+
+def group_batches(sections):
+    """Groups the start/restart lines of containers that share a schedule into batches,
+    which fire as a single line (see runjob.run_batch).
+
+    Args:
+        sections (list): (name, section) for each container, from Reloader.update_sections
+
+    Returns:
+        dict: Map of batch id to (schedule, [[container name, action], ...])
+        dict: Map of container name to the set of its section lines moved into a batch
+    """
+    groups = collections.defaultdict(list)
+    for name, section in sections:
+        for line, kind, schedule in section["batch"]:
+            groups[schedule].append((name, kind, line))
+
+    batches = {}
+    batched = collections.defaultdict(set)
+    for schedule, members in groups.items():
+        if len({name for name, _, _ in members}) < 2:
+            continue
+        id = hashlib.sha256(schedule.encode("utf-8")).hexdigest()[0:12]
+        batches[id] = (schedule, [[name, kind] for name, kind, _ in members])
+        for name, _, line in members:
+            batched[name].add(line)
+    return batches, batched
+
+def generate_batches(batches):
+    """Generates the crontab lines of the batches from group_batches"""
+    output = ["# Batches", "!reset,stdout(true),mail(false)"]
+    for id, (schedule, entries) in sorted(batches.items(), key=lambda b: b[1][0]):
+        output.append("{} {} {}".format(schedule, jobindex.BATCH, id))
+    return output
+
+def omit_lines(lines, refs, omit):
+    """Returns the lines and refs of a section without the (1-indexed) lines in omit"""
+    kept = []
+    moved = {}
+    for i, line in enumerate(lines, 1):
+        if i not in omit:
+            kept.append(line)
+            moved[i] = len(kept)
+    return kept, [[moved[r[0]]] + r[1:] for r in refs if r[0] in moved]
+
+def ref_job(name, kind, index, orig):
+    """Creates a stand-in Job for a cached line reference, for error reporting"""
+    job = parser.Job()
+    job.container = parser.Container()
+    job.container.name = name
+    job.index = index
+    job.orig = orig
+    job.start = kind == "start"
+    job.restart = kind == "restart"
+    return job
+
+def job_kind(job):
+    """Returns the kind of job: start, restart or job"""
+    return "start" if job.start else "restart" if job.restart else "job"
 
 def generate_crontab(cfg):
     """Generates a crontab file from the specified config.
@@ -41,33 +415,72 @@ def generate_crontab(cfg):
         list: A list of the lines of the output crontab.
         dict: A map of lines in the output (1-indexed) to input Job objects.
     """
-    output = []
+    output = generate_header(cfg.environment)
     lirefs = {}
     for c in cfg.containers:
-        output.append("# Container {name}".format(name=c.name))
-        colls = [c.start_jobs, c.restart_jobs]
-        if c.running:
-            colls.append(c.jobs)
-        for coll in colls:
-            if len(coll) == 0: continue
-
-            output.append("!reset,stdout(true),mail(false)")
-            for j in coll:
-                if not filter_options(j):
-                    continue
-
-                if not j.is_empty():
-                    output.append(serialize_job(j))
-                    lirefs[len(output)] = j
+        lines, refs = generate_container(c)
+        for line, job in refs.items():
+            lirefs[len(output) + line] = job
+        output.extend(lines)
+
+    return output, lirefs
+
+def generate_header(environment):
+    """Generates the crontab lines that precede the container sections.
+
+    Args:
+        environment (dict): Settings from parser.parse_environment
+
+    Returns:
+        list: Environment assignments for settings runjob needs before it loads its
+            configuration, which fcron passes to every job.
+    """
+    output = []
+    for key in HEADER_SETTINGS:
+        value = environment.get(key)
+        if value:
+            output.append('{}="{}"'.format(key, sanitize_cmd(value).replace('"', '')))
+    return output
+
+def generate_container(c):
+    """Generates the crontab lines of a single container.
+
+    Args:
+        c (parser.Container): The container.
+
+    Returns:
+        list: A list of the lines of the container's section of the crontab.
+        dict: A map of lines in the section (1-indexed) to input Job objects.
+    """
+    output = ["# Container {name}".format(name=c.name)]
+    lirefs = {}
+    colls = [c.start_jobs, c.restart_jobs]
+    if c.running:
+        colls.append(c.jobs)
+    for coll in colls:
+        if len(coll) == 0: continue
+
+        output.append("!reset,stdout(true),mail(false)")
+        for j in coll:
+            if not filter_options(j):
+                continue
+
+            if not j.is_empty():
+                output.append(serialize_job(j))
+                lirefs[len(output)] = j
 
     return output, lirefs
 
 def filter_options(job):
     """Removes options from the input Job that are not supported."""
     optcount = len(job.options)
-    for opt in ["n", "nice", "runas"]:
+    for opt in ["n", "nice", "runas", "stdin", "timeout"]:
         if opt in job.options:
             del job.options[opt]
+    if "overlap" in job.options:
+        # runjob applies the overlap policy, so fcron must not hold back the fire itself
+        del job.options["overlap"]
+        job.options["exesev"] = "true"
     if job.assign is not None:
         if job.assign[0] == "SHELL":
             return False
@@ -164,7 +577,7 @@ def install_crontab(crontab, lirefs):
                 if num in lirefs:
                     job = lirefs[num]
                     xformed = crontab[num - 1]
-                    t = "start" if job.start else "restart" if job.restart else "job"
+                    t = job_kind(job)
                     logger.warning("Syntax error in {}:{} {}\nOriginal line: {}\nTransformed line: {}"
                         .format(job.container.name, t, job.index, job.orig, xformed))
                 else:
@@ -177,4 +590,5 @@ def install_crontab(crontab, lirefs):
 
 if __name__ == "__main__":
     import sys
+    logconfig.setDefault()
     sys.exit(0 if main() else 1)
@@ -16,57 +16,201 @@
 # along with this program; if not, write to the Free Software Foundation,
 # Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
 
-import docker
+import contextlib
+import functools
+import hashlib
+import io
 import logging
 import os
 import sys
 import time
 
-import exec
+import dockerapi
+import jobindex
+import metrics
 import parser
 import logconfig
 
 logger = logging.getLogger("runjob")
 
+# Files for the stdin(...) option are read from here
+STDIN_DIR = "/stdin"
+
+# Set by /opt/bin/runjob to the time (seconds since the epoch) fcron fired the job
+FIRED_VAR = "DOCKER_GEN_CRON_FIRED"
+
+# runjob arguments that print the recent output of a container's jobs, followed by the
+# container name and optionally a job id.  See sinks.recent.
+OUTPUT = "--output"
+
+# runjob arguments that summarize the run history of a container's jobs, followed by the
+# container name and optionally a job id.  See history.summarize.
+HISTORY = "--history"
+
+# Label of containers listing (comma separated) the containers they depend on.  A batch
+# starts or restarts a container's dependencies before the container itself.
+DEPENDS_LABEL = "docker-gen-cron.depends-on"
+
+# Seconds fires wait for jobs.json to be written at startup
+JOBS_TIMEOUT = 30
+
+# When set, runjob logs how long each stage of its startup took
+PROFILE_VAR = "DOCKER_GEN_CRON_PROFILE_STARTUP"
+
+# File in the target container that a job which may need to be stopped writes its process
+# group id to, formatted with the job id and the id of the run
+PIDFILE = "/tmp/docker-gen-cron.{}.{}.pid"
+
+# Runs a job ("$@" after the inner script) in a new process group, with setsid where the
+# container has it, so that signal_job reaches any processes the job starts.  The group
+# leader writes its pid to the pid file "$0", which is removed when the job exits.
+TRACK_SCRIPT = ('inner=$1; shift; s=; command -v setsid >/dev/null 2>&1 && s=setsid; '
+    '$s /bin/sh -c "$inner" "$0" "$@"; c=$?; rm -f "$0"; exit $c')
+TRACK_INNER = 'echo $$ > "$0" 2>/dev/null; exec "$@"'
+
+# Signals ("$1") the process group in the pid file "$0", or just the process if it
+# isn't a group leader, i.e. the container has no setsid
+SIGNAL_SCRIPT = 'kill -s "$1" -- "-$(cat "$0")" 2>/dev/null || kill -s "$1" "$(cat "$0")"'
+
 def main(container_name, action, jobid = None):
+    profile = StartupProfile(os.environ)
+    profile.mark("interpreter and imports")
+
     if not wait_for_jobs():
         logger.critical("Cannot load jobs file, aborting")
         return False
 
-    cfg = parser.parse_crontab()
+    cfg = load_config()
     logconfig.setLevel(cfg)
+    profile.mark("configuration loaded")
 
     logger.debug("uid={uid}, gid={gid}, euid={euid}, egid={egid}".format(uid=os.getuid(), gid=os.getgid(), euid=os.geteuid(), egid=os.getegid()))
 
-    client = docker.from_env()
+    delay = jitter(cfg, container_name, action, jobid)
+    if delay > 0:
+        logger.debug("Delaying {:.3f}s for jitter".format(delay))
+        time.sleep(delay)
+
+    client = dockerapi.Client()
+    profile.mark("first docker API call")
+    return dispatch(client, cfg, container_name, action, jobid)
+
+class StartupProfile:
+    """
+    StartupProfile logs startup milestones when PROFILE_VAR is set.  Times are
+    relative to when fcron fired the job, or to the first milestone if that is unknown.
+
+    Attributes:
+        enabled (bool): Whether to log milestones
+        base (float): Time milestones are relative to, or None before the first
+    """
+    def __init__(self, env):
+        self.enabled = bool(env.get(PROFILE_VAR))
+        try:
+            self.base = float(env[FIRED_VAR])
+        except (KeyError, ValueError):
+            self.base = None
+
+    def mark(self, milestone):
+        if not self.enabled:
+            return
+        now = time.time()
+        if self.base is None:
+            self.base = now
+        logger.info("Startup: {} after {:.1f}ms".format(milestone, (now - self.base) * 1000))
+
+def dispatch(client, cfg, container_name, action, jobid = None, env = None, stdout=None, stderr=None, slot=contextlib.nullcontext):
+    """Performs the requested action against a container.
+
+    Args:
+        client (dockerapi.Client): Docker client
+        cfg (jobindex.JobIndex/parser.CronTab): Job index or crontab configuration
+        container_name (str): Name of the target container, or jobindex.BATCH, OUTPUT or HISTORY
+        action (str): One of "start", "restart" or "job", or the batch id or container name
+        jobid (str): Job id, for the "job" action
+        env (dict): Environment the job was fired with, or None for os.environ
+        stdout (file): Binary stream for job stdout, or None for sys.stdout
+        stderr (file): Binary stream for job stderr, or None for sys.stderr
+        slot (callable): Returns a context manager, given the container name, that is held
+            while the action runs.  A job with the overlap option takes it after its lock.
+
+    Returns:
+        bool/int: Whether the operation succeeds, and if so the exit code of the job.
+    """
+    if env is None:
+        env = os.environ
+
+    if container_name == jobindex.BATCH:
+        with slot(container_name):
+            return run_batch(client, cfg, action, env)
+    if container_name == OUTPUT:
+        import sinks
+        return sinks.show(cfg.environment, action, jobid, stdout or sys.stdout.buffer)
+    if container_name == HISTORY:
+        import history
+        return history.show(cfg.environment, action, jobid, stdout or sys.stdout.buffer)
+
     try:
-        container = client.containers.get(container_name)
+        container = client.container_state(container_name)
     except:
         logger.exception("Error finding container: {}".format(container_name))
         return False
 
+    fired = env.get(FIRED_VAR)
+    if fired is not None and action in ("start", "restart", "job"):
+        try:
+            metrics.DISPATCH_LATENCY.observe(max(0.0, time.time() - float(fired)), container_name, action)
+        except ValueError:
+            pass
+
     if action == "start":
-        return start_container(container)
+        with slot(container_name):
+            return start_container(client, container)
     elif action == "restart":
-        return restart_container(container)
+        with slot(container_name):
+            return restart_container(client, container)
     elif action == "job":
-        return run_job(container, cfg, jobid)
+        return run_job(client, container, cfg, jobid, env, stdout, stderr, slot)
 
     logger.error("Invalid arguments")
     return False
 
-def start_container(container):
+def jitter(cfg, container_name, action, jobid = None):
+    """Returns how long to delay a fire when DOCKER_GEN_CRON_JITTER is set.  The delay is
+    derived from the job hash, so each job is spread to the same point every time.
+
+    Args:
+        cfg (jobindex.JobIndex/parser.CronTab): Job index or crontab configuration
+        container_name (str): Name of the target container
+        action (str): One of "start", "restart" or "job"
+        jobid (str): Job id, for the "job" action
+
+    Returns:
+        float: Delay in seconds
+    """
+    spread = parser.setting_int(cfg.environment, "DOCKER_GEN_CRON_JITTER")
+    if spread <= 0 or container_name in (OUTPUT, HISTORY):
+        return 0.0
+
+    if action == "job" and jobid and all(c in "0123456789abcdef" for c in jobid):
+        n = int(jobid, 16)
+    else:
+        n = int(hashlib.sha256("{} {}".format(container_name, action).encode("utf-8")).hexdigest()[0:10], 16)
+    return (n % (spread * 1000)) / 1000.0
+
+def start_container(client, container):
     """Starts the specified container
 
     Args:
-        container (docker.Container): Container object
+        client (dockerapi.Client): Docker client
+        container (dockerapi.ContainerState): Container state
 
     Returns:
         bool: Whether the operation succeeded.
     """
     if container.status in ("created", "exited"):
         try:
-            container.start()
+            client.start(container.id)
             return True
         except:
             logger.exception("Unexpected exception starting container {}".format(container.name))
@@ -75,18 +219,19 @@ def start_container(container):
     logger.warning("Container {} is running, won't stop".format(container.name))
     return False
 
-def restart_container(container):
+def restart_container(client, container):
     """Restarts the specified container
 
     Args:
-        container (docker.Container): Container object
+        client (dockerapi.Client): Docker client
+        container (dockerapi.ContainerState): Container state
 
     Returns:
         bool: Whether the operation succeeded.
     """
     if container.status == "running":
         try:
-            container.restart()
+            client.restart(container.id)
             return True
         except:
             logger.exception("Unexpected exception restarting container {}".format(container.name))
@@ -95,40 +240,299 @@ def restart_container(container):
     logger.warning("Container {} is not running, won't restart".format(container.name))
     return False
 
-def run_job(container, cfg, id):
+def run_batch(client, cfg, id, env):
+    """Starts/restarts the containers of a batch written by reload.group_batches, on
+    up to DOCKER_GEN_CRON_BATCH threads.  Containers listing others in the batch in their
+    DEPENDS_LABEL go after them.
+
+    Args:
+        client (dockerapi.Client): Docker client
+        cfg (jobindex.JobIndex/parser.CronTab): Job index or crontab configuration
+        id (str): Batch id
+        env (dict): Environment the batch was fired with
+
+    Returns:
+        bool: Whether every action in the batch succeeded.
+    """
+    entries = cfg.batch(id) if isinstance(cfg, jobindex.JobIndex) else None
+    if not entries:
+        logger.error("Can't find batch {}, aborting".format(id))
+        return False
+
+    # Only batches need a thread pool, keep it out of single fires' startup
+    import concurrent.futures
+
+    def state(name):
+        try:
+            return client.container_state(name)
+        except:
+            logger.exception("Error finding container: {}".format(name))
+            return None
+
+    def act(entry):
+        name, action = entry
+        container = states[name]
+        if container is None:
+            return False
+        fired = env.get(FIRED_VAR)
+        if fired is not None:
+            try:
+                metrics.DISPATCH_LATENCY.observe(max(0.0, time.time() - float(fired)), name, action)
+            except ValueError:
+                pass
+        if action == "start":
+            return start_container(client, container)
+        return restart_container(client, container)
+
+    workers = max(1, parser.setting_int(cfg.environment, "DOCKER_GEN_CRON_BATCH", 1))
+    results = {}
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        names = sorted({name for name, _ in entries})
+        states = dict(zip(names, pool.map(logconfig.in_context(state), names)))
+        for wave in dependency_waves(entries, states):
+            for entry, ok in zip(wave, pool.map(logconfig.in_context(act), wave)):
+                results[tuple(entry)] = ok
+
+    failed = ["{} {}".format(action, name) for (name, action), ok in results.items() if not ok]
+    logger.info("Batch {}: {} of {} succeeded{}".format(id, len(results) - len(failed), len(results),
+        ", failed: " + ", ".join(failed) if failed else ""))
+    return not failed
+
+def dependency_waves(entries, states):
+    """Orders the entries of a batch by the dependencies in DEPENDS_LABEL.
+
+    Args:
+        entries (list): [container name, action] of each action in the batch
+        states (dict): Map of container name to dockerapi.ContainerState, or None
+
+    Returns:
+        list: Lists of entries that can run at the same time, each after the ones before it.
+    """
+    names = {name for name, _ in entries}
+    deps = {}
+    for name in names:
+        labels = states[name].labels if states.get(name) is not None else {}
+        deps[name] = {d.strip() for d in labels.get(DEPENDS_LABEL, "").split(",")} & names - {name}
+
+    waves = []
+    done = set()
+    remaining = list(entries)
+    while remaining:
+        wave = [e for e in remaining if deps[e[0]] <= done]
+        if not wave:
+            logger.warning("Dependency cycle between {}, ignoring their order".format(", ".join(sorted({e[0] for e in remaining}))))
+            wave = remaining
+        waves.append(wave)
+        done |= {name for name, _ in wave}
+        remaining = [e for e in remaining if e not in wave]
+    return waves
+
+def run_job(client, container, cfg, id, env, stdout=None, stderr=None, slot=contextlib.nullcontext):
     """Runs job by id on the specified container.
 
     Args:
-        container (docker.Container): Container object
-        cfg (parser.CronTab): Crontab configuration
+        client (dockerapi.Client): Docker client
+        container (dockerapi.ContainerState): Container state
+        cfg (jobindex.JobIndex/parser.CronTab): Job index or crontab configuration
         id (str): Job id
+        env (dict): Environment the job was fired with
+        stdout (file): Binary stream for job stdout, or None for sys.stdout
+        stderr (file): Binary stream for job stderr, or None for sys.stderr
+        slot (callable): See dispatch
 
     Returns:
         bool/int: Whether the operation succeeds, and if so the exit code of the job.
     """
     if container.status != "running":
-        logger.warning("Container {} is not running, won't run job".format(container_name))
+        logger.warning("Container {} is not running, won't run job".format(container.name))
         return False
 
-    jobcfg = find_job(cfg, container.name, id)
+    jobcfg = lookup_job(cfg, container.name, id)
     if not jobcfg:
         logger.error("Can't find job, aborting")
         return False
 
     logger.debug(">>> Command: {}".format(jobcfg.job.cmd))
-    cmdline = get_command(jobcfg, os.environ)
+    cmdline = get_command(jobcfg, env)
     logger.debug("Executing command: {}".format(repr(cmdline)))
+
+    mode = None
+    if "overlap" in jobcfg.options:
+        import overlap
+        mode = overlap.policy(jobcfg.options)
+    timeout = job_timeout(jobcfg.options)
+    run = os.urandom(6).hex()
+    if timeout is not None or (mode is not None and mode == overlap.KILL):
+        track_pid(cmdline, id, run)
+    stop = functools.partial(signal_job, client, container.name, id, run, cmdline.get("user", ""))
+
+    def stop_previous(signal, previous):
+        signal_job(client, container.name, id, previous, cmdline.get("user", ""), signal)
+
+    # Take the lock before a slot and before setting up output, so a queued run
+    # doesn't hold up other jobs while it waits, and a skipped one costs nothing
+    lock = None
+    if mode is not None:
+        lock = overlap.acquire(container.name, id, mode, overlap.stale_after(cfg.environment), stop_previous, run)
+        if lock is None:
+            record_run(cfg, container.name, id, jobcfg.job.index, time.time(), 0.0, None)
+            return True
+
+    try:
+        with slot(container.name):
+            return exec_job(client, container, cfg, jobcfg, id, cmdline, timeout, stop, stdout, stderr)
+    finally:
+        if lock is not None:
+            lock.release()
+
+def exec_job(client, container, cfg, jobcfg, id, cmdline, timeout, stop, stdout, stderr):
+    """Runs the command of a job, see run_job.
+
+    Args:
+        jobcfg (jobindex.JobConfig): Job, from lookup_job
+        cmdline (dict): Named arguments to docker.exec_create, from get_command
+        timeout (float): Seconds the job may run for, or None for no limit
+        stop (callable): Sends the job a signal, see signal_job
+
+    Returns:
+        bool/int: Whether the operation succeeds, and if so the exit code of the job.
+    """
+    input = jobcfg.job.input
+    if "stdin" in jobcfg.options:
+        if input is not None:
+            logger.warning("Job has both % input and a stdin option, using stdin({})".format(jobcfg.options["stdin"]))
+        try:
+            input = open_stdin(jobcfg.options["stdin"])
+        except (OSError, ValueError) as e:
+            logger.error("Cannot open stdin for job: {}".format(e))
+            return False
+
+    # Only the job action needs exec, keep it out of start/restart startup
+    import exec
+
+    shipper = None
+    if cfg.environment.get("DOCKER_GEN_CRON_OUTPUT"):
+        import sinks
+        stdout, stderr, shipper = sinks.outputs(cfg.environment, container.name, id, jobcfg.job.index,
+            stdout or sys.stdout.buffer, stderr or sys.stderr.buffer)
+
+    started_at = time.time()
+    started = time.monotonic()
+    code = -1
     try:
-        return exec.docker_exec(container.client.api, container.name, cmdline, jobcfg.job.input)
+        code = exec.docker_exec(client, container.name, cmdline, input, stdout, stderr, timeout, stop)
+        metrics.EXEC_DURATION.observe(time.monotonic() - started, container.name, id)
+        metrics.EXEC_EXITS.inc(container.name, id, code)
+        return code
+    except exec.Timeout as e:
+        logger.error("{}: job {} timed out after {:.3f}s (timeout({}))".format(container.name, id, e.duration, jobcfg.options["timeout"]))
+        metrics.EXEC_DURATION.observe(time.monotonic() - started, container.name, id)
+        metrics.EXEC_EXITS.inc(container.name, id, "timeout")
+        code = exec.TIMEOUT_CODE
+        return code
     except:
         logger.exception("Unexpected exception running command")
+        metrics.EXEC_EXITS.inc(container.name, id, "error")
         return -1
+    finally:
+        record_run(cfg, container.name, id, jobcfg.job.index, started_at, time.monotonic() - started, code)
+        if input is not jobcfg.job.input:
+            input.close()
+        if shipper is not None:
+            sinks.finish(shipper, stdout, stderr)
+
+def record_run(cfg, container_name, id, index, started, duration, code):
+    """Records a run in the history, when DOCKER_GEN_CRON_HISTORY is set.
+
+    Args:
+        cfg (jobindex.JobIndex/parser.CronTab): Job index or crontab configuration
+        container_name (str): Container the job ran in
+        id (str): Job id
+        index (int): Index of the job
+        started (float): When the run started, in seconds since the epoch
+        duration (float): Duration of the run, in seconds
+        code (int): Exit code, or None if the run was skipped for overlapping the previous one
+    """
+    if not cfg.environment.get("DOCKER_GEN_CRON_HISTORY"):
+        return
+    import history
+    history.record(cfg.environment, container_name, id, index, started, duration, history.SKIPPED if code is None else code)
+
+def job_timeout(options):
+    """Returns the seconds a job may run for from its timeout option, or None for no limit"""
+    value = options.get("timeout")
+    if value is None:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        seconds = 0
+    if not 0 < seconds < float("inf"):
+        logger.warning("Ignoring invalid timeout: {}".format(repr(value)))
+        return None
+    return seconds
+
+def track_pid(cmdline, id, run):
+    """Makes a command run in its own process group and write the group id to pidfile in
+    the container before it runs, so that signal_job can reach it.
+
+    Args:
+        cmdline (dict): Named arguments to docker.exec_create, from get_command
+        id (str): Job id
+        run (str): Id of this run of the job, so that runs have their own pid files
+    """
+    cmdline["cmd"] = ["/bin/sh", "-c", TRACK_SCRIPT, PIDFILE.format(id, run), TRACK_INNER] + cmdline["cmd"]
+
+def signal_job(client, container_name, id, run, user, signal):
+    """Sends a signal to the processes of a job started with track_pid.
+
+    Args:
+        client (dockerapi.Client): Docker client
+        container_name (str): Container the job runs in
+        id (str): Job id
+        run (str): Id of the run, as given to track_pid
+        user (str): User the job runs as
+        signal (str): Signal name, e.g. "TERM"
+
+    Returns:
+        bool: Whether the signal was sent
+    """
+    import exec
+    args = {"cmd": ["/bin/sh", "-c", SIGNAL_SCRIPT, PIDFILE.format(id, run), signal], "user": user}
+    out = io.BytesIO()
+    try:
+        code = exec.docker_exec(client, container_name, args, None, out, out)
+    except:
+        logger.exception("Unexpected exception signalling job {}".format(id))
+        return False
+    if code != 0:
+        logger.warning("{}: cannot send SIG{} to job {}: {}".format(container_name, signal, id, out.getvalue().decode("utf-8", "replace").strip()))
+        return False
+    logger.info("{}: sent SIG{} to job {}".format(container_name, signal, id))
+    return True
+
+def open_stdin(name):
+    """Opens a file under STDIN_DIR to stream to the stdin of a job.
+
+    Args:
+        name (str): Path of the file, relative to STDIN_DIR
+
+    Returns:
+        file: The file, opened for reading in binary mode
+    """
+    if not name:
+        raise ValueError("stdin option requires a file name")
+    root = os.path.realpath(STDIN_DIR)
+    path = os.path.realpath(os.path.join(root, name))
+    if os.path.commonpath([root, path]) != root:
+        raise ValueError("{} is outside of {}".format(name, STDIN_DIR))
+    return open(path, "rb")
 
 def get_command(jobcfg, env):
     """Gets the command to run for the specified job.
 
     Args:
-        jobcfg (parser.Job): Job configuration
+        jobcfg (jobindex.JobConfig): Job configuration
         env (dict): Input environment arguments
 
     Returns:
@@ -149,6 +553,38 @@ def get_command(jobcfg, env):
 
     return result
 
+def load_config():
+    """Loads the precompiled job index written by reload.py, or parses the crontab
+    if there is no index.
+
+    Returns:
+        jobindex.JobIndex/parser.CronTab: The job index or crontab configuration.
+    """
+    index = jobindex.load()
+    if index is not None:
+        return index
+    return parser.parse_crontab()
+
+def lookup_job(cfg, container_name, id):
+    """Finds a job by container and id in a job index or crontab configuration.
+    Jobs missing from an index are looked up in a freshly parsed crontab.
+
+    Args:
+        cfg (jobindex.JobIndex/parser.CronTab): Job index or crontab configuration
+        container_name (str): Name of the container where the job exists
+        id (str): Job id
+
+    Returns:
+        jobindex.JobConfig: The job and its associated configuration.
+    """
+    if isinstance(cfg, jobindex.JobIndex):
+        jobcfg = cfg.find(container_name, id)
+        if jobcfg is not None:
+            return jobcfg
+        logger.debug("Job {} not found in index, parsing {}".format(id, parser.JOB_FILE))
+        cfg = parser.parse_crontab()
+    return find_job(cfg, container_name, id)
+
 def find_job(config, container_name, id):
     """Finds a job by container and id, and evalutes option values along the way.
 
@@ -158,78 +594,57 @@ def find_job(config, container_name, id):
         id (str): Job id
 
     Returns:
-        JobConfig: The job and its associated configuration.
+        jobindex.JobConfig: The job and its associated configuration.
     """
     for container in config.containers:
         if container.name != container_name:
             continue
 
-        cfg = JobConfig()
-        cfg.container = container_name
-        for job in container.jobs:
-            if job.assign is not None:
-                if job.assign[0] == "SHELL":
-                    cfg.shell = job.assign[1]
-                else:
-                    cfg.env[job.assign[0]] = job.assign[1]
-            elif job.prefix == "!":
-                cfg.add_options(job.options)
-            elif job.jobhash() == id:
-                cfg.add_options(job.options)
-                cfg.job = job
+        for cfg in jobindex.resolve_jobs(container):
+            if cfg.job.jobhash() == id:
                 return cfg
 
         return None
     return None
 
-class JobConfig:
-    """
-    JobConfig represents a job and its applied options and environment.
-
-    Attributes:
-        container (parser.Container): The container of the job.
-        env (dict): The environment variables set leading up to this job.
-        options (dict): The fcron options specified for this job.
-        shell (str): The SHELL environment variable or None.
-        job (parser.Job): The job object.
-    """
-    def __init__(self):
-        self.container = None
-        self.env = {}
-        self.options = {}
-        self.shell = None
-        self.job = None
-
-    def add_options(self, options):
-        """Merges the specified options into this JobConfig"""
-        for k, v in options.items():
-            if k == "reset":
-                self.options = {}
-                self.env = {} # TODO: Correct?
-                self.shell = None
-            else:
-                self.options[k] = v
-
-def wait_for_jobs():
+def wait_for_jobs(timeout=JOBS_TIMEOUT):
     """Waits for parser.JOB_FILE to exist and returns True on success, False on timeout"""
-    for delay in [1, 2, 5, 10, 0]:
-        if os.path.exists(parser.JOB_FILE):
-            return True
-        time.sleep(delay)
-    return False
+    started = time.monotonic()
+    if os.path.exists(parser.JOB_FILE):
+        ready = True
+    else:
+        logger.info("Waiting up to {}s for {}".format(timeout, parser.JOB_FILE))
+        import inotify
+        ready = inotify.wait_for_file(parser.JOB_FILE, timeout)
+    metrics.JOBS_WAIT.observe(time.monotonic() - started, "ready" if ready else "timeout")
+    return ready
+
+def parse_args(args):
+    """Extracts runjob arguments from the command line fcron passes to its shell.
 
-if __name__ == "__main__":
-    args = sys.argv[1:]
+    Args:
+        args (list): Command line arguments, excluding the program name
+
+    Returns:
+        list: container, action and (optionally) job id
+    """
     if len(args) == 2 and args[0] == "-c":
         import shlex
         if "--" in args[1]:
             # What comes after '--' may not parse.
-            args = shlex.split(args[1][:args[1].index("--")])
+            return shlex.split(args[1][:args[1].index("--")])
         else:
-            args = shlex.split(args[1])
+            return shlex.split(args[1])
     elif "--" in args:
-        args = args[:args.index("--")]
-    res = main(*args)
+        return args[:args.index("--")]
+    return args
+
+def exit_code(res):
+    """Converts the result of main/dispatch to a process exit code"""
     if type(res) == int:
-        sys.exit(res)
-    sys.exit(0 if res else 1)
+        return res
+    return 0 if res else 1
+
+if __name__ == "__main__":
+    logconfig.setDefault()
+    sys.exit(exit_code(main(*parse_args(sys.argv[1:]))))
@@ -0,0 +1,449 @@
+# This file is part of docker-gen-cron
+# Copyright (C) 2020 John J. Jordan
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+
+# Destinations for job output other than the cron container's console, selected
+# with DOCKER_GEN_CRON_OUTPUT.  Output is handed to a background thread that
+# writes it out in batches, so a job producing a lot of output doesn't wait on
+# the disk.
+
+import collections
+import contextvars
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import urllib.parse
+
+import metrics
+
+logger = logging.getLogger("sinks")
+
+# Sinks to use when DOCKER_GEN_CRON_OUTPUT is not set
+DEFAULT_SINKS = "console"
+OUTPUT_DIR = "/var/log/docker-gen-cron"
+
+# Per-job log files and the JSON lines log are rotated at this size, keeping BACKUPS
+MAX_BYTES = 1024 * 1024
+BACKUPS = 3
+
+# Bytes of output kept in memory for each job by the ring sink
+RING_SIZE = 64 * 1024
+
+# Bytes of output waiting to be written before output is dropped rather than queued
+MAX_PENDING = 16 * 1024 * 1024
+
+# Longest output is held before being written out
+FLUSH_INTERVAL = 0.5
+
+# Longest a finished job waits for its output to be written out
+FLUSH_TIMEOUT = 30
+
+class Record:
+    """
+    Record is a piece of output from a job.
+
+    Attributes:
+        time (float): When the output was received, in seconds since the epoch
+        container (str): Container name
+        job (str): Job id
+        index (int): Index of the job in the container's crontab entries
+        stream (str): "stdout" or "stderr"
+        data (bytes): Output
+        context (contextvars.Context): Context of the job, to log errors writing the
+            record in, or None
+    """
+    __slots__ = ("time", "container", "job", "index", "stream", "data", "context")
+
+    def __init__(self, container, job, index, stream, data, context=None):
+        self.time = time.time()
+        self.container = container
+        self.job = job
+        self.index = index
+        self.stream = stream
+        self.data = data
+        self.context = context
+
+class FileSink:
+    """
+    FileSink appends the output of each job to its own file, OUTPUT_DIR/<container>/<job>.log,
+    rotated at MAX_BYTES.
+    """
+    name = "file"
+
+    def __init__(self, directory=None, max_bytes=MAX_BYTES, backups=BACKUPS):
+        self.directory = directory or OUTPUT_DIR
+        self.max_bytes = max_bytes
+        self.backups = backups
+
+    def write(self, records):
+        by_job = collections.defaultdict(list)
+        for r in records:
+            by_job[(r.container, r.job)].append(r.data)
+        for (container, job), chunks in by_job.items():
+            path = job_log(self.directory, container, job)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            append(path, b"".join(chunks), self.max_bytes, self.backups)
+
+class JsonLinesSink:
+    """
+    JsonLinesSink appends output to OUTPUT_DIR/output.jsonl, one JSON object per piece of
+    output, tagged with its container, job id, job index and stream.  Rotated at MAX_BYTES.
+    """
+    name = "jsonl"
+
+    def __init__(self, directory=None, max_bytes=MAX_BYTES, backups=BACKUPS):
+        self.path = os.path.join(directory or OUTPUT_DIR, "output.jsonl")
+        self.max_bytes = max_bytes
+        self.backups = backups
+
+    def write(self, records):
+        lines = []
+        for r in records:
+            lines.append(json.dumps({
+                "time": r.time,
+                "container": r.container,
+                "job": r.job,
+                "index": r.index,
+                "stream": r.stream,
+                "data": r.data.decode("utf-8", "replace"),
+            }, separators=(",", ":")) + "\n")
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        append(self.path, "".join(lines).encode("utf-8"), self.max_bytes, self.backups)
+
+class RingSink:
+    """
+    RingSink keeps the last RING_SIZE bytes of output of each job in memory, for
+    recent().  Only useful in a long-running process, i.e. the dispatcher.
+    """
+    name = "ring"
+
+    def __init__(self, size=RING_SIZE):
+        self.size = size
+        self.lock = threading.Lock()
+        self.buffers = {}
+
+    def write(self, records):
+        with self.lock:
+            for r in records:
+                buf = self.buffers.get((r.container, r.job))
+                if buf is None:
+                    buf = self.buffers[(r.container, r.job)] = bytearray()
+                buf += r.data
+                if len(buf) > self.size:
+                    del buf[:len(buf) - self.size]
+
+    def tail(self, container, job=None):
+        """Returns a map of job id to recent output for the jobs of a container"""
+        with self.lock:
+            return {k[1]: bytes(v) for k, v in self.buffers.items() if k[0] == container and job in (None, k[1])}
+
+SINKS = {s.name: s for s in (FileSink, JsonLinesSink, RingSink)}
+
+class Shipper:
+    """
+    Shipper hands output to its sinks on a background thread.  Records queued while
+    the sinks are busy are written together; up to MAX_PENDING bytes can wait, beyond
+    that output is dropped (and counted in metrics) rather than holding up the job.
+    Records are numbered as they are queued, so a job can wait for just its own
+    records to be written while others keep producing output.
+
+    Args:
+        sinks (list): Sinks, objects with a write(records) method
+    """
+    def __init__(self, sinks):
+        self.sinks = sinks
+        self.queue = queue.SimpleQueue()
+        self.cond = threading.Condition()
+        self.pending = 0
+        self.submitted = 0
+        self.written = 0
+        self.flushing = 0
+        self.wake = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, record):
+        """Queues a record, or drops it if too much output is waiting.
+
+        Returns:
+            int: The record's number, to pass to flush, or None if it was dropped
+        """
+        with self.cond:
+            if self.pending + len(record.data) > MAX_PENDING:
+                metrics.OUTPUT_DROPPED.inc(record.container, amount=len(record.data))
+                return None
+            self.pending += len(record.data)
+            self.submitted += 1
+            # Queued under the lock, so records are written in the order of their numbers
+            self.queue.put((self.submitted, record))
+            return self.submitted
+
+    def flush(self, timeout=None, upto=None):
+        """Waits until the records numbered up to upto (everything submitted so far by
+        default) have been written.
+
+        Returns:
+            bool: False on timeout
+        """
+        with self.cond:
+            if upto is None:
+                upto = self.submitted
+            self.flushing += 1
+            self.wake.set()
+            try:
+                return self.cond.wait_for(lambda: self.written >= upto, timeout)
+            finally:
+                self.flushing -= 1
+
+    def ring(self):
+        """Returns the ring sink, or None"""
+        for s in self.sinks:
+            if isinstance(s, RingSink):
+                return s
+        return None
+
+    def run(self):
+        while True:
+            records = [self.queue.get()]
+            # Give the job a moment to produce more (unless someone is waiting for it),
+            # then take everything waiting
+            if self.pending < MAX_PENDING // 2 and not self.flushing:
+                self.wake.wait(FLUSH_INTERVAL)
+            self.wake.clear()
+            while True:
+                try:
+                    records.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            last = records[-1][0]
+            records = [r for _, r in records]
+            for s in self.sinks:
+                try:
+                    s.write(records)
+                except Exception:
+                    # Each job whose output was lost hears about it
+                    contexts = {id(r.context): r.context for r in records if r.context is not None}
+                    for ctx in contexts.values() or [contextvars.copy_context()]:
+                        ctx.copy().run(logger.exception, "Error writing output to {} sink".format(s.name))
+            with self.cond:
+                self.pending -= sum(len(r.data) for r in records)
+                self.written = last
+                self.cond.notify_all()
+
+class JobOutput:
+    """
+    JobOutput is the binary stream a job's stdout or stderr is written to when it has
+    sinks: the output is submitted to the Shipper, and also written to the console if
+    that's one of the sinks.
+
+    Args:
+        shipper (Shipper): Shipper
+        console (file): Console stream, or None
+        container (str): Container name
+        job (str): Job id
+        index (int): Index of the job
+        stream (str): "stdout" or "stderr"
+
+    Attributes:
+        seq (int): Number of the last record submitted, see Shipper.flush
+        context (contextvars.Context): Context the job runs in, see Record
+    """
+    def __init__(self, shipper, console, container, job, index, stream):
+        self.shipper = shipper
+        self.console = console
+        self.container = container
+        self.job = job
+        self.index = index
+        self.stream = stream
+        self.seq = 0
+        self.context = contextvars.copy_context()
+
+    def write(self, data):
+        if self.console is not None:
+            self.console.write(data)
+        seq = self.shipper.submit(Record(self.container, self.job, self.index, self.stream, bytes(data), self.context))
+        if seq is not None:
+            self.seq = seq
+        return len(data)
+
+    def flush(self):
+        if self.console is not None:
+            self.console.flush()
+
+_shipper = None
+_shipper_key = None
+_shipper_lock = threading.Lock()
+
+def shipper(environment):
+    """Returns the Shipper for the sinks configured in environment, or None if job output
+    only goes to the console.
+
+    Args:
+        environment (dict): Same as parser.CronTab.environment
+    """
+    global _shipper, _shipper_key
+    names = configured(environment)
+    directory = environment.get("DOCKER_GEN_CRON_OUTPUT_DIR") or OUTPUT_DIR
+    key = (tuple(n for n in names if n != "console"), directory)
+    if not key[0]:
+        return None
+
+    with _shipper_lock:
+        if key != _shipper_key:
+            if _shipper is not None:
+                _shipper.flush(FLUSH_TIMEOUT)
+            _shipper = Shipper([SINKS[n](directory) if n != "ring" else RingSink() for n in key[0]])
+            _shipper_key = key
+        return _shipper
+
+def configured(environment):
+    """Returns the names of the sinks selected in environment"""
+    names = []
+    for n in (environment.get("DOCKER_GEN_CRON_OUTPUT") or DEFAULT_SINKS).split(","):
+        n = n.strip()
+        if n in SINKS or n == "console":
+            names.append(n)
+        elif n:
+            logger.warning("Ignoring unknown output sink {}".format(repr(n)))
+    return names
+
+def outputs(environment, container, job, index, stdout, stderr):
+    """Returns the streams to give a job for its stdout and stderr.
+
+    Args:
+        environment (dict): Same as parser.CronTab.environment
+        container (str): Container name
+        job (str): Job id
+        index (int): Index of the job
+        stdout (file): Console stream for stdout
+        stderr (file): Console stream for stderr
+
+    Returns:
+        file: Stream for stdout
+        file: Stream for stderr
+        Shipper: The shipper, to pass to finish() when the job is done, or None
+    """
+    s = shipper(environment)
+    if s is None:
+        return stdout, stderr, None
+    console = "console" in configured(environment)
+    return (JobOutput(s, stdout if console else None, container, job, index, "stdout"),
+        JobOutput(s, stderr if console else None, container, job, index, "stderr"), s)
+
+def finish(shipper, stdout, stderr, timeout=FLUSH_TIMEOUT):
+    """Waits (up to timeout) for the output of a job to be written, see outputs().
+
+    Returns:
+        bool: False on timeout
+    """
+    if shipper.flush(timeout, max(stdout.seq, stderr.seq)):
+        return True
+    logger.warning("{}: output of job {} not written after {}s".format(stdout.container, stdout.job, timeout))
+    return False
+
+def recent(environment, container, job=None):
+    """Returns the recent output of the jobs of a container, from the ring sink if this
+    process has seen them run, otherwise from their log files.
+
+    Args:
+        environment (dict): Same as parser.CronTab.environment
+        container (str): Container name
+        job (str): Job id, or None for every job
+
+    Returns:
+        dict: Map of job id to its recent output
+    """
+    s = shipper(environment)
+    if s is not None:
+        s.flush(FLUSH_TIMEOUT)
+        ring = s.ring()
+        if ring is not None:
+            found = ring.tail(container, job)
+            if found:
+                return found
+
+    directory = environment.get("DOCKER_GEN_CRON_OUTPUT_DIR") or OUTPUT_DIR
+    if job is not None:
+        jobs = [job]
+    else:
+        try:
+            jobs = sorted(urllib.parse.unquote(f[:-4]) for f in os.listdir(os.path.dirname(job_log(directory, container, "x"))) if f.endswith(".log"))
+        except FileNotFoundError:
+            jobs = []
+    found = {}
+    for j in jobs:
+        data = read_log(directory, container, j)
+        if data is not None:
+            found[j] = data
+    return found
+
+def show(environment, container, job, out):
+    """Writes the recent output of the jobs of a container to out, see recent().
+
+    Returns:
+        bool: Whether there was any
+    """
+    found = recent(environment, container, job)
+    for j, data in sorted(found.items()):
+        if job is None:
+            out.write("==> {} {} <==\n".format(container, j).encode("utf-8"))
+        out.write(data)
+        if job is None and data and not data.endswith(b"\n"):
+            out.write(b"\n")
+    out.flush()
+    return len(found) > 0
+
+def job_log(directory, container, job):
+    """Returns the path of the log file of a job.  Both names come from the command line
+    of runjob, which runs as root, so neither may reach outside directory."""
+    return os.path.join(directory, file_name(container), "{}.log".format(file_name(job)))
+
+def file_name(name):
+    """Quotes a name for use as a file name, including a leading dot so that it can't be
+    "." or ".." (container names and job ids never start with one)"""
+    name = urllib.parse.quote(name, safe="")
+    return "%2E" + name[1:] if name.startswith(".") else name
+
+def read_log(directory, container, job, limit=RING_SIZE):
+    """Returns the last limit bytes of a job's log file, or None if it has none"""
+    path = job_log(directory, container, job)
+    try:
+        with open(path, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            f.seek(max(0, f.tell() - limit))
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+def append(path, data, max_bytes, backups):
+    """Appends data to a file, first rotating it (path.1, path.2, ...) if it would grow past max_bytes"""
+    try:
+        size = os.path.getsize(path)
+    except FileNotFoundError:
+        size = 0
+    if size > 0 and size + len(data) > max_bytes:
+        for i in range(backups - 1, 0, -1):
+            if os.path.exists("{}.{}".format(path, i)):
+                os.replace("{}.{}".format(path, i), "{}.{}".format(path, i + 1))
+        if backups > 0:
+            os.replace(path, path + ".1")
+        else:
+            os.unlink(path)
+    with open(path, "ab") as f:
+        f.write(data)
@@ -0,0 +1,133 @@
+# This file is part of docker-gen-cron
+# Copyright (C) 2020 John J. Jordan
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+
+# Short-lived cache of container states for the dispatcher, so that the jobs of
+# a container firing in the same minute share one inspect.  Entries are dropped
+# when docker reports an event for their container, and the cache is only used
+# while the event stream is up, so a state is never older than the last event.
+
+import logging
+import threading
+import time
+
+import dockerapi
+import metrics
+
+logger = logging.getLogger("statecache")
+
+# Seconds a state is kept when DOCKER_GEN_CRON_STATE_TTL is not set
+DEFAULT_TTL = 5
+
+# Events that can change a container's state
+EVENTS = ["create", "start", "restart", "stop", "kill", "die", "destroy", "rename", "pause", "unpause", "update"]
+
+class StateCache:
+    """
+    StateCache holds container states by the name (or id) they were looked up by.
+
+    Attributes:
+        ttl (float): Seconds a state is kept, 0 to disable caching
+        enabled (bool): Whether states are cached, i.e. the event stream is up
+    """
+    def __init__(self, ttl=DEFAULT_TTL):
+        self.ttl = ttl
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.generation = 0
+
+    def lookup(self, key):
+        """Returns the cached state for key, or None, and the generation to pass to store"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                metrics.STATE_CACHE.inc("hit")
+                return entry[1], self.generation
+            metrics.STATE_CACHE.inc("miss")
+            return None, self.generation
+
+    def store(self, key, state, generation):
+        """Caches a state, unless something was invalidated since its lookup"""
+        with self.lock:
+            if self.enabled and self.ttl > 0 and generation == self.generation:
+                self.entries[key] = (time.monotonic() + self.ttl, state)
+
+    def invalidate(self, id=None, name=None):
+        """Drops the state of a container, or every state if neither id nor name is given"""
+        with self.lock:
+            self.generation += 1
+            if id is None and name is None:
+                self.entries.clear()
+                return
+            for key, (_, state) in list(self.entries.items()):
+                if key in (id, name) or state.id == id or state.name == name:
+                    del self.entries[key]
+
+    def set_enabled(self, enabled):
+        """Turns caching on or off, dropping every state"""
+        with self.lock:
+            self.enabled = enabled
+        self.invalidate()
+
+class CachingClient(dockerapi.Client):
+    """
+    CachingClient is a dockerapi.Client whose container_state is served from a StateCache.
+    follow_events must run (on its own thread) for anything to be cached.
+
+    Attributes:
+        states (StateCache): The cache
+    """
+    def __init__(self, *args, ttl=DEFAULT_TTL, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.states = StateCache(ttl)
+
+    def container_state(self, container):
+        state, generation = self.states.lookup(container)
+        if state is None:
+            state = super().container_state(container)
+            self.states.store(container, state, generation)
+        return state
+
+    def start(self, container):
+        try:
+            super().start(container)
+        finally:
+            self.states.invalidate(container, container)
+
+    def restart(self, container, timeout=10):
+        try:
+            super().restart(container, timeout)
+        finally:
+            self.states.invalidate(container, container)
+
+    def follow_events(self, retry=5):
+        """Invalidates states from the event stream forever, resubscribing as needed.
+        Caching is off while there is no subscription."""
+        filters = {"type": ["container"], "event": EVENTS}
+        while True:
+            try:
+                stream = self.events(filters)
+                self.states.set_enabled(True)
+                for ev in stream:
+                    actor = ev.get("Actor") or {}
+                    self.states.invalidate(ev.get("id") or actor.get("ID"), (actor.get("Attributes") or {}).get("name"))
+                self.states.set_enabled(False)
+                logger.warning("Event stream ended, resubscribing")
+            except (dockerapi.APIError, OSError, ValueError) as e:
+                self.states.set_enabled(False)
+                logger.error("Event stream failed: {}".format(e))
+                time.sleep(retry)
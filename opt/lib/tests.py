@@ -16,13 +16,42 @@
 # along with this program; if not, write to the Free Software Foundation,
 # Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
 
+import asyncio
+import contextlib
+import io
+import json
+import logging
+import os
 import os.path
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
 import unittest
+import unittest.mock
 import yaml
 
+import aioexec
+import bench
+import dispatcher
+import dockerapi
+import exec
+import history
+import inotify
+import jobindex
+import logconfig
+import metrics
+import overlap
 import parser
 import reload
 import runjob
+import sinks
+import statecache
+import watcher
 
 class TestAll(unittest.TestCase):
     def test_basic(self):
@@ -84,6 +113,13 @@ class TestAll(unittest.TestCase):
             parsed (parser.CronTab): Configuration
             container (dict): Container json object
         """
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "jobs.idx")
+            jobindex.write(jobindex.build(parsed), path)
+            index = jobindex.load(path)
+            # Read before the directory goes away
+            index.container(container["name"])
+
         for case in container["cases"]:
             if "docker" not in case:
                 continue
@@ -98,6 +134,1403 @@ class TestAll(unittest.TestCase):
                 cmdline = runjob.get_command(jobcfg, jobcfg.env)
                 self.assertEqual(case["docker"], cmdline)
 
+                jobcfg = index.find(container["name"], job.jobhash())
+                self.assertIsNotNone(jobcfg, "Cannot find job in index")
+                self.assertEqual(job.input, jobcfg.job.input)
+
+                cmdline = runjob.get_command(jobcfg, jobcfg.env)
+                self.assertEqual(case["docker"], cmdline)
+
+class TestParser(unittest.TestCase):
+    def test_take_fields(self):
+        """Tests that fields are only split at whitespace"""
+        self.assertEqual(("abc", "", False), parser.take_fields("abc", 2))
+        self.assertEqual(("0 4 */2 *", "", False), parser.take_fields("0 4 */2 *", 5))
+        self.assertEqual(("0 4 */2 * *", "cmd  x", True), parser.take_fields(" 0 4 */2 * * cmd  x", 5))
+        self.assertEqual(("a b", "", True), parser.take_fields("a b", 2))
+        self.assertEqual(("", "a", True), parser.take_fields("a", 0))
+
+    def test_short_timespec(self):
+        """Tests that entries with too few timespec fields are dropped"""
+        c = parser.Container()
+        parser.parse_container(c, [("START_1", "0 4 */2 *"), ("RESTART_1", "0 4"), ("START_2", "0 4 */2 * *")])
+        self.assertEqual([], c.restart_jobs)
+        self.assertEqual([2], [j.index for j in c.start_jobs])
+
+class TestOptions(unittest.TestCase):
+    def test_options(self):
+        o = parser.Options()
+        o["a"] = "1"
+        o["b"] = None
+        o["c"] = "3"
+        self.assertEqual(o["a"], "1")
+        self.assertEqual(list(o), ["a", "b", "c"])
+        self.assertTrue(o.has_any("x", "c"))
+        self.assertFalse(o.has_any("x", "y"))
+
+        # Assignment replaces in place
+        o["a"] = "3"
+        self.assertEqual(o.items(), [("a", "3"), ("b", None), ("c", "3")])
+
+        del o["a"]
+        self.assertNotIn("a", o)
+        self.assertEqual(o["c"], "3")
+        self.assertEqual(len(o), 2)
+        with self.assertRaises(KeyError):
+            o["a"]
+
+class TestParserBenchmark(unittest.TestCase):
+    def test_parse_throughput(self):
+        """Benchmarks parser.parse_crontab_json on a synthetic 10k container jobs.json"""
+        j = bench.make_crontab_json(10000)
+        jobs = bench.crontab_lines(j)
+
+        cfg, elapsed = bench.timed(parser.parse_crontab_json, j)
+        self.assertEqual(10000, len(cfg.containers))
+        tracemalloc.start()
+        cfg = parser.parse_crontab_json(j)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        print("\nparse_crontab_json: {} containers, {} lines in {:.3f}s, {:.0f} lines/s, peak {:.1f} MiB".format(
+            len(cfg.containers), jobs, elapsed, jobs / elapsed, peak / (1 << 20)), file=sys.stderr)
+
+class TestJobIndex(unittest.TestCase):
+    def test_generations(self):
+        """Tests that the index is read one container at a time and replaced atomically"""
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "jobs.idx")
+            self.assertIsNone(jobindex.load(path))
+
+            index = jobindex.JobIndex()
+            index.environment = {"DOCKER_GEN_CRON_DEBUG": "1"}
+            index.containers = {"a": {"1": {"index": 1}}, "b/c": {"2": {"index": 2}}}
+            jobindex.write(index, path)
+            first = jobindex.load(path)
+            self.assertEqual(index.environment, first.environment)
+            self.assertEqual({}, first.containers)
+            self.assertEqual({"2": {"index": 2}}, first.container("b/c"))
+            self.assertEqual(["b/c"], list(first.containers))
+            self.assertEqual({}, first.container("missing"))
+
+            # Readers of the previous generation keep working, older ones are removed
+            index.containers = {"a": {"3": {"index": 3}}}
+            jobindex.write(index, path)
+            self.assertEqual({"1": {"index": 1}}, first.container("a"))
+            self.assertEqual({"3": {"index": 3}}, jobindex.load(path).container("a"))
+            jobindex.write(index, path)
+            self.assertEqual(3, len(os.listdir(d)))
+            self.assertEqual({}, jobindex.JobIndex(first.path).container("a"))
+
+class TestReload(unittest.TestCase):
+    def test_header(self):
+        """Tests that settings runjob needs at startup are assigned at the top of the crontab"""
+        j = {"containers": [{"name": "a", "running": True, "envs": [{"key": "1", "cmd": "* * * * * true"}]}],
+            "env": {"DOCKER_GEN_CRON_PROFILE_STARTUP": "1"}}
+        plain, plainrefs = reload.generate_crontab(parser.parse_crontab_json(dict(j, env={})))
+        crontab, lirefs = reload.generate_crontab(parser.parse_crontab_json(j))
+        self.assertEqual(['DOCKER_GEN_CRON_PROFILE_STARTUP="1"'] + plain, crontab)
+        self.assertEqual({n + 1 for n in plainrefs}, set(lirefs))
+
+        installed = []
+        with tempfile.TemporaryDirectory() as d, \
+                unittest.mock.patch("reload.install_crontab", lambda crontab, lirefs: installed.append((crontab, lirefs)) or True), \
+                unittest.mock.patch("jobindex.INDEX_FILE", os.path.join(d, "jobs.idx")):
+            self.assertTrue(reload.Reloader(os.path.join(d, "reload.cache")).reload(j))
+        self.assertEqual(crontab, installed[0][0])
+        self.assertEqual(set(lirefs), set(installed[0][1]))
+
+    def test_incremental(self):
+        """Tests that Reloader only regenerates changed containers and skips unchanged installs"""
+        path = os.path.realpath(os.path.dirname(__file__))
+        with open(os.path.join(path, "test_cases.yml"), "r") as f:
+            y = yaml.safe_load(f)
+        j = convert_to_json(y["tests"][0]["containers"])
+
+        installed = []
+        def install(crontab, lirefs):
+            installed.append(crontab)
+            return True
+
+        with tempfile.TemporaryDirectory() as d, \
+                unittest.mock.patch("reload.install_crontab", install), \
+                unittest.mock.patch("jobindex.INDEX_FILE", os.path.join(d, "jobs.idx")):
+            cache = os.path.join(d, "reload.cache")
+            self.assertTrue(reload.Reloader(cache).reload(j))
+            expected, _ = reload.generate_crontab(parser.parse_crontab_json(j))
+            self.assertEqual([expected], installed)
+
+            # Nothing changed, even across processes
+            r = reload.Reloader(cache)
+            self.assertTrue(r.reload(j))
+            self.assertEqual(1, len(installed))
+            line = next(l for l in installed[0] if " a job " in l)
+            jobid = line.split(" a job ")[1].split()[0]
+            self.assertIsNotNone(jobindex.load(os.path.join(d, "jobs.idx")).find("a", jobid))
+
+            # Change one container
+            j["containers"][1]["running"] = False
+            _, regenerated = r.update_sections(j)
+            self.assertEqual(1, regenerated)
+            self.assertTrue(r.reload(j))
+            expected, _ = reload.generate_crontab(parser.parse_crontab_json(j))
+            self.assertEqual(expected, installed[-1])
+
+class TestBatch(unittest.TestCase):
+    def test_reload(self):
+        """Tests that start/restart lines sharing a schedule are grouped into one batch line"""
+        def container(name, schedule):
+            return {"name": name, "running": True, "envs": [{"key": "RESTART_0", "cmd": schedule}, {"key": "0", "cmd": "@daily true"}]}
+        j = {"containers": [container("a", "0 4 * * *"), container("b", "0 4 * * *"), container("c", "0 5 * * *")],
+            "env": {"DOCKER_GEN_CRON_BATCH": "4"}}
+
+        installed = []
+        with tempfile.TemporaryDirectory() as d, \
+                unittest.mock.patch("reload.install_crontab", lambda crontab, lirefs: installed.append((crontab, lirefs)) or True), \
+                unittest.mock.patch("jobindex.INDEX_FILE", os.path.join(d, "jobs.idx")):
+            self.assertTrue(reload.Reloader(None).reload(j))
+            crontab, lirefs = installed[-1]
+            self.assertEqual(["0 5 * * * c restart"], [l for l in crontab if l.endswith(" restart")])
+            batch = [l for l in crontab if " --batch " in l]
+            self.assertEqual(1, len(batch))
+            self.assertTrue(batch[0].startswith("0 4 * * * --batch "))
+            self.assertEqual([["a", "restart"], ["b", "restart"]], jobindex.load().batch(batch[0].split()[-1]))
+            for num, job in lirefs.items():
+                self.assertIn(" {} ".format(job.container.name), crontab[num - 1])
+
+            # Batching is opt-in
+            j["env"] = {}
+            self.assertTrue(reload.Reloader(None).reload(j))
+            self.assertEqual(3, len([l for l in installed[-1][0] if l.endswith(" restart")]))
+
+    def test_options(self):
+        """Tests that start/restart entries under option lines or assignments aren't batched"""
+        def container(name, envs):
+            return {"name": name, "running": True, "envs": [{"key": k, "cmd": v} for k, v in envs]}
+        j = {"containers": [
+                container(n, [("START_0", "!mailto(ops@x.org)"), ("START_1", "0 4 * * *"), ("RESTART_0", "0 5 * * *")])
+                for n in ("a", "b")] + [
+                container("c", [("START_0", "0 4 * * *"), ("RESTART_0", "MAILTO=ops@x.org"), ("RESTART_1", "0 5 * * *")])],
+            "env": {"DOCKER_GEN_CRON_BATCH": "4"}}
+
+        installed = []
+        with tempfile.TemporaryDirectory() as d, \
+                unittest.mock.patch("reload.install_crontab", lambda crontab, lirefs: installed.append((crontab, lirefs)) or True), \
+                unittest.mock.patch("jobindex.INDEX_FILE", os.path.join(d, "jobs.idx")):
+            self.assertTrue(reload.Reloader(None).reload(j))
+            crontab, lirefs = installed[-1]
+            self.assertEqual(2, crontab.count("!mailto(ops@x.org)"))
+            self.assertEqual(["0 4 * * * a start", "0 4 * * * b start", "0 4 * * * c start"],
+                [l for l in crontab if l.endswith(" start")])
+            # Only the restarts of a and b are plain
+            self.assertEqual(["0 5 * * * c restart"], [l for l in crontab if l.endswith(" restart")])
+            batch = [l for l in crontab if " --batch " in l]
+            self.assertEqual(1, len(batch))
+            self.assertTrue(batch[0].startswith("0 5 * * * --batch "))
+            self.assertFalse(any(l.startswith("!") and "--batch" in l for l in crontab))
+
+    def test_run(self):
+        """Tests that a batch acts on every container, dependencies first"""
+        class Client:
+            def __init__(self):
+                self.calls = []
+                self.labels = {"web": {runjob.DEPENDS_LABEL: "db, cache"}, "cache": {runjob.DEPENDS_LABEL: "db"}}
+
+            def container_state(self, name):
+                if name == "gone":
+                    raise dockerapi.NotFound(404, "No such container")
+                return dockerapi.ContainerState(name, name, "running", self.labels.get(name))
+
+            def restart(self, id):
+                self.calls.append(id)
+
+        index = jobindex.JobIndex()
+        index.environment = {"DOCKER_GEN_CRON_BATCH": "4"}
+        index.batches = {"1": [["web", "restart"], ["cache", "restart"], ["db", "restart"]], "2": [["db", "restart"], ["gone", "restart"]]}
+        client = Client()
+        self.assertTrue(runjob.dispatch(client, index, jobindex.BATCH, "1", env={}))
+        self.assertEqual(["db", "cache", "web"], client.calls)
+        self.assertFalse(runjob.dispatch(client, index, jobindex.BATCH, "2", env={}))
+        self.assertFalse(runjob.dispatch(client, index, jobindex.BATCH, "3", env={}))
+
+        # A cycle doesn't stop the batch
+        client.labels["db"] = {runjob.DEPENDS_LABEL: "web"}
+        client.calls = []
+        self.assertTrue(runjob.dispatch(client, index, jobindex.BATCH, "1", env={}))
+        self.assertCountEqual(["db", "cache", "web"], client.calls)
+
+class TestWatcher(unittest.TestCase):
+    def test_watcher(self):
+        """Tests that the watcher follows container changes"""
+        client = FakeClient()
+        client.add("1", "a", True, ["CRON_1=* * * * * a job", "PATH=/bin"])
+        client.add("2", "b", False, ["CRON_START_1=0 4 * * *", "CRON_1=@hourly b job"])
+        client.add("3", "c", True, ["PATH=/bin"])
+
+        installed = []
+        def install(crontab, lirefs):
+            installed.append(crontab)
+            return True
+
+        with tempfile.TemporaryDirectory() as d, \
+                unittest.mock.patch("reload.install_crontab", install), \
+                unittest.mock.patch("jobindex.INDEX_FILE", os.path.join(d, "jobs.idx")), \
+                unittest.mock.patch("parser.JOB_FILE", os.path.join(d, "jobs.json")):
+            w = watcher.Watcher(client, reload.Reloader(None), {"DOCKER_GEN_CRON_PREFIX": "CRON"})
+            self.assertTrue(w.sync())
+            w.apply()
+            cfg = parser.parse_crontab()
+            self.assertEqual(["a", "b"], [c.name for c in cfg.containers])
+            self.assertEqual(reload.generate_crontab(cfg)[0], installed[-1])
+
+            # Containers without crontab entries don't matter
+            self.assertFalse(w.update(["3"]))
+
+            client.add("2", "b", True, ["CRON_START_1=0 4 * * *", "CRON_1=@hourly b job"])
+            self.assertTrue(w.update(["2"]))
+            w.apply()
+            self.assertTrue(any("b job" in l for l in installed[-1]))
+
+            del client.inspects["1"]
+            self.assertTrue(w.update(["1"]))
+            w.apply()
+            self.assertEqual(["b"], [c.name for c in parser.parse_crontab().containers])
+
+
+class TestScheduler(unittest.TestCase):
+    def test_coalesce(self):
+        """Tests that a burst of notifications results in a single reload"""
+        applied = []
+        sched = reload.Scheduler(applied.append, min_delay=0.05, max_delay=0.5, max_wait=5)
+        for key in ["a", "b", "a", None]:
+            sched.notify(key)
+        self.assertTrue(sched.run_once())
+        self.assertEqual([{"a", "b", None}], applied)
+        self.assertFalse(sched.run_once(timeout=0.01))
+
+        stats = sched.stats()
+        self.assertEqual(1, stats["reloads"])
+        self.assertEqual(4, stats["events"])
+        self.assertEqual(3, stats["coalesced"])
+        self.assertGreaterEqual(stats["last_apply_seconds"], 0.05)
+
+    def test_adaptive(self):
+        """Tests that the quiet period grows with the notification rate, within bounds"""
+        clock = FakeClock()
+        sched = reload.Scheduler(None, min_delay=0.25, max_delay=5, max_wait=20, clock=clock)
+        self.assertEqual(0.25, sched.delay())
+        for i in range(20):
+            sched.notify(i)
+        self.assertAlmostEqual(0.75, sched.delay())
+        for i in range(1000):
+            sched.notify(i)
+        self.assertEqual(5, sched.delay())
+
+        # Notifications older than the rate window no longer count
+        clock.now += reload.RATE_WINDOW + 1
+        self.assertEqual(0.25, sched.delay())
+
+    def test_max_wait(self):
+        """Tests that a steady stream of notifications can't postpone a reload forever"""
+        clock = FakeClock()
+        sched = reload.Scheduler(None, min_delay=0.1, max_delay=0.1, max_wait=0.3, clock=clock)
+        with sched.cond:
+            sched.notify("a")
+            self.assertAlmostEqual(0.1, sched.due())
+            for _ in range(20):
+                clock.now += 0.05
+                sched.notify("a")
+                self.assertLessEqual(sched.due(), 0.3)
+            self.assertAlmostEqual(0.3, sched.due())
+
+        # With real time, the reload runs while notifications are still coming in
+        applied = []
+        sched = reload.Scheduler(applied.append, min_delay=0.1, max_delay=0.1, max_wait=0.3)
+        done = threading.Event()
+        def notify():
+            while not done.is_set():
+                sched.notify("a")
+                time.sleep(0.02)
+        t = threading.Thread(target=notify)
+        t.start()
+        try:
+            runner = threading.Thread(target=sched.run_once)
+            runner.start()
+            runner.join(30)
+            self.assertFalse(runner.is_alive())
+            self.assertEqual([{"a"}], applied)
+        finally:
+            done.set()
+            t.join()
+
+class TestMetrics(unittest.TestCase):
+    def test_render(self):
+        """Tests the text format of counters and histograms"""
+        registry = metrics.Registry()
+        c = registry.register(metrics.Counter("jobs_total", "Jobs", ["container"]))
+        h = registry.register(metrics.Histogram("duration_seconds", "Duration", ["container"], [0.1, 1]))
+        c.inc("a")
+        c.inc("a", amount=2)
+        c.inc('b"')
+        h.observe(0.05, "a")
+        h.observe(0.5, "a")
+        h.observe(5, "a")
+        self.assertEqual(3, c.get("a"))
+        self.assertEqual([
+            "# HELP duration_seconds Duration",
+            "# TYPE duration_seconds histogram",
+            'duration_seconds_bucket{container="a",le="0.1"} 1',
+            'duration_seconds_bucket{container="a",le="1"} 2',
+            'duration_seconds_bucket{container="a",le="+Inf"} 3',
+            'duration_seconds_sum{container="a"} 5.55',
+            'duration_seconds_count{container="a"} 3',
+            "# HELP jobs_total Jobs",
+            "# TYPE jobs_total counter",
+            'jobs_total{container="a"} 3',
+            'jobs_total{container="b\\""} 1',
+        ], registry.render().splitlines())
+
+    def test_serve(self):
+        """Tests that /metrics is served over HTTP"""
+        import urllib.request
+        metrics.OUTPUT_BYTES.inc("test", "stdout", amount=10)
+        server = metrics.serve("127.0.0.1:0")
+        try:
+            url = "http://127.0.0.1:{}/metrics".format(server.server_address[1])
+            with urllib.request.urlopen(url) as resp:
+                body = resp.read().decode("utf-8")
+            self.assertIn('docker_gen_cron_output_bytes_total{container="test",stream="stdout"}', body)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+class TestBench(unittest.TestCase):
+    def test_bench(self):
+        """Tests that the benchmarks run against the fake docker daemon"""
+        args = bench.make_arg_parser().parse_args(["-c", "3", "-j", "2", "-r", "2", "-o", "70000", "-e", "10", "-i", "100"])
+        for name in ["exec", "aioexec", "runjob"]:
+            with self.subTest(benchmark=name):
+                latencies, elapsed, failed, requests = bench.BENCHMARKS[name](args)
+                self.assertEqual(12, len(latencies))
+                self.assertEqual(0, failed)
+                self.assertIn("12 fires", bench.report(name, args, latencies, elapsed, failed, requests))
+
+    def test_reload(self):
+        """Tests that the reload benchmark installs the expected crontabs"""
+        args = bench.make_arg_parser().parse_args(["reload", "-s", "50,200"])
+        results = bench.bench_reload(args)
+        self.assertEqual([50, 200], [r["containers"] for r in results])
+        for r in results:
+            # Cold and 1% changed install, unchanged doesn't
+            self.assertEqual(2, r["installs"])
+            self.assertGreater(r["output_lines"], r["containers"])
+        self.assertIn("containers", bench.report_reload(results))
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(50, bench.percentile(values, 50))
+        self.assertEqual(99, bench.percentile(values, 99))
+        self.assertEqual(1, bench.percentile(values, 0))
+        self.assertEqual(0.0, bench.percentile([], 50))
+
+class TestExec(unittest.TestCase):
+    def test_wait_for_exit(self):
+        """Tests that wait_for_exit polls until the exec stops running"""
+        class Client:
+            calls = 0
+            def exec_inspect(self, id):
+                self.calls += 1
+                return {"Running": self.calls < 4, "ExitCode": 3}
+
+        client = Client()
+        inspect = exec.wait_for_exit(client, "abc")
+        self.assertEqual(3, inspect["ExitCode"])
+        self.assertEqual(4, client.calls)
+
+    def test_timeout(self):
+        """Tests that an exec running past its timeout is signalled, then abandoned"""
+        with bench.environment(1, 1, delay=60) as (server, fires), unittest.mock.patch.object(exec, "KILL_GRACE", 0.1):
+            client = dockerapi.Client()
+            name, id = fires[0]
+            signals = []
+            started = time.monotonic()
+            with self.assertRaises(exec.Timeout) as cm:
+                exec.docker_exec(client, name, {"cmd": ["sleep", "5"]}, None, io.BytesIO(), io.BytesIO(), 0.2, signals.append)
+            self.assertEqual(["TERM", "KILL"], signals)
+            self.assertGreaterEqual(cm.exception.duration, 0.2)
+            self.assertLess(time.monotonic() - started, 30)
+
+            # runjob reports the timeout as exit code 124
+            cfg = jobindex.load()
+            cfg.environment["DOCKER_GEN_CRON_HISTORY"] = "100"
+            jobcfg = cfg.find(name, id)
+            jobcfg.options["timeout"] = "0.2"
+            timeouts = metrics.EXEC_EXITS.get(name, id, "timeout")
+            with unittest.mock.patch.object(runjob, "lookup_job", return_value=jobcfg), \
+                    unittest.mock.patch.object(runjob, "signal_job") as signal_job:
+                self.assertEqual(exec.TIMEOUT_CODE, runjob.dispatch(client, cfg, name, "job", id, env={}, stdout=io.BytesIO(), stderr=io.BytesIO()))
+            self.assertEqual(["TERM", "KILL"], [c[0][-1] for c in signal_job.call_args_list])
+            self.assertEqual(timeouts + 1, metrics.EXEC_EXITS.get(name, id, "timeout"))
+            self.assertEqual(exec.TIMEOUT_CODE, history.summarize(name)[0].last_code)
+
+    def test_read_result(self):
+        """Tests demultiplexing frames of all sizes, split across reads"""
+        sizes = [1, 7, 8, 9, 100, 4096, 65535, 65536, 70000, 300000, 2000000, 5]
+        stream, expected = make_stream(sizes)
+
+        for chunk in [7, 4096, 100000, None]:
+            with self.subTest(chunk=chunk):
+                sock = ChunkedReader(stream, chunk)
+                stdout, stderr = io.BytesIO(), io.BytesIO()
+                counts = exec.read_result(sock, stdout, stderr)
+                self.assertEqual(expected[1], stdout.getvalue())
+                self.assertEqual(expected[2], stderr.getvalue())
+                self.assertEqual((len(expected[1]), len(expected[2])), counts)
+
+    def test_read_result_splice(self):
+        """Tests that output to a pipe matches output to a file"""
+        stream, expected = make_stream([100000, 10, 3000000, 20, 30])
+        a, b = socket.socketpair()
+        r, w = os.pipe()
+        received = bytearray()
+
+        def send():
+            a.sendall(stream)
+            a.close()
+        def drain():
+            while True:
+                data = os.read(r, 65536)
+                if not data:
+                    break
+                received.extend(data)
+
+        threads = [threading.Thread(target=send), threading.Thread(target=drain)]
+        for t in threads:
+            t.start()
+        with open(w, "wb", buffering=0) as stdout:
+            stderr = io.BytesIO()
+            counts = exec.read_result(socket.SocketIO(b, "rb"), stdout, stderr)
+        for t in threads:
+            t.join()
+        b.close()
+        os.close(r)
+
+        self.assertEqual(expected[1], bytes(received))
+        self.assertEqual(expected[2], stderr.getvalue())
+        self.assertEqual((len(expected[1]), len(expected[2])), counts)
+
+    def test_large_stdin(self):
+        """Tests that a large stdin can't deadlock against output the process writes first"""
+        a, b = socket.socketpair()
+        payload = os.urandom(8 << 20)
+        output = b"x" * (8 << 20)
+
+        def process():
+            a.sendall(struct.pack(">BxxxL", 1, len(output)) + output)
+            received = 0
+            while True:
+                data = a.recv(1 << 20)
+                if not data:
+                    break
+                received += len(data)
+            result = str(received).encode("utf-8")
+            a.sendall(struct.pack(">BxxxL", 2, len(result)) + result)
+            a.close()
+
+        class Client:
+            def exec_create(self, container, stdin, **args):
+                self.stdin = stdin
+                return {"Id": "0123456789abcdef"}
+            def exec_start(self, id, socket):
+                return SocketIOWithSock(b, "rwb")
+            def exec_inspect(self, id):
+                return {"Running": False, "ExitCode": 0}
+
+        t = threading.Thread(target=process)
+        t.start()
+        client = Client()
+        stdout, stderr = io.BytesIO(), io.BytesIO()
+        self.assertEqual(0, exec.docker_exec(client, "a", {"cmd": ["cat"]}, io.BytesIO(payload), stdout, stderr))
+        t.join()
+        self.assertTrue(client.stdin)
+        self.assertEqual(len(output), len(stdout.getvalue()))
+        self.assertEqual(str(len(payload)).encode("utf-8"), stderr.getvalue())
+
+    def test_read_result_throughput(self):
+        """Benchmarks exec.read_result on a synthetic 64 MiB stream over a socket"""
+        sizes = [4096] * 8192 + [128] * 16384 + [1 << 20] * 30
+        stream, expected = make_stream(sizes)
+        a, b = socket.socketpair()
+
+        def send():
+            a.sendall(stream)
+            a.close()
+
+        t = threading.Thread(target=send)
+        t.start()
+        with CountingWriter() as stdout, CountingWriter() as stderr:
+            start = time.perf_counter()
+            exec.read_result(socket.SocketIO(b, "rb"), stdout, stderr)
+            elapsed = time.perf_counter() - start
+        t.join()
+        b.close()
+
+        self.assertEqual(len(expected[1]), stdout.count)
+        self.assertEqual(len(expected[2]), stderr.count)
+        print("\nread_result: {:.1f} MiB in {:.3f}s, {:.0f} MiB/s, {:.0f} frames/s".format(
+            len(stream) / (1 << 20), elapsed, len(stream) / (1 << 20) / elapsed, len(sizes) / elapsed), file=sys.stderr)
+
+class TestAioExec(unittest.TestCase):
+    def test_read_result(self):
+        """Tests demultiplexing frames of all sizes, split across reads"""
+        stream, expected = make_stream([1, 7, 8, 9, 100, 4096, 65535, 65536, 70000, 300000, 5])
+
+        async def read(chunk):
+            reader = asyncio.StreamReader()
+            for i in range(0, len(stream), chunk):
+                reader.feed_data(stream[i:i + chunk])
+            reader.feed_eof()
+            stdout, stderr = io.BytesIO(), io.BytesIO()
+            counts = await aioexec.read_result(reader, stdout, stderr)
+            return stdout.getvalue(), stderr.getvalue(), counts
+
+        for chunk in [7, 4096, 100000]:
+            with self.subTest(chunk=chunk):
+                stdout, stderr, counts = asyncio.run(read(chunk))
+                self.assertEqual(expected[1], stdout)
+                self.assertEqual(expected[2], stderr)
+                self.assertEqual((len(expected[1]), len(expected[2])), counts)
+
+    def test_run_all(self):
+        """Tests running execs concurrently on one event loop"""
+        with bench.environment(4, 5, output_size=70000, stderr_size=10, input_size=100, delay=0.05) as (server, fires):
+            cfg = jobindex.load()
+            out = io.BytesIO()
+            execs = []
+            for name, id in fires:
+                jobcfg = cfg.find(name, id)
+                execs.append((name, runjob.get_command(jobcfg, {}), jobcfg.job.input, out, out))
+
+            async def run():
+                client = aioexec.AsyncClient()
+                try:
+                    return await aioexec.run_all(client, execs, limit=8)
+                finally:
+                    await client.close()
+
+            started = time.monotonic()
+            results = asyncio.run(run())
+            self.assertEqual([0] * 20, results)
+            self.assertEqual(20 * 70010, len(out.getvalue()))
+            # 20 execs of 0.05s each, 8 at a time
+            self.assertLess(time.monotonic() - started, 20 * 0.05)
+
+class TestSinks(unittest.TestCase):
+    def test_sinks(self):
+        """Tests that job output reaches every configured sink"""
+        with tempfile.TemporaryDirectory() as d:
+            env = {"DOCKER_GEN_CRON_OUTPUT": "console,file,jsonl,ring", "DOCKER_GEN_CRON_OUTPUT_DIR": d}
+            console = io.BytesIO()
+            stdout, stderr, shipper = sinks.outputs(env, "a/b", "0123", 4, console, console)
+            stdout.write(b"out 1\n")
+            stderr.write(memoryview(b"err\n"))
+            stdout.write(b"out 2\n")
+            self.assertTrue(shipper.flush(5))
+
+            self.assertEqual(b"out 1\nerr\nout 2\n", console.getvalue())
+            self.assertEqual(b"out 1\nerr\nout 2\n", sinks.read_log(d, "a/b", "0123"))
+            with open(os.path.join(d, "output.jsonl")) as f:
+                records = [json.loads(l) for l in f]
+            self.assertEqual(["stdout", "stderr", "stdout"], [r["stream"] for r in records])
+            self.assertEqual({("a/b", "0123", 4)}, {(r["container"], r["job"], r["index"]) for r in records})
+            self.assertEqual({"0123": b"out 1\nerr\nout 2\n"}, sinks.recent(env, "a/b"))
+
+            out = io.BytesIO()
+            self.assertTrue(sinks.show(dict(env, DOCKER_GEN_CRON_OUTPUT="file"), "a/b", None, out))
+            self.assertEqual(b"==> a/b 0123 <==\nout 1\nerr\nout 2\n", out.getvalue())
+            self.assertFalse(sinks.show(env, "c", None, io.BytesIO()))
+
+        # Console only is the default, and doesn't need a shipper
+        self.assertEqual((console, console, None), sinks.outputs({}, "a", "0", 0, console, console))
+
+    def test_traversal(self):
+        """Tests that container names and job ids can't reach outside the output directory"""
+        with tempfile.TemporaryDirectory() as d:
+            out = os.path.join(d, "out")
+            os.makedirs(os.path.join(out, "a"))
+            with open(os.path.join(d, "secret.log"), "wb") as f:
+                f.write(b"secret\n")
+            env = {"DOCKER_GEN_CRON_OUTPUT": "file", "DOCKER_GEN_CRON_OUTPUT_DIR": out}
+            for container, job in [("a", "../../secret"), ("a", "../../secret.log"), ("..", "secret"), ("a/../..", "secret")]:
+                with self.subTest(container=container, job=job):
+                    self.assertTrue(os.path.realpath(sinks.job_log(out, container, job)).startswith(out + os.sep))
+                    self.assertEqual({}, sinks.recent(env, container, job))
+                    self.assertFalse(sinks.show(env, container, job, io.BytesIO()))
+
+    def test_finish(self):
+        """Tests that a job waits only for its own output, however busy other jobs are"""
+        class SlowSink:
+            name = "slow"
+            def __init__(self):
+                self.written = []
+            def write(self, records):
+                time.sleep(0.01)
+                self.written.extend(records)
+
+        sink = SlowSink()
+        shipper = sinks.Shipper([sink])
+        done = threading.Event()
+        def chatty():
+            out = sinks.JobOutput(shipper, None, "a", "chatty", 0, "stdout")
+            while not done.is_set():
+                out.write(b"x")
+        t = threading.Thread(target=chatty)
+        t.start()
+        try:
+            stdout = sinks.JobOutput(shipper, None, "a", "quiet", 1, "stdout")
+            stderr = sinks.JobOutput(shipper, None, "a", "quiet", 1, "stderr")
+            stdout.write(b"out")
+            stderr.write(b"err")
+            self.assertTrue(sinks.finish(shipper, stdout, stderr, 30))
+            self.assertEqual([b"out", b"err"], [r.data for r in list(sink.written) if r.job == "quiet"])
+            self.assertTrue(t.is_alive())
+
+            # Nothing submitted, nothing to wait for
+            idle = sinks.JobOutput(shipper, None, "a", "idle", 2, "stdout")
+            self.assertTrue(sinks.finish(shipper, idle, idle, 0))
+
+        finally:
+            done.set()
+            t.join()
+
+        # Waiting is bounded, and a timeout is logged
+        gate = threading.Event()
+        class BlockedSink:
+            name = "blocked"
+            def write(self, records):
+                gate.wait()
+        blocked = sinks.Shipper([BlockedSink()])
+        out = sinks.JobOutput(blocked, None, "a", "blocked", 0, "stdout")
+        out.write(b"x")
+        with self.assertLogs("sinks", "WARNING"):
+            self.assertFalse(sinks.finish(blocked, out, out, 0.05))
+        gate.set()
+        self.assertTrue(sinks.finish(blocked, out, out, 30))
+
+    def test_rotation(self):
+        """Tests that logs are rotated when they would grow past their limit"""
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "x.log")
+            for i in range(5):
+                sinks.append(path, str(i).encode("utf-8") * 6, 10, 2)
+            with open(path, "rb") as f:
+                self.assertEqual(b"444444", f.read())
+            with open(path + ".2", "rb") as f:
+                self.assertEqual(b"222222", f.read())
+            self.assertFalse(os.path.exists(path + ".3"))
+
+    def test_runjob(self):
+        """Tests that runjob sends job output to the sinks, and prints it back"""
+        with bench.environment(2, 1, output_size=100) as (server, fires), tempfile.TemporaryDirectory() as d:
+            cfg = jobindex.load()
+            cfg.environment.update({"DOCKER_GEN_CRON_OUTPUT": "file", "DOCKER_GEN_CRON_OUTPUT_DIR": d})
+            client = dockerapi.Client()
+            console = io.BytesIO()
+            name, id = fires[0]
+            self.assertEqual(0, runjob.dispatch(client, cfg, name, "job", id, env={}, stdout=console, stderr=console))
+            self.assertEqual(b"", console.getvalue())
+
+            out = io.BytesIO()
+            self.assertTrue(runjob.dispatch(client, cfg, runjob.OUTPUT, name, id, env={}, stdout=out))
+            self.assertEqual(b"x" * 100, out.getvalue())
+
+class TestHistory(unittest.TestCase):
+    def test_record(self):
+        """Tests that runs are recorded and summarized, keeping the last few of each job"""
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "history.db")
+            env = {"DOCKER_GEN_CRON_HISTORY": "5"}
+            for i in range(8):
+                history.record(env, "a", "0123", 2, 1000.0 + i, float(i), 1 if i in (4, 6) else 0, path)
+            history.record(env, "a", "4567", 3, 2000.0, 0.5, 0, path)
+            history.record(env, "b", "0123", 0, 3000.0, 0.5, 0, path)
+            history.record({"DOCKER_GEN_CRON_HISTORY": "0"}, "a", "0123", 2, 4000.0, 9.0, 9, path)
+
+            s = history.summarize("a", None, path)
+            self.assertEqual(["0123", "4567"], [x.job for x in s])
+            self.assertEqual((2, 5, 1007.0, 7.0, 0), (s[0].index, s[0].runs, s[0].last_started, s[0].last_duration, s[0].last_code))
+            self.assertEqual((5.0, 7.0, 2), (s[0].p50, s[0].p95, s[0].failures))
+            self.assertEqual(1, s[1].runs)
+            self.assertEqual([], history.summarize("c", None, path))
+
+            out = io.BytesIO()
+            self.assertTrue(history.show(env, "a", "4567", out, path))
+            lines = out.getvalue().decode("utf-8").splitlines()
+            self.assertEqual(2, len(lines))
+            self.assertTrue(lines[0].startswith("JOB"))
+            self.assertTrue(lines[1].startswith("4567"))
+            self.assertFalse(history.show(env, "c", None, io.BytesIO(), path))
+
+    def test_skipped(self):
+        """Tests that skipped runs are counted apart from the runs that ran"""
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "history.db")
+            env = {"DOCKER_GEN_CRON_HISTORY": "5"}
+            history.record(env, "a", "0123", 0, 1000.0, 2.0, 1, path)
+            history.record(env, "a", "0123", 0, 1060.0, 0.0, history.SKIPPED, path)
+            history.record(env, "a", "4567", 0, 1060.0, 0.0, history.SKIPPED, path)
+            s = history.summarize("a", None, path)
+            self.assertEqual([(2, 1, 1, 2.0, history.SKIPPED), (1, 0, 1, None, history.SKIPPED)],
+                [(x.runs, x.failures, x.skipped, x.p50, x.last_code) for x in s])
+
+            out = io.BytesIO()
+            self.assertTrue(history.show(env, "a", None, out, path))
+            lines = out.getvalue().decode("utf-8").splitlines()
+            self.assertEqual(["skip", "100.0%", "1"], [lines[1].split()[i] for i in (5, -2, -1)])
+            self.assertEqual(["-", "-", "-", "-"], lines[2].split()[6:10])
+
+    def test_prune(self):
+        """Tests that the database is capped however many job ids come and go"""
+        with tempfile.TemporaryDirectory() as d, \
+                unittest.mock.patch.multiple(history, MAX_ROWS=30, PRUNE_INTERVAL=10, MAX_AGE=1000):
+            path = os.path.join(d, "history.db")
+            env = {"DOCKER_GEN_CRON_HISTORY": "5"}
+            history.record(env, "a", "old", 0, 1.0, 0.5, 0, path)
+            for i in range(100):
+                history.record(env, "a", "{:04x}".format(i), 0, 5000.0 + i, 0.5, 0, path)
+            count, oldest = history.connect(path).execute("SELECT count(*), min(started) FROM runs").fetchone()
+            self.assertLessEqual(count, 30 + 10)
+            self.assertGreater(oldest, 1.0)
+            self.assertEqual([], history.summarize("a", "old", path))
+
+    def test_runjob(self):
+        """Tests that runjob records the runs of jobs, and prints their history"""
+        with bench.environment(2, 1) as (server, fires):
+            cfg = jobindex.load()
+            client = dockerapi.Client()
+            name, id = fires[0]
+            # History is off by default
+            self.assertEqual(0, runjob.dispatch(client, cfg, name, "job", id, env={}, stdout=io.BytesIO(), stderr=io.BytesIO()))
+            out = io.BytesIO()
+            self.assertFalse(runjob.dispatch(client, cfg, runjob.HISTORY, name, None, env={}, stdout=out))
+            self.assertIn(b"DOCKER_GEN_CRON_HISTORY", out.getvalue())
+            self.assertEqual([], [f for f in os.listdir(os.path.dirname(history.HISTORY_FILE)) if f.startswith("history.db")])
+
+            cfg.environment["DOCKER_GEN_CRON_HISTORY"] = "100"
+            for i in range(3):
+                self.assertEqual(0, runjob.dispatch(client, cfg, name, "job", id, env={}, stdout=io.BytesIO(), stderr=io.BytesIO()))
+
+            s = history.summarize(name)
+            self.assertEqual([(id, 3, 0)], [(x.job, x.runs, x.failures) for x in s])
+            out = io.BytesIO()
+            self.assertTrue(runjob.dispatch(client, cfg, runjob.HISTORY, name, None, env={}, stdout=out))
+            self.assertIn(id[:12], out.getvalue().decode("utf-8"))
+
+class TestOverlap(unittest.TestCase):
+    def setUp(self):
+        d = tempfile.TemporaryDirectory()
+        self.addCleanup(d.cleanup)
+        patcher = unittest.mock.patch.object(overlap, "LOCK_DIR", d.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_skip(self):
+        """Tests that a run is skipped while the previous one holds the lock"""
+        skipped = metrics.OVERLAPS.get("a/b", "skip1", "skip")
+        with overlap.acquire("a/b", "skip1", overlap.SKIP) as lock:
+            self.assertIsNotNone(lock)
+            self.assertIsNone(overlap.acquire("a/b", "skip1", overlap.SKIP))
+            # Other jobs and containers have their own locks
+            with overlap.acquire("a/b", "skip2", overlap.SKIP), overlap.acquire("c", "skip1", overlap.SKIP):
+                pass
+        self.assertEqual(skipped + 1, metrics.OVERLAPS.get("a/b", "skip1", "skip"))
+        self.assertEqual([], os.listdir(overlap.LOCK_DIR))
+        with overlap.acquire("a/b", "skip1", overlap.SKIP) as lock:
+            self.assertIsNotNone(lock)
+
+    def test_queue(self):
+        """Tests that a queued run waits for the previous one, and kill stops it"""
+        for policy in (overlap.QUEUE, overlap.KILL):
+            lock = overlap.acquire("a", "queue", policy, run="r1")
+            signals = []
+            if policy == overlap.QUEUE:
+                threading.Timer(0.2, lock.release).start()
+            started = time.monotonic()
+            with overlap.acquire("a", "queue", policy, kill=lambda *s: (signals.append(s), lock.release()), run="r2"):
+                self.assertEqual([("TERM", "r1")] if policy == overlap.KILL else [], signals)
+                if policy == overlap.QUEUE:
+                    self.assertGreaterEqual(time.monotonic() - started, 0.2)
+
+    def test_stale(self):
+        """Tests that a lock held for too long is broken"""
+        lock = overlap.acquire("a", "stale", overlap.SKIP)
+        past = time.time() - 120
+        os.utime(lock.path, (past, past))
+        self.assertIsNone(overlap.acquire("a", "stale", overlap.SKIP, stale=300))
+        with overlap.acquire("a", "stale", overlap.SKIP, stale=60) as newer:
+            self.assertIsNotNone(newer)
+            # The stale holder finishing doesn't remove the new lock
+            lock.release()
+            self.assertTrue(os.path.exists(newer.path))
+            self.assertIsNone(overlap.acquire("a", "stale", overlap.SKIP, stale=60))
+
+    def test_runjob(self):
+        """Tests that runjob takes the lock before its output and slot, and records skips"""
+        with bench.environment(1, 2) as (server, fires):
+            cfg = jobindex.load()
+            cfg.environment["DOCKER_GEN_CRON_HISTORY"] = "100"
+            cfg.environment["DOCKER_GEN_CRON_OUTPUT"] = "console"
+            client = dockerapi.Client()
+            (name, first), (_, second) = fires
+            jobcfgs = {id: cfg.find(name, id) for _, id in fires}
+            limiter = dispatcher.Limiter()
+            limiter.configure(1, 0)
+
+            def fire(id, policy):
+                jobcfgs[id].options["overlap"] = policy
+                return runjob.dispatch(client, cfg, name, "job", id, env={}, stdout=io.BytesIO(), stderr=io.BytesIO(), slot=limiter.slot)
+
+            with unittest.mock.patch.object(runjob, "lookup_job", side_effect=lambda cfg, name, id: jobcfgs[id]):
+                lock = overlap.acquire(name, first, overlap.SKIP)
+                with unittest.mock.patch.object(sinks, "outputs") as outputs:
+                    self.assertTrue(fire(first, overlap.SKIP))
+                outputs.assert_not_called()
+                self.assertEqual((1, 1, history.SKIPPED), [(s.runs, s.skipped, s.last_code) for s in history.summarize(name, first)][0])
+
+                # A queued run waits for the lock without holding up other jobs' slots
+                queued = metrics.OVERLAPS.get(name, first, overlap.QUEUE)
+                results = []
+                t = threading.Thread(target=lambda: results.append(fire(first, overlap.QUEUE)))
+                t.start()
+                deadline = time.monotonic() + 5
+                while metrics.OVERLAPS.get(name, first, overlap.QUEUE) == queued and time.monotonic() < deadline:
+                    time.sleep(0.01)
+                other = threading.Thread(target=lambda: results.append(fire(second, None)))
+                other.start()
+                other.join(5)
+                self.assertEqual([0], results)
+                self.assertTrue(t.is_alive())
+                lock.release()
+                t.join(5)
+                self.assertEqual([0, 0], results)
+                self.assertEqual(0, limiter.running)
+
+    def test_command(self):
+        """Tests the commands that track and signal the processes of a job"""
+        cmdline = {"cmd": ["/bin/sh", "-c", "sleep 90"], "environment": {}}
+        runjob.track_pid(cmdline, "0123", "r1")
+        self.assertEqual("/tmp/docker-gen-cron.0123.r1.pid", cmdline["cmd"][3])
+        self.assertEqual(["/bin/sh", "-c", "sleep 90"], cmdline["cmd"][5:])
+
+        # The job runs in its own process group, so a signal reaches the processes it
+        # started, and the pid file goes away when it exits
+        pidfile = os.path.join(overlap.LOCK_DIR, "pid")
+        childfile = os.path.join(overlap.LOCK_DIR, "child")
+        job = subprocess.Popen(cmdline["cmd"][:3] + [pidfile] + cmdline["cmd"][4:5] +
+            ["/bin/sh", "-c", 'sleep 90 & echo $! > "$0"; wait', childfile])
+        self.addCleanup(job.kill)
+        deadline = time.monotonic() + 5
+        while not (os.path.exists(childfile) and os.path.getsize(childfile)) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        with open(pidfile) as f:
+            pgid = int(f.read())
+        with open(childfile) as f:
+            child = int(f.read())
+        self.assertEqual(pgid, os.getpgid(child))
+        self.assertNotEqual(os.getpgid(0), pgid)
+
+        subprocess.run(["/bin/sh", "-c", runjob.SIGNAL_SCRIPT, pidfile, "TERM"], check=True)
+        self.assertEqual(128 + 15, job.wait(5))
+        self.assertFalse(os.path.exists(pidfile))
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline:
+            try:
+                with open("/proc/{}/stat".format(child)) as f:
+                    if f.read().rsplit(")", 1)[1].split()[0] == "Z":
+                        break
+            except FileNotFoundError:
+                break
+            time.sleep(0.01)
+        else:
+            self.fail("child of the job is still running")
+
+class TestStateCache(unittest.TestCase):
+    def test_cache(self):
+        """Tests that container states are cached until they expire or are invalidated"""
+        with bench.environment(2, 1) as (server, fires):
+            client = statecache.CachingClient(ttl=60)
+            name = fires[0][0]
+            other = [n for n, _ in fires if n != name][0]
+            hits, misses = metrics.STATE_CACHE.get("hit"), metrics.STATE_CACHE.get("miss")
+
+            # Nothing is cached without the event stream
+            client.container_state(name)
+            requests = server.requests
+            client.container_state(name)
+            self.assertEqual(requests + 1, server.requests)
+
+            client.states.set_enabled(True)
+            state = client.container_state(name)
+            client.container_state(other)
+            requests = server.requests
+            self.assertIs(state, client.container_state(name))
+            client.container_state(other)
+            self.assertEqual(requests, server.requests)
+            self.assertEqual((hits + 2, misses + 4), (metrics.STATE_CACHE.get("hit"), metrics.STATE_CACHE.get("miss")))
+
+            # Events and our own start/restart drop the container's state only
+            client.states.invalidate(state.id, None)
+            self.assertIsNot(state, client.container_state(name))
+            self.assertEqual(requests + 1, server.requests)
+            client.start(client.container_state(name).id)
+            client.container_state(other)
+            self.assertEqual(requests + 2, server.requests)
+            client.container_state(name)
+            self.assertEqual(requests + 3, server.requests)
+
+            # A state looked up before an invalidation isn't stored
+            _, generation = client.states.lookup("x")
+            client.states.invalidate(None, "y")
+            client.states.store("x", state, generation)
+            self.assertIsNone(client.states.lookup("x")[0])
+
+            client.states.ttl = 0
+            client.states.invalidate()
+            client.container_state(name)
+            client.container_state(name)
+            self.assertEqual(requests + 5, server.requests)
+
+class TestDockerAPI(unittest.TestCase):
+    def exchange(self, response):
+        """Returns a Connection whose peer has sent response, and the peer socket"""
+        a, b = socket.socketpair()
+        self.addCleanup(b.close)
+        conn = dockerapi.Connection(a)
+        self.addCleanup(conn.close)
+        b.sendall(response)
+        return conn, b
+
+    def test_responses(self):
+        """Tests Content-Length and chunked responses on one keep-alive connection"""
+        conn, peer = self.exchange(
+            b"HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\nhello"
+            b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n"
+            b"3\r\nabc\r\n2;ext=1\r\nde\r\n0\r\nX-Trailer: 1\r\n\r\n"
+            b"HTTP/1.1 204 No Content\r\n\r\n")
+        conn.request("GET", "/a")
+        self.assertTrue(peer.recv(1024).startswith(b"GET /a HTTP/1.1\r\n"))
+
+        resp = conn.response()
+        self.assertEqual((200, "OK"), (resp.status, resp.reason))
+        self.assertFalse(resp.will_close)
+        self.assertEqual(b"hello", resp.read())
+
+        resp = conn.response()
+        self.assertTrue(resp.chunked)
+        self.assertEqual([b"abc", b"de"], list(resp.chunks()))
+
+        resp = conn.response()
+        self.assertEqual(204, resp.status)
+        self.assertEqual(b"", resp.read())
+        self.assertFalse(resp.will_close)
+
+    def test_close_delimited(self):
+        """Tests a response that ends with the connection"""
+        conn, peer = self.exchange(b"HTTP/1.0 200 OK\r\n\r\nall of it")
+        peer.shutdown(socket.SHUT_WR)
+        resp = conn.response()
+        self.assertTrue(resp.will_close)
+        self.assertEqual(b"all of it", resp.read())
+
+        with self.assertRaises(dockerapi.ConnectionClosed):
+            conn.response()
+
+    def test_upgrade(self):
+        """Tests that bytes read past an upgrade response are handed over with the socket"""
+        conn, peer = self.exchange(b"HTTP/1.1 101 UPGRADED\r\nConnection: Upgrade\r\nUpgrade: tcp\r\n\r\n\x01\x00\x00\x00")
+        resp = conn.response()
+        self.assertEqual(101, resp.status)
+        sock, leftover = conn.detach()
+        self.addCleanup(sock.close)
+        peer.sendall(b"\x00\x00\x00\x02hi")
+        self.assertEqual(b"\x01\x00\x00\x00", leftover)
+        self.assertEqual(b"\x00\x00\x00\x02hi", sock.recv(1024))
+
+    def test_retry(self):
+        """Tests that only GETs are retried when the daemon drops a pooled connection,
+        and that idle connections it closed aren't used"""
+        # What the daemon does with each request: respond, respond and close, or drop it
+        actions = iter(["ok", "drop", "ok", "drop", "close", "ok"])
+        seen = []
+        d = tempfile.TemporaryDirectory()
+        self.addCleanup(d.cleanup)
+        path = os.path.join(d.name, "docker.sock")
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.addCleanup(listener.close)
+        listener.bind(path)
+        listener.listen(8)
+
+        def serve(sock):
+            with sock:
+                data = b""
+                while True:
+                    while b"\r\n\r\n" not in data:
+                        chunk = sock.recv(4096)
+                        if not chunk:
+                            return
+                        data += chunk
+                    head, _, data = data.partition(b"\r\n\r\n")
+                    length = int(dict(l.split(b": ", 1) for l in head.split(b"\r\n")[1:]).get(b"Content-Length", 0))
+                    while len(data) < length:
+                        data += sock.recv(4096)
+                    data = data[length:]
+                    seen.append(head.split(b" ")[0].decode())
+                    action = next(actions)
+                    if action == "drop":
+                        return
+                    sock.sendall(b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\n{}")
+                    if action == "close":
+                        return
+
+        def accept():
+            while True:
+                try:
+                    sock, _ = listener.accept()
+                except OSError:
+                    return
+                threading.Thread(target=serve, args=(sock,), daemon=True).start()
+        threading.Thread(target=accept, daemon=True).start()
+
+        client = dockerapi.Client("unix://" + path)
+        self.addCleanup(client.close)
+        self.assertEqual({}, client.inspect_container("a"))
+        self.assertEqual({}, client.inspect_container("a"))
+        self.assertEqual(["GET", "GET", "GET"], seen)
+
+        with self.assertRaises(ConnectionError):
+            client.start("a")
+        self.assertEqual(["GET", "GET", "GET", "POST"], seen)
+
+        self.assertEqual({}, client.inspect_container("a"))
+        time.sleep(0.1)
+        client.start("a")
+        self.assertEqual(["GET", "GET", "GET", "POST", "GET", "POST"], seen)
+
+    def test_parse_host(self):
+        """Tests daemon URLs, and that TLS settings are refused rather than ignored"""
+        with unittest.mock.patch.dict(os.environ, {"DOCKER_API_VERSION": "1.40"}):
+            self.assertEqual(("/run/d.sock", None, "/v1.40"), dockerapi.parse_host("unix:///run/d.sock"))
+            self.assertEqual((None, ("h", 2375), "/v1.40"), dockerapi.parse_host("tcp://h"))
+        for var in dockerapi.TLS_VARS:
+            with self.subTest(var=var), unittest.mock.patch.dict(os.environ, {var: "1"}):
+                with self.assertRaisesRegex(ValueError, var):
+                    dockerapi.parse_host("tcp://h:2376")
+
+    def test_startup_imports(self):
+        """Tests that runjob starts without the modules it only needs for some actions"""
+        code = ("import sys, runjob; "
+            "print(' '.join(m for m in ('docker', 'http.client', 'http.server', 'exec') if m in sys.modules))")
+        proc = subprocess.run([sys.executable, "-c", code], cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True)
+        self.assertEqual(0, proc.returncode, proc.stderr)
+        self.assertEqual("", proc.stdout.strip())
+
+class TestInotify(unittest.TestCase):
+    def check_wait(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "jobs.json")
+            self.assertFalse(inotify.wait_for_file(path, 0.1))
+
+            def write():
+                time.sleep(0.2)
+                with open(path + ".tmp", "w") as f:
+                    f.write("{}")
+                os.replace(path + ".tmp", path)
+            t = threading.Thread(target=write)
+            t.start()
+            started = time.monotonic()
+            self.assertTrue(inotify.wait_for_file(path, 10))
+            self.assertLess(time.monotonic() - started, 5)
+            t.join()
+            self.assertTrue(inotify.wait_for_file(path, 0))
+
+    def test_wait(self):
+        """Tests waiting for a file to be renamed into place"""
+        self.check_wait()
+
+    def test_poll(self):
+        """Tests waiting for a file where inotify is unavailable"""
+        with unittest.mock.patch("inotify.watch", lambda directory, mask: None):
+            self.check_wait()
+
+    def test_wait_for_jobs(self):
+        """Tests that runjob records how long fires waited for jobs.json"""
+        with tempfile.TemporaryDirectory() as d, \
+                unittest.mock.patch("parser.JOB_FILE", os.path.join(d, "jobs.json")):
+            timeouts = metrics.JOBS_WAIT.values.get(("timeout",), [None, 0])[1]
+            self.assertFalse(runjob.wait_for_jobs(0.05))
+            self.assertEqual(timeouts + 1, metrics.JOBS_WAIT.values[("timeout",)][1])
+
+class TestDispatcher(unittest.TestCase):
+    def test_limiter(self):
+        """Tests that the per-container limit queues a container without blocking others"""
+        limiter = dispatcher.Limiter()
+        limiter.configure(2, 1)
+        order = []
+
+        def run(name):
+            with limiter.slot(name):
+                order.append(name)
+
+        with limiter.slot("a"):
+            t1 = threading.Thread(target=run, args=("a",))
+            t1.start()
+            t2 = threading.Thread(target=run, args=("b",))
+            t2.start()
+            t2.join(5)
+            self.assertEqual(["b"], order)
+            self.assertTrue(t1.is_alive())
+        t1.join(5)
+        self.assertEqual(["b", "a"], order)
+        self.assertEqual(0, limiter.running)
+
+    def test_jitter(self):
+        """Tests that jitter is deterministic and within the configured spread"""
+        cfg = parser.CronTab()
+        self.assertEqual(0, runjob.jitter(cfg, "a", "job", "0123456789"))
+
+        cfg.environment["DOCKER_GEN_CRON_JITTER"] = "30"
+        delay = runjob.jitter(cfg, "a", "job", "0123456789")
+        self.assertEqual(delay, runjob.jitter(cfg, "a", "job", "0123456789"))
+        self.assertTrue(0 <= delay < 30)
+        self.assertTrue(0 <= runjob.jitter(cfg, "a", "restart") < 30)
+
+    @contextlib.contextmanager
+    def serve(self, *args, **kwargs):
+        """Runs a dispatcher on a temporary socket against bench's fake docker daemon,
+        forwarding log records to clients as dispatcher.main does"""
+        with bench.environment(*args, **kwargs) as (docker, fires), tempfile.TemporaryDirectory() as d:
+            server = dispatcher.Server(os.path.join(d, "dispatcher.sock"))
+            handler = dispatcher.ClientLogHandler()
+            handler.setFormatter(logconfig.formatter())
+            logging.getLogger().addHandler(handler)
+            t = threading.Thread(target=server.serve_forever)
+            t.start()
+            try:
+                yield server, fires
+            finally:
+                logging.getLogger().removeHandler(handler)
+                server.shutdown()
+                server.server_close()
+                t.join()
+
+    def request(self, server, data, close=False):
+        """Sends a raw request to a dispatcher.
+
+        Returns:
+            dict: Map of stream to the bytes received on it (EXIT to the exit code)
+        """
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(10)
+            sock.connect(server.server_address)
+            sock.sendall(data)
+            sock.shutdown(socket.SHUT_WR)
+            if close:
+                return None
+            data = bytearray()
+            while True:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                data += chunk
+
+        streams = {}
+        pos = 0
+        while pos < len(data):
+            self.assertGreaterEqual(len(data) - pos, 8, "truncated frame header")
+            stream, length = struct.unpack_from(">BxxxL", data, pos)
+            pos += 8
+            self.assertGreaterEqual(len(data) - pos, length, "truncated frame")
+            self.assertNotIn(dispatcher.EXIT, streams, "frame after the exit frame")
+            if stream == dispatcher.EXIT:
+                self.assertEqual(4, length)
+                streams[stream] = struct.unpack_from(">l", data, pos)[0]
+            else:
+                streams[stream] = streams.get(stream, b"") + bytes(data[pos:pos + length])
+            pos += length
+        return streams
+
+    def encode(self, args, env):
+        return "".join(s + "\0" for s in [str(len(args))] + args + ["{}={}".format(k, v) for k, v in env.items()]).encode("utf-8")
+
+    def test_job(self):
+        """Tests running a job through the dispatcher: output frames, then the exit frame"""
+        with self.serve(2, 1, output_size=70000, stderr_size=10) as (server, fires):
+            name, id = fires[0]
+            res = self.request(server, self.encode([name, "job", id], {"PATH": "/bin"}))
+            self.assertEqual(b"x" * 70000, res[dispatcher.STDOUT])
+            self.assertIn(b"x" * 10, res[dispatcher.STDERR])
+            self.assertEqual(0, res[dispatcher.EXIT])
+
+            # fcron's shell-style invocation
+            res = self.request(server, self.encode(["-c", "{} job {} -- cmd".format(name, id)], {}))
+            self.assertEqual(0, res[dispatcher.EXIT])
+
+    def test_errors(self):
+        """Tests that failures are reported through the exit code and forwarded log output"""
+        with self.serve(1, 1) as (server, fires):
+            res = self.request(server, self.encode(["missing", "job", "0123"], {}))
+            self.assertEqual(1, res[dispatcher.EXIT])
+            self.assertIn(b"Error finding container: missing", res[dispatcher.STDERR])
+
+            res = self.request(server, self.encode(["a"], {}))
+            self.assertEqual(1, res[dispatcher.EXIT])
+            self.assertIn(b"Invalid arguments", res[dispatcher.STDERR])
+
+            # Malformed requests are dropped without a response
+            for data in [b"", b"3\0a\0b\0", b"x\0a\0", b"1\0a", b"-1\0"]:
+                with self.subTest(data=data):
+                    self.assertEqual({}, self.request(server, data))
+            with unittest.mock.patch("dispatcher.MAX_REQUEST", 16):
+                self.assertEqual({}, self.request(server, self.encode(["a", "job", "0123"], {"X": "y" * 32})))
+
+            name, id = fires[0]
+            self.assertEqual(0, self.request(server, self.encode([name, "job", id], {}))[dispatcher.EXIT])
+
+    def test_batch_errors(self):
+        """Tests that log records of a batch's worker threads reach the client"""
+        with self.serve(1, 1) as (server, fires):
+            name = fires[0][0]
+            index = jobindex.JobIndex()
+            index.environment = {"DOCKER_GEN_CRON_BATCH": "4"}
+            index.batches = {"1": [[name, "restart"], ["gone", "restart"]]}
+            with unittest.mock.patch.object(server, "config", return_value=index):
+                res = self.request(server, self.encode([jobindex.BATCH, "1"], {}))
+            self.assertEqual(1, res[dispatcher.EXIT])
+            self.assertIn(b"Error finding container: gone", res[dispatcher.STDERR])
+
+    def test_client_gone(self):
+        """Tests that a client disconnecting mid-job doesn't disturb the dispatcher"""
+        with self.serve(1, 1, output_size=1024 * 1024, delay=0.2) as (server, fires):
+            name, id = fires[0]
+            with self.assertLogs("dispatcher", "WARNING") as logs:
+                self.request(server, self.encode([name, "job", id], {}), close=True)
+                deadline = time.monotonic() + 10
+                while not any("went away" in l for l in logs.output) and time.monotonic() < deadline:
+                    time.sleep(0.05)
+            self.assertTrue(any("Client went away" in l for l in logs.output))
+            self.assertEqual(0, server.limiter.running)
+            self.assertEqual(0, self.request(server, self.encode([name, "job", id], {}))[dispatcher.EXIT])
+
+    def test_reload_request(self):
+        """Tests that reload.py's requests are queued with the dispatcher's scheduler"""
+        with tempfile.TemporaryDirectory() as d, \
+                unittest.mock.patch("dispatcher.SOCKET_PATH", os.path.join(d, "dispatcher.sock")):
+            self.assertFalse(dispatcher.request_reload())
+
+            server = dispatcher.Server(dispatcher.SOCKET_PATH)
+            t = threading.Thread(target=server.serve_forever)
+            t.start()
+            try:
+                self.assertTrue(dispatcher.request_reload())
+                self.assertTrue(dispatcher.request_reload())
+                self.assertEqual(2, server.scheduler.stats()["events"])
+            finally:
+                server.shutdown()
+                server.server_close()
+                t.join()
+
+    def test_reload_request_watcher(self):
+        """Tests that reload requests go to the watcher's scheduler when it replaces docker-gen"""
+        with tempfile.TemporaryDirectory() as d, \
+                unittest.mock.patch("dispatcher.SOCKET_PATH", os.path.join(d, "dispatcher.sock")), \
+                unittest.mock.patch("watcher.Watcher.run"):
+            server = dispatcher.Server(dispatcher.SOCKET_PATH)
+            idle = server.scheduler
+            dispatcher.start_reloads(server, {"DOCKER_GEN_CRON_WATCHER": "1"})
+            self.assertIsNot(idle, server.scheduler)
+            t = threading.Thread(target=server.serve_forever)
+            t.start()
+            try:
+                self.assertTrue(dispatcher.request_reload())
+                self.assertEqual(1, server.scheduler.stats()["events"])
+                self.assertEqual({watcher.RESYNC}, server.scheduler.pending)
+            finally:
+                server.shutdown()
+                server.server_close()
+                t.join()
+
+class FakeClock:
+    """Clock for reload.Scheduler that only moves when told to"""
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+class FakeClient:
+    """Stands in for dockerapi.Client with a fixed set of containers"""
+    def __init__(self):
+        self.inspects = {}
+
+    def add(self, id, name, running, env):
+        self.inspects[id] = {"Id": id, "Name": "/" + name, "State": {"Running": running}, "Config": {"Env": env}}
+
+    def containers(self, all=False):
+        return [{"Id": id} for id in self.inspects]
+
+    def inspect_container(self, id):
+        if id not in self.inspects:
+            raise watcher.dockerapi.NotFound(404, "No such container: " + id)
+        return self.inspects[id]
+
+class ChunkedReader:
+    """Socket stand-in that returns at most chunk bytes per read"""
+    def __init__(self, data, chunk):
+        self.data = memoryview(data)
+        self.chunk = chunk
+
+    def readinto(self, b):
+        n = min(len(b), len(self.data), self.chunk or len(b))
+        b[:n] = self.data[:n]
+        self.data = self.data[n:]
+        return n
+
+class SocketIOWithSock(socket.SocketIO):
+    """socket.SocketIO that closes its socket on close, like the one docker.APIClient returns"""
+    def close(self):
+        sock = self._sock
+        super().close()
+        sock.close()
+
+class CountingWriter(io.FileIO):
+    """Writes to /dev/null and counts the bytes written"""
+    def __init__(self):
+        super().__init__(os.devnull, "wb")
+        self.count = 0
+
+    def write(self, b):
+        n = super().write(b)
+        self.count += n
+        return n
+
+def make_stream(sizes):
+    """Makes a multiplexed stream with frames of the specified sizes, alternating between
+    stdout and stderr.
+
+    Returns:
+        bytes: The stream
+        dict: The expected output of streams 1 and 2
+    """
+    stream = bytearray()
+    expected = {1: bytearray(), 2: bytearray()}
+    for i, size in enumerate(sizes):
+        n = 1 + i % 2
+        data = bytes([65 + i % 26]) * size
+        stream += struct.pack(">BxxxL", n, size) + data
+        expected[n] += data
+    return bytes(stream), {k: bytes(v) for k, v in expected.items()}
+
 def convert_to_json(containers):
     """Converts data found in test_cases to the format found in jobs.json"""
     result = {"containers": [], "env": {}}
@@ -106,7 +1539,7 @@ def convert_to_json(containers):
             "name": c["name"],
             "running": c["running"],
             "envs": [{
-                "key": parser.trim_prefix("CRON_", k),
+                "key": k[len("CRON_"):],
                 "cmd": v,
             } for k, v in c["env"].items() if k.startswith("CRON_")]
         })
@@ -0,0 +1,198 @@
+#!/usr/bin/python3
+# This file is part of docker-gen-cron
+# Copyright (C) 2020 John J. Jordan
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+
+# Built-in replacement for docker-gen (enabled with DOCKER_GEN_CRON_WATCHER).
+# Subscribes to the docker event stream and inspects only the containers an
+# event refers to, maintaining the same jobs.json contents that
+# jobs.json.tmpl renders, and runs the reload in-process.
+
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+import dockerapi
+import parser
+import logconfig
+import reload
+
+logger = logging.getLogger("watcher")
+
+# Events that can change a container's crontab entries or running state
+EVENTS = ["create", "start", "restart", "die", "destroy", "rename", "pause", "unpause"]
+
+# Notified in place of a container id when every container has to be inspected again
+RESYNC = None
+
+def main():
+    Watcher().run()
+    return True
+
+class Watcher:
+    """
+    Watcher keeps the crontab up-to-date from docker events.
+
+    Attributes:
+        client (dockerapi.Client): Docker client
+        reloader (reload.Reloader): Installs the crontab
+        prefix (str): Environment variable prefix of crontab entries, e.g. "CRON_"
+        env (dict): Environment of the cron container, as in jobs.json
+        containers (dict): Map of container id to its jobs.json entry, or None before
+            the first sync
+        scheduler (reload.Scheduler): Coalesces events into reloads
+    """
+    def __init__(self, client=None, reloader=None, env=None):
+        self.client = client or dockerapi.Client()
+        self.reloader = reloader or reload.Reloader()
+        self.env = dict(os.environ if env is None else env)
+        self.prefix = "{}_".format(self.env.get("DOCKER_GEN_CRON_PREFIX") or "CRON")
+        self.containers = None
+        self.scheduler = reload.Scheduler(self.refresh)
+
+    def run(self):
+        """Watches for events forever"""
+        t = threading.Thread(target=self.subscribe, daemon=True)
+        t.start()
+        self.scheduler.run()
+
+    def refresh(self, ids):
+        """Inspects the containers in ids (or all of them if RESYNC is one of them), and
+        reloads if anything changed.  Called by the scheduler."""
+        try:
+            if RESYNC in ids or self.containers is None:
+                changed = self.sync()
+            else:
+                changed = self.update(ids)
+            if changed:
+                self.apply()
+        except dockerapi.APIError as e:
+            logger.error("Docker API error: {}".format(e))
+            time.sleep(1)
+            self.scheduler.notify(RESYNC)
+        except OSError as e:
+            logger.error("Cannot reach docker: {}".format(e))
+            time.sleep(5)
+            self.scheduler.notify(RESYNC)
+
+    def subscribe(self):
+        """Feeds container ids from the event stream to the scheduler, resubscribing as
+        needed.  Each (re)subscription notifies RESYNC, since events may have been missed."""
+        filters = {"type": ["container"], "event": EVENTS}
+        while True:
+            try:
+                stream = self.client.events(filters)
+                self.scheduler.notify(RESYNC)
+                for ev in stream:
+                    id = ev.get("id") or ev.get("Actor", {}).get("ID")
+                    if id:
+                        logger.debug("Event {} for {}".format(ev.get("Action") or ev.get("status"), id))
+                        self.scheduler.notify(id)
+                logger.warning("Event stream ended, resubscribing")
+            except (dockerapi.APIError, OSError, ValueError) as e:
+                logger.error("Event stream failed: {}".format(e))
+                time.sleep(5)
+
+    def sync(self):
+        """Inspects every container.
+
+        Returns:
+            bool: Whether any container's entry changed
+        """
+        containers = {}
+        for c in self.client.containers(all=True):
+            try:
+                entry = container_json(self.client.inspect_container(c["Id"]), self.prefix)
+            except dockerapi.NotFound:
+                continue
+            if entry is not None:
+                containers[c["Id"]] = entry
+
+        changed = containers != self.containers
+        self.containers = containers
+        logger.debug("Synced {} containers with crontab entries".format(len(containers)))
+        return changed
+
+    def update(self, ids):
+        """Inspects the specified containers.
+
+        Returns:
+            bool: Whether any container's entry changed
+        """
+        changed = False
+        for id in ids:
+            try:
+                entry = container_json(self.client.inspect_container(id), self.prefix)
+            except dockerapi.NotFound:
+                entry = None
+
+            if entry is None:
+                changed |= self.containers.pop(id, None) is not None
+            elif self.containers.get(id) != entry:
+                self.containers[id] = entry
+                changed = True
+        return changed
+
+    def jobs_json(self):
+        """Returns the current contents of jobs.json"""
+        return {
+            "containers": sorted(self.containers.values(), key=lambda c: c["name"]),
+            "env": self.env,
+        }
+
+    def apply(self):
+        """Writes jobs.json and installs the crontab"""
+        j = self.jobs_json()
+        write_jobs_json(j)
+        return self.reloader.reload(j)
+
+def container_json(inspect, prefix):
+    """Converts the inspect output of a container to its jobs.json entry.
+
+    Args:
+        inspect (dict): Output of dockerapi.Client.inspect_container
+        prefix (str): Environment variable prefix of crontab entries
+
+    Returns:
+        dict: The entry, or None if the container has no crontab entries.
+    """
+    envs = {}
+    for e in inspect["Config"].get("Env") or []:
+        k, sep, v = e.partition("=")
+        if sep and k.startswith(prefix):
+            envs[k[len(prefix):]] = v
+    if len(envs) == 0:
+        return None
+
+    return {
+        "name": inspect["Name"].lstrip("/"),
+        "running": inspect["State"]["Running"],
+        "envs": [{"key": k, "cmd": v} for k, v in sorted(envs.items())],
+    }
+
+def write_jobs_json(j):
+    """Atomically replaces parser.JOB_FILE"""
+    tmp = "{}.{}.tmp".format(parser.JOB_FILE, os.getpid())
+    with open(tmp, "w") as f:
+        json.dump(j, f)
+    os.replace(tmp, parser.JOB_FILE)
+
+if __name__ == "__main__":
+    logconfig.setDefault()
+    sys.exit(0 if main() else 1)